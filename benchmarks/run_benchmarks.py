@@ -0,0 +1,309 @@
+"""
+Benchmarks of the data pipeline, the training step and the decoding.
+
+Generates a synthetic EDUB-SegDesc-shaped dataset (see benchmarks/synthetic_dataset.py) and times:
+    * build_dataset: building the Dataset instance from the annotation and feature list files (for each dataset
+      variant needed by the benchmarked models)
+    * batches: loading training batches (Dataset.getXY_FromIndices)
+    * train_epoch/<MODEL_TYPE>: one training epoch of each model (building and compiling the model are timed apart)
+    * decode/beam_<BEAM_SIZE>: beam search decoding of the val split with the trained model of --decode-model
+The results (and the commit, the arguments and the dataset statistics) are stored in a JSON file. With --compare, they
+are compared with a previous results file.
+
+Usage (from the root of the repository):
+    python -m benchmarks.run_benchmarks [--output benchmark.json] [--compare previous.json]
+        [--benchmarks build_dataset,batches,train_epoch,decode] [--model-types ArcticVideoCaptionWithInit,...]
+        [--beam-sizes 1,5,10] [--events 300] [--repeats 3] [key=Value ...]
+"""
+import argparse
+import ast
+import json
+import logging
+import os
+import random
+import subprocess
+import time
+import traceback
+from timeit import default_timer as timer
+
+import numpy as np
+
+from benchmarks.synthetic_dataset import generate_dataset, parse_range
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+BENCHMARKS = ['build_dataset', 'batches', 'train_epoch', 'decode']
+MODEL_TYPES = ['ArcticVideoCaptionWithInit', 'ArcticVideoCaptionNoLSTMEncWithInit',
+               'TemporallyLinkedVideoDescriptionNoAtt', 'TemporallyLinkedVideoDescriptionAtt',
+               'TemporallyLinkedVideoDescriptionAttDoublePrev', 'VideoTextEmbedding', 'DeepSeek']
+
+
+def dataset_variant(model_type):
+    """
+    DATASET_NAME suffix required by each model type.
+    """
+    if model_type == 'TemporallyLinkedVideoDescriptionAttDoublePrev':  # previous description and previous video
+        return '-linked-vidtext'
+    if model_type.startswith('TemporallyLinked'):
+        return '-linked'
+    if model_type == 'VideoTextEmbedding':
+        return '-vidtext-embed'
+    return ''
+
+
+def benchmark_parameters(base_params, data_path, store_path, model_type):
+    """
+    Parameters for training 'model_type' on the synthetic dataset (the dataset dependent ids of config.py are set
+    for the DATASET_NAME of the model).
+    """
+    params = dict(base_params)
+    variant = dataset_variant(model_type)
+    params['DATASET_NAME'] = 'EDUB-synthetic' + variant
+    params['DATA_ROOT_PATH'] = data_path
+    params['DATASET_STORE_PATH'] = os.path.join(store_path, 'datasets') + '/'
+    params['MODEL_TYPE'] = model_type
+    params['MODEL_NAME'] = 'benchmark_' + model_type
+    params['STORE_PATH'] = os.path.join(store_path, 'models', model_type) + '/'
+    for key in ['FRAMES_LIST_FILES', 'FRAMES_COUNTS_FILES', 'DESCRIPTION_FILES', 'DESCRIPTION_COUNTS_FILES']:
+        params[key] = dict([(s, f.replace('_without_noninfo', '')) for s, f in base_params[key].iteritems()])
+    params['FEATURE_NAMES'] = ['ImageNet']
+    params['LINK_SAMPLE_FILES'] = dict([(s, 'Annotations/' + s + '_link_samples.txt')
+                                        for s in ['train', 'val', 'test']])
+
+    if variant == '-vidtext-embed':
+        params['INPUTS_IDS_DATASET'] = ['video', 'description']
+        params['OUTPUTS_IDS_DATASET'] = ['match']
+        params['BEAM_SEARCH'] = False
+        params['STOP_METRIC'] = 'accuracy'
+    else:
+        params['INPUTS_IDS_DATASET'] = ['video', 'state_below']
+        params['OUTPUTS_IDS_DATASET'] = ['description']
+        params['SAMPLE_WEIGHTS'] = True
+        if variant.startswith('-linked'):
+            params['INPUTS_IDS_DATASET'] += ['prev_description']
+            if variant == '-linked-vidtext':
+                params['INPUTS_IDS_DATASET'] += ['prev_video']
+            params['INPUTS_IDS_DATASET'] += ['link_index']
+    params['INPUTS_IDS_MODEL'] = list(params['INPUTS_IDS_DATASET'])
+    params['OUTPUTS_IDS_MODEL'] = list(params['OUTPUTS_IDS_DATASET'])
+
+    # Only the training step is timed
+    params['REBUILD_DATASET'] = False
+    params['RELOAD'] = 0
+    params['MODE'] = 'training'
+    params['MAX_EPOCH'] = 1
+    params['METRICS'] = []
+    params['SAMPLE_ON_SETS'] = []
+    params['EVAL_ON_SETS_KERAS'] = []
+    params['EPOCHS_FOR_SAVE'] = None
+    params['SAVE_EACH_EVALUATION'] = False
+    params['PRE_TRAINED_DATASET_NAME'] = None
+    params['PRE_TRAINED_VOCABULARY_NAME'] = None
+    params['TRG_PRETRAINED_VECTORS'] = None
+    params['VERBOSE'] = 0
+    return params
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return None
+
+
+def summarize(times, **extra):
+    result = {'time': float(np.median(times)), 'min': float(np.min(times)), 'times': [float(t) for t in times]}
+    result.update(extra)
+    return result
+
+
+def bench_build_dataset(params, repeats):
+    from data_engine.prepare_data import build_dataset
+
+    build_params = dict(params)
+    build_params['REBUILD_DATASET'] = True
+    times = []
+    dataset = None
+    for _ in range(repeats):
+        start_time = timer()
+        dataset = build_dataset(build_params)
+        times.append(timer() - start_time)
+    return dataset, summarize(times, samples=dataset.len_train)
+
+
+def bench_batches(dataset, params, repeats, n_batches=50):
+    batch_size = params['BATCH_SIZE']
+    n_samples = min(n_batches * batch_size, dataset.len_train)
+    times = []
+    for _ in range(repeats):
+        start_time = timer()
+        for i in range(0, n_samples, batch_size):
+            dataset.getXY_FromIndices('train', range(i, min(i + batch_size, n_samples)), dataAugmentation=False)
+        times.append(timer() - start_time)
+    return summarize(times, samples=n_samples, samples_per_sec=n_samples / max(np.median(times), 1e-8))
+
+
+def bench_train_epoch(params, dataset):
+    """
+    Trains one epoch. Returns the results and the trained model.
+    """
+    from keras.callbacks import Callback as KerasCallback
+    from main import train_model
+
+    timings = dict()
+    trained = dict()
+
+    class EpochTimer(KerasCallback):
+        def on_epoch_begin(self, epoch, logs=None):
+            timings['epoch_start'] = timer()
+
+        def on_epoch_end(self, epoch, logs=None):
+            timings['epoch'] = timer() - timings['epoch_start']
+
+    def build_timer(model):
+        trained['model'] = model
+        timings['setup'] = timer() - timings['start']
+        return EpochTimer()
+
+    timings['start'] = timer()
+    train_model(params, dataset=dataset, callback_builders=[build_timer])
+    result = summarize([timings['epoch']], setup=timings['setup'], samples=dataset.len_train,
+                       samples_per_sec=dataset.len_train / max(timings['epoch'], 1e-8))
+    return result, trained['model']
+
+
+def bench_decode(model, dataset, params, beam_size):
+    prediction_params = {'max_batch_size': params['BATCH_SIZE'],
+                         'n_parallel_loaders': 1,
+                         'predict_on_sets': ['val'],
+                         'beam_size': beam_size,
+                         'maxlen': params['MAX_OUTPUT_TEXT_LEN_TEST'],
+                         'optimized_search': params['OPTIMIZED_SEARCH'],
+                         'batched_search': params.get('BATCHED_SEARCH', False),
+                         'model_inputs': params['INPUTS_IDS_MODEL'],
+                         'model_outputs': params['OUTPUTS_IDS_MODEL'],
+                         'dataset_inputs': params['INPUTS_IDS_DATASET'],
+                         'dataset_outputs': params['OUTPUTS_IDS_DATASET'],
+                         'normalize_probs': params['NORMALIZE_SAMPLING'],
+                         'alpha_factor': params['ALPHA_FACTOR'],
+                         'temporally_linked': dataset_variant(params['MODEL_TYPE']).startswith('-linked')}
+    start_time = timer()
+    model.predictBeamSearchNet(dataset, prediction_params)
+    elapsed = timer() - start_time
+    return summarize([elapsed], samples=dataset.len_val, samples_per_sec=dataset.len_val / max(elapsed, 1e-8))
+
+
+def run(args, base_params):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    data_path = os.path.join(args.work_path, 'data')
+    stats = generate_dataset(data_path, n_events=args.events, n_days=args.days, frames=args.frames,
+                             captions=args.captions, vocabulary_size=args.vocabulary,
+                             feat_size=base_params['IMG_FEAT_SIZE'], write_csv=False, seed=args.seed)
+
+    results = dict()
+    datasets = dict()
+    for model_type in args.model_types:
+        params = benchmark_parameters(base_params, data_path, args.work_path, model_type)
+        variant = dataset_variant(model_type)
+        if variant not in datasets:
+            if not os.path.isdir(params['DATASET_STORE_PATH']):
+                os.makedirs(params['DATASET_STORE_PATH'])
+            datasets[variant], result = bench_build_dataset(params, args.repeats)
+            if 'build_dataset' in args.benchmarks:
+                results['build_dataset/' + params['DATASET_NAME']] = result
+                logger.info('build_dataset %s: %.2fs' % (params['DATASET_NAME'], result['time']))
+            if 'batches' in args.benchmarks:
+                result = bench_batches(datasets[variant], params, args.repeats)
+                results['batches/' + params['DATASET_NAME']] = result
+                logger.info('batches %s: %.1f samples/s' % (params['DATASET_NAME'], result['samples_per_sec']))
+        if 'train_epoch' not in args.benchmarks and \
+                ('decode' not in args.benchmarks or model_type != args.decode_model):
+            continue
+
+        try:
+            result, model = bench_train_epoch(params, datasets[variant])
+        except Exception:
+            logger.error('Error training ' + model_type + ':\n' + traceback.format_exc())
+            results['train_epoch/' + model_type] = {'error': traceback.format_exc()}
+            continue
+        if 'train_epoch' in args.benchmarks:
+            results['train_epoch/' + model_type] = result
+            logger.info('train_epoch %s: %.2fs (setup %.2fs)' % (model_type, result['time'], result['setup']))
+        if 'decode' in args.benchmarks and model_type == args.decode_model:
+            for beam_size in args.beam_sizes:
+                result = bench_decode(model, datasets[variant], params, beam_size)
+                results['decode/beam_' + str(beam_size)] = result
+                logger.info('decode beam %d: %.1f samples/s' % (beam_size, result['samples_per_sec']))
+
+    return {'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'arguments': dict([(k, v) for k, v in vars(args).iteritems() if k != 'changes']),
+            'changes': args.changes,
+            'dataset': stats,
+            'results': results}
+
+
+def compare(report, previous):
+    """
+    Prints the time of each benchmark against a previous report (ratio < 1 is faster).
+    """
+    print '\n%-60s %12s %12s %8s' % ('benchmark', 'previous', 'current', 'ratio')
+    for name in sorted(set(report['results']) | set(previous['results'])):
+        current = report['results'].get(name, {}).get('time')
+        old = previous['results'].get(name, {}).get('time')
+        ratio = '%8.3f' % (current / old) if current is not None and old else '%8s' % '-'
+        print '%-60s %12s %12s %s' % (name, '%.3f' % old if old is not None else '-',
+                                      '%.3f' % current if current is not None else '-', ratio)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks of the data pipeline, training step and decoding.')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='Results file')
+    parser.add_argument('--compare', type=str, default=None, help='Previous results file to compare with')
+    parser.add_argument('--work-path', type=str, default='/tmp/tma_benchmarks',
+                        help='Folder of the synthetic dataset and the models')
+    parser.add_argument('--benchmarks', type=lambda v: v.split(','), default=BENCHMARKS,
+                        help='Comma-separated benchmarks (' + ','.join(BENCHMARKS) + ')')
+    parser.add_argument('--model-types', type=lambda v: v.split(','), default=MODEL_TYPES,
+                        help='Comma-separated MODEL_TYPEs trained for one epoch')
+    parser.add_argument('--decode-model', type=str, default='ArcticVideoCaptionWithInit',
+                        help='MODEL_TYPE used for the decoding benchmarks')
+    parser.add_argument('--beam-sizes', type=lambda v: [int(b) for b in v.split(',')], default=[1, 5, 10],
+                        help='Comma-separated BEAM_SIZEs')
+    parser.add_argument('--events', type=int, default=300, help='Number of synthetic events')
+    parser.add_argument('--days', type=int, default=20, help='Number of synthetic days')
+    parser.add_argument('--frames', type=parse_range, default=(5, 80), help='Min,max frames per event')
+    parser.add_argument('--captions', type=parse_range, default=(1, 5), help='Min,max captions per event')
+    parser.add_argument('--vocabulary', type=int, default=3000, help='Synthetic vocabulary size')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Repetitions of the data benchmarks (the median time is reported)')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed')
+    parser.add_argument('changes', nargs='*', help='Changes to the config (key=Value)', default=[])
+    return parser
+
+
+if __name__ == "__main__":
+    from config import load_parameters
+
+    args = build_parser().parse_args()
+    parameters = load_parameters()
+    try:
+        for arg in args.changes:
+            k, v = arg.split('=')
+            parameters[k] = ast.literal_eval(v)
+    except ValueError:
+        print 'Overwritten arguments must have the form key=Value'
+        exit(1)
+    if 'decode' in args.benchmarks and args.decode_model not in args.model_types:
+        args.model_types.append(args.decode_model)
+
+    benchmark_report = run(args, parameters)
+    with open(args.output, 'w') as f:
+        json.dump(benchmark_report, f, indent=1, sort_keys=True)
+    logger.info('Benchmark results stored in ' + args.output)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(benchmark_report, json.load(f))
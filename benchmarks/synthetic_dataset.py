@@ -0,0 +1,156 @@
+"""
+Synthetic EDUB-SegDesc-shaped dataset.
+
+Writes, in the layout read by data_engine/prepare_data.py (with the default file names of config.py):
+    Features/<split>_<feature>_all_frames.csv       one CSV line of features per frame (raw features, as the input of
+    Features/<split>_<feature>_all_frames_counts.txt  data_engine/generate_features_lists.py) and frames per event
+    Features/<feature>/video_<i>/frame_<j>.npy      features of each frame
+    Annotations/<feature>/<split>_feat_list.txt     path of the features of each frame
+    Annotations/<feature>/<split>_feat_counts.txt   number of frames of each event
+    Annotations/<split>_list_final.txt              event names (<day>_<event>), in chronological order per day
+    Annotations/<split>_descriptions.txt            captions of the events, one per line
+    Annotations/<split>_descriptions_counts.npy     number of captions of each event
+    Annotations/<split>_link_samples.txt            index of the previous event of the same day (-1 for the first one)
+The features lists/counts and the links are also the inputs of the previous videos of the '-linked-vidtext' variant
+(insertTemporallyLinkedCaptionsVidText). The captions are drawn from a Zipf distribution over a synthetic vocabulary,
+so that the vocabulary and caption length statistics are realistic. The same arguments and seed always produce the same dataset.
+
+Usage:
+    python -m benchmarks.synthetic_dataset --path /tmp/EDUB-synthetic [--events 1339] [--days 55] [--frames 5,80]
+        [--captions 1,5] [--vocabulary 3000] [--feat-size 1024]
+"""
+import argparse
+import logging
+import os
+
+import numpy as np
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+SPLITS = ['train', 'val', 'test']
+
+
+def split_days(n_days, proportions=(0.7, 0.15, 0.15)):
+    """
+    Number of days of each split (at least one each).
+    """
+    n_val = max(int(round(n_days * proportions[1])), 1)
+    n_test = max(int(round(n_days * proportions[2])), 1)
+    return [max(n_days - n_val - n_test, 1), n_val, n_test]
+
+
+def generate_caption(rng, word_probabilities, min_words=4, max_words=20):
+    length = rng.randint(min_words, max_words + 1)
+    words = rng.choice(len(word_probabilities), size=length, p=word_probabilities)
+    return ' '.join(['w%d' % w for w in words])
+
+
+def generate_dataset(path, n_events=1339, n_days=55, frames=(5, 80), captions=(1, 5), vocabulary_size=3000,
+                     feat_size=1024, feature_name='ImageNet', write_csv=True, seed=1234):
+    """
+    Generates a synthetic dataset in 'path'.
+    :param n_events: total number of events (videos)
+    :param n_days: number of days (the events of a day are temporally linked)
+    :param frames: (min, max) number of frames per event
+    :param captions: (min, max) number of captions per event
+    :param vocabulary_size: number of distinct words
+    :param feat_size: size of the features of each frame (IMG_FEAT_SIZE)
+    :param feature_name: feature type (FEATURE_NAMES)
+    :param write_csv: also write the raw features CSV files
+    :param seed: random seed
+    :return: dictionary of statistics of the generated dataset
+    """
+    rng = np.random.RandomState(seed)
+    word_probabilities = 1. / np.arange(1, vocabulary_size + 1)
+    word_probabilities /= word_probabilities.sum()
+
+    for folder in ['Annotations/' + feature_name, 'Features/' + feature_name]:
+        if not os.path.isdir(os.path.join(path, folder)):
+            os.makedirs(os.path.join(path, folder))
+
+    # Events per day: at least one
+    events_per_day = np.ones((n_days,), dtype='int64')
+    events_per_day += np.bincount(rng.randint(0, n_days, size=max(n_events - n_days, 0)), minlength=n_days)
+    days_per_split = split_days(n_days)
+
+    stats = {'events': dict(), 'captions': dict(), 'frames': dict()}
+    day = 0
+    video = 0
+    for split, split_n_days in zip(SPLITS, days_per_split):
+        names = []
+        links = []
+        frame_counts = []
+        caption_counts = []
+        with open(os.path.join(path, 'Annotations', split + '_descriptions.txt'), 'w') as f_descriptions, \
+                open(os.path.join(path, 'Annotations', feature_name, split + '_feat_list.txt'), 'w') as f_list:
+            f_csv = open(os.path.join(path, 'Features', split + '_' + feature_name + '_all_frames.csv'), 'w') \
+                if write_csv else None
+            for _ in range(split_n_days):
+                for event in range(events_per_day[day]):
+                    links.append(len(names) - 1 if event > 0 else -1)
+                    names.append('Day%d_%d' % (day + 1, event + 1))
+                    n_frames = rng.randint(frames[0], frames[1] + 1)
+                    frame_counts.append(n_frames)
+                    video_path = 'Features/%s/video_%0.4d' % (feature_name, video)
+                    if not os.path.isdir(os.path.join(path, video_path)):
+                        os.makedirs(os.path.join(path, video_path))
+                    features = rng.rand(n_frames, feat_size).astype('float32')
+                    for j in range(n_frames):
+                        frame_path = '%s/frame_%0.4d.npy' % (video_path, j)
+                        np.save(os.path.join(path, frame_path), features[j])
+                        f_list.write(frame_path + '\n')
+                        if f_csv is not None:
+                            f_csv.write(','.join(['%.6f' % x for x in features[j]]) + '\n')
+                    n_captions = rng.randint(captions[0], captions[1] + 1)
+                    caption_counts.append(n_captions)
+                    for _ in range(n_captions):
+                        f_descriptions.write(generate_caption(rng, word_probabilities) + '\n')
+                    video += 1
+                day += 1
+            if f_csv is not None:
+                f_csv.close()
+
+        with open(os.path.join(path, 'Annotations', feature_name, split + '_feat_counts.txt'), 'w') as f:
+            f.write(''.join([str(c) + '\n' for c in frame_counts]))
+        if write_csv:
+            with open(os.path.join(path, 'Features', split + '_' + feature_name + '_all_frames_counts.txt'), 'w') as f:
+                f.write(''.join([str(c) + '\n' for c in frame_counts]))
+        with open(os.path.join(path, 'Annotations', split + '_list_final.txt'), 'w') as f:
+            f.write(''.join([name + '\n' for name in names]))
+        with open(os.path.join(path, 'Annotations', split + '_link_samples.txt'), 'w') as f:
+            f.write(''.join([str(link) + '\n' for link in links]))
+        np.save(os.path.join(path, 'Annotations', split + '_descriptions_counts.npy'), np.asarray(caption_counts))
+
+        stats['events'][split] = len(names)
+        stats['captions'][split] = int(sum(caption_counts))
+        stats['frames'][split] = int(sum(frame_counts))
+
+    logger.info('Synthetic dataset written in %s: %s events, %s captions' % (path, stats['events'], stats['captions']))
+    return stats
+
+
+def parse_range(value):
+    values = [int(v) for v in value.split(',')]
+    return (values[0], values[-1])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Generates a synthetic EDUB-SegDesc-shaped dataset.')
+    parser.add_argument('--path', type=str, required=True, help='Output folder (DATA_ROOT_PATH)')
+    parser.add_argument('--events', type=int, default=1339, help='Number of events')
+    parser.add_argument('--days', type=int, default=55, help='Number of days')
+    parser.add_argument('--frames', type=parse_range, default=(5, 80), help='Min,max frames per event')
+    parser.add_argument('--captions', type=parse_range, default=(1, 5), help='Min,max captions per event')
+    parser.add_argument('--vocabulary', type=int, default=3000, help='Vocabulary size')
+    parser.add_argument('--feat-size', type=int, default=1024, help='Size of the features of each frame')
+    parser.add_argument('--no-csv', action='store_true', help='Do not write the raw features CSV files')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed')
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    generate_dataset(args.path, n_events=args.events, n_days=args.days, frames=args.frames, captions=args.captions,
+                     vocabulary_size=args.vocabulary, feat_size=args.feat_size, write_csv=not args.no_csv,
+                     seed=args.seed)
@@ -95,13 +95,20 @@ def load_parameters():
     # Evaluation params
     if not '-vidtext-embed' in DATASET_NAME:
         METRICS = ['coco']  # Metric used for evaluating model after each epoch (leave empty if only prediction is required)
+                            # 'coco_parallel': same scores as 'coco', with concurrent scorers (utils/coco_evaluation.py)
+                            # 'bleu_ids': only Bleu_1-4 and ROUGE_L, vectorized (utils/id_metrics.py). Fast STOP_METRIC
     else:
         METRICS = ['multiclass_metrics']
     EVAL_ON_SETS = ['val', 'test']                 # Possible values: 'train', 'val' and 'test' (external evaluator)
     EVAL_ON_SETS_KERAS = []                        # Possible values: 'train', 'val' and 'test' (Keras' evaluator)
+    REFERENCE_INDEX = False                        # 'coco_parallel': store the preprocessed references of EVAL_ON_SETS
+                                                   # in DATASET_STORE_PATH (utils/reference_index.py)
     START_EVAL_ON_EPOCH = 0                        # First epoch where the model will be evaluated
     EVAL_EACH_EPOCHS = False                       # Select whether evaluate between N epochs or N updates
     EVAL_EACH = 50                                 # Sets the evaluation frequency (epochs or updates)
+    ASYNC_EVALUATION = False                       # Evaluate in a background worker while training continues
+    ASYNC_EVALUATION_DEVICE = 'cpu'                # Theano device of the evaluation worker (None: same as training)
+    ASYNC_EVALUATION_MAX_PENDING = 2               # Training waits when this many evaluations are queued
 
     # Search parameters
     SAMPLING = 'max_likelihood'                   # Possible values: multinomial or max_likelihood (recommended)
@@ -113,9 +120,21 @@ def load_parameters():
     BEAM_SIZE = 10                                # Beam size (in case of BEAM_SEARCH == True)
     BEAM_SEARCH_COND_INPUT = 1                    # Index of the conditional input used in beam search (i.e., state_below)
     OPTIMIZED_SEARCH = True                       # Compute annotations only a single time per sample
+    BATCHED_SEARCH = False                        # Decode BATCH_SIZE samples at once, dropping the finished ones from
+                                                  # the batch at each step (requires OPTIMIZED_SEARCH)
+    SHORTLIST = False                             # Only score a per-sample shortlist of the vocabulary when decoding
+                                                  # (applied with the batched search, see utils/shortlist.py)
+    SHORTLIST_FREQUENT = 500                      # Most frequent training words included in every shortlist
+    SHORTLIST_NEIGHBOURS = 10                     # Nearest training videos whose caption words are included
     NORMALIZE_SAMPLING = False                    # Normalize hypotheses scores according to their length
     ALPHA_FACTOR = .6                             # Normalization according to length**ALPHA_FACTOR
                                                   # (see: arxiv.org/abs/1609.08144)
+    DECODE_CACHE = False                          # Store the beam search results on disk and reuse them when decoding
+                                                  # the same samples with the same weights and search parameters
+    DECODE_CACHE_PATH = 'decode_cache/'           # Decode cache location
+    DECODE_CACHE_MAX_SIZE = 512                   # Maximum size of the decode cache (in MB)
+    ONLINE_CONTEXT_MAX_ENTRIES = 100              # Max. number of (user, day) contexts kept by the online captioner
+                                                  # of temporally-linked models (see utils/online_captioning.py)
 
     # Sampling params: Show some samples during training
     if not '-vidtext-embed' in DATASET_NAME:
@@ -166,10 +185,29 @@ def load_parameters():
     BATCH_SIZE = 64                               # ABiViRNet trained with BATCH_SIZE = 64
 
     HOMOGENEOUS_BATCHES = False                         # Use batches with homogeneous output lengths for every minibatch (Possibly buggy!)
+    BUCKETED_BATCHES = False                            # Shuffle the training samples by (video length, caption length)
+                                                        # buckets, so each batch has samples of similar lengths
+    BUCKET_VIDEO_WIDTH = 4                              # Number of frames covered by each bucket
+    BUCKET_CAPTION_WIDTH = 2                            # Number of words covered by each bucket
     PARALLEL_LOADERS = 8                                # Parallel data batch loaders
+    SHARED_MEMORY_LOADER = False                        # Training loaders write the batches into shared memory
+                                                        # instead of pickling them (see data_engine/shared_memory_loader.py)
+    LOADER_PREFETCH = 8                                 # Number of batches prepared ahead of the trainer (shared memory)
     EPOCHS_FOR_SAVE = 1 if EVAL_EACH_EPOCHS else None   # Number of epochs between model saves (None for disabling epoch save)
     WRITE_VALID_SAMPLES = True                          # Write valid samples in file
     SAVE_EACH_EVALUATION = True if not EVAL_EACH_EPOCHS else False   # Save each time we evaluate the model
+    CHECKPOINT_MANAGER = False                          # Write the checkpoints in background, keeping only the best and
+                                                        # the last ones (see utils/checkpoints.py)
+    CHECKPOINT_TOP_K = 3                                # Number of best checkpoints (by STOP_METRIC on 'val') kept
+    CHECKPOINT_LAST_N = 2                               # Number of most recent checkpoints kept
+    TRAINING_METRICS = False                            # Record per-update data wait, step and callback times, throughput,
+                                                        # padding and memory in STORE_PATH (see utils/training_metrics.py)
+    TRAINING_METRICS_FORMAT = 'jsonl'                   # 'jsonl' or 'csv'
+    TRAINING_METRICS_LOG_EACH = 100                     # Number of updates between training metrics log lines
+    PROFILING = False                                   # Time the dataset building, model building and decoding stages
+                                                        # (STORE_PATH/profile_summary.txt, see utils/profiling.py)
+    PROFILING_MODE = None                               # None (only the stage timers), 'cprofile' or 'sampling'
+    PROFILING_SAMPLE_INTERVAL = 0.005                   # Seconds of CPU time between stack samples ('sampling' mode)
 
     # Early stop parameters
     EARLY_STOP = True                             # Turns on/off the early stop protocol
@@ -363,6 +401,12 @@ def load_parameters():
 
     STORE_PATH = 'trained_models/' + MODEL_NAME  + '/' # Models and evaluation results will be stored here
     DATASET_STORE_PATH = 'datasets/'                   # Dataset instance will be stored here
+    FUNCTION_CACHE = False                             # Store the compiled Theano functions and reload them on later
+                                                       # runs of the same model (see utils/function_cache.py)
+    FUNCTION_CACHE_PATH = 'function_cache/'            # Compiled function cache location
+    SHARED_DATASET = False                             # Publish the dataset once as read-only memory-mapped arrays,
+                                                       # shared by all the processes (see data_engine/shared_dataset.py)
+    SHARED_DATASET_PATH = '/dev/shm/'                  # Location of the shared dataset (a tmpfs is preferable)
 
     SAMPLING_SAVE_MODE = 'list'                        # 'list' or 'vqa'
     VERBOSE = 1                                        # Vqerbosity level
@@ -371,12 +415,31 @@ def load_parameters():
     REBUILD_DATASET = True                             # Build again or use stored instance
     MODE = 'training'                                  # 'training' or 'sampling' (if 'sampling' then RELOAD must
                                                        # be greater than 0 and EVAL_ON_SETS will be used)
+                                                       # 'build_dataset' only builds and stores the dataset
     RELOAD_PATH = None
     SAMPLING_RELOAD_EPOCH = False
     SAMPLING_RELOAD_POINT = 0
+    ENSEMBLE_MODELS = []                               # Checkpoints decoded in ensemble with the sampled model: reload
+                                                       # points of STORE_PATH or (model_path, reload_point) pairs
+                                                       # (requires OPTIMIZED_SEARCH, see utils/ensemble.py)
+    ENSEMBLE_WORKERS = False                           # Apply each checkpoint of ENSEMBLE_MODELS in its own process
+    EXPORT_QUANTIZATION = 'int8'                       # Weights of the inference-only export: 'float32', 'float16'
+                                                       # or 'int8' (see utils/inference_export.py)
+    EXPORT_PATH = None                                 # Export folder (None: STORE_PATH/inference_<quantization>)
+    AVERAGE_CHECKPOINTS = 5                            # Number of last checkpoints (or list of reload points) averaged
+                                                       # by utils/average_checkpoints.py
+    AVERAGE_CHECKPOINTS_PATH = None                    # Folder of the averaged checkpoint (None: STORE_PATH/average)
+    AVERAGE_CHECKPOINTS_EVALUATE = False               # Evaluate the averaged checkpoint on 'val'
     # Extra parameters for special trainings
     TRAIN_ON_TRAINVAL = False  # train the model on both training and validation sets combined
     FORCE_RELOAD_VOCABULARY = False  # force building a new vocabulary from the training samples applicable if RELOAD > 1
+    DISTILLATION = False  # train the model (student) on the captions decoded by a trained teacher instead of the
+                          # references (see utils/distillation.py). E.g. student: ENCODER_HIDDEN_SIZE = 0 (no LSTM
+                          # encoder), BIDIRECTIONAL_ENCODER = False and smaller DECODER_HIDDEN_SIZE
+    DISTILLATION_TEACHER_PATH = None  # STORE_PATH of the teacher (trained on the same dataset)
+    DISTILLATION_TEACHER_RELOAD = 0  # reload point of the teacher
+    DISTILLATION_TEACHER_RELOAD_EPOCH = False  # the teacher reload point is an epoch (otherwise, an update)
+    DISTILLATION_BEAM_SIZE = 5  # beam size of the teacher decoding of the training set
 
     # ============================================
     parameters = locals().copy()
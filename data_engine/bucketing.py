@@ -0,0 +1,195 @@
+"""
+Length-bucketed batches.
+
+Each batch pays for its longest caption (the text inputs/outputs are padded on batch), so mixing short and long
+captions in a batch wastes LSTM and attention time on padding. Here, the training samples are grouped in buckets of
+similar (video length, caption length) and the training split is reordered at the beginning of each epoch, so that
+the consecutive BATCH_SIZE-sized batches read by the data generators are taken from the same (or neighbouring)
+buckets. Samples are shuffled within each bucket and the batches are shuffled across buckets. Neighbouring buckets
+are sorted by caption length first, since the video features are always padded to MAX_VIDEO_LEN frames.
+
+The reordering is applied by the Dataset.shuffleTraining method, which is called by the data generators at the
+beginning of each epoch, so it is always in sync with the batches actually read.
+
+Only the training batches are bucketed. When predicting, the decoding starts from <null> (the caption inputs do not
+depend on the caption lengths) and the videos are padded to NUM_FRAMES, and the differences in output lengths are
+already handled by the batched search, which drops the finished samples from the batch (utils/batched_search.py).
+"""
+import logging
+import random
+
+from keras_wrapper.dataset import Dataset
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+
+
+def bucketed_batches(video_lengths, caption_lengths, batch_size, video_width=1, caption_width=1, shuffle=True):
+    """
+    Composes batches of samples of similar lengths.
+
+    :param video_lengths: number of frames of each sample
+    :param caption_lengths: number of tokens of each sample
+    :param batch_size: number of samples per batch
+    :param video_width: number of frames covered by each bucket
+    :param caption_width: number of tokens covered by each bucket
+    :param shuffle: shuffle the samples within each bucket and the batches across buckets
+    :return: list of batches (lists of sample indices). All of them have 'batch_size' samples but the last one.
+    """
+    buckets = dict()
+    for i, (v_len, c_len) in enumerate(zip(video_lengths, caption_lengths)):
+        buckets.setdefault((c_len // caption_width, v_len // video_width), []).append(i)
+
+    batches = []
+    leftovers = []
+    for key in sorted(buckets.keys()):
+        indices = buckets[key]
+        if shuffle:
+            random.shuffle(indices)
+        n_full = len(indices) // batch_size * batch_size
+        batches += [indices[i:i + batch_size] for i in range(0, n_full, batch_size)]
+        leftovers += indices[n_full:]
+    # The remaining samples of each bucket are joined in bucket order, so they are batched with neighbouring buckets
+    batches += [leftovers[i:i + batch_size] for i in range(0, len(leftovers), batch_size)]
+
+    # The only incomplete batch must be the last one, as the data generators read consecutive batch_size chunks
+    last = [batches.pop()] if len(batches) > 0 and len(batches[-1]) < batch_size else []
+    if shuffle:
+        random.shuffle(batches)
+    return batches + last
+
+
+def padding_waste(lengths, batches):
+    """
+    Fraction of padded positions when padding each batch to its longest sample.
+
+    :param lengths: length of each sample
+    :param batches: list of batches (lists of sample indices)
+    :return: padded positions / total positions
+    """
+    total = sum([max([lengths[i] for i in batch]) * len(batch) for batch in batches if len(batch) > 0])
+    if total == 0:
+        return 0.
+    return 1. - float(sum([lengths[i] for batch in batches for i in batch])) / total
+
+
+class BucketedDataset(Dataset):
+    """
+    Dataset whose training samples are shuffled by length buckets (see setBucketing).
+    """
+
+    def setBucketing(self, batch_size, caption_id, video_id=None, video_width=1, caption_width=1, link_index_id=None):
+        """
+        Enables the bucketed shuffling of the training split.
+
+        :param batch_size: training batch size
+        :param caption_id: identifier of the output (or input) text used for the caption lengths
+        :param video_id: identifier of the video input used for the video lengths (None for not considering them)
+        :param video_width: number of frames covered by each bucket
+        :param caption_width: number of tokens covered by each bucket
+        :param link_index_id: identifier of the 'link_index' input of temporally-linked datasets. Its values are
+                              remapped to the new positions of the linked samples.
+        """
+        self.bucketing = {'batch_size': batch_size,
+                          'caption_id': caption_id,
+                          'video_id': video_id,
+                          'video_width': video_width,
+                          'caption_width': caption_width,
+                          'link_index_id': link_index_id}
+
+    def trainingLengths(self):
+        """
+        Returns the video and caption lengths of the training samples, in their current order.
+        """
+        caption_id = self.bucketing['caption_id']
+        captions = self.Y_train[caption_id] if caption_id in self.Y_train else self.X_train[caption_id]
+        caption_lengths = [len(caption.split()) + 1 for caption in captions]  # +1 for the <eos> symbol
+        video_id = self.bucketing['video_id']
+        if video_id is None:
+            video_lengths = [0] * self.len_train
+        else:
+            counts = self.counts_frames[video_id]['train']
+            video_lengths = [min(counts[i], self.max_video_len[video_id]) for i in self.X_train[video_id]]
+        return video_lengths, caption_lengths
+
+    def shuffleTraining(self):
+        """
+        Applies a random shuffling to the training samples, composing batches of similar lengths.
+        """
+        if getattr(self, 'bucketing', None) is None:
+            return super(BucketedDataset, self).shuffleTraining()
+
+        video_lengths, caption_lengths = self.trainingLengths()
+        batches = bucketed_batches(video_lengths, caption_lengths, self.bucketing['batch_size'],
+                                   video_width=self.bucketing['video_width'],
+                                   caption_width=self.bucketing['caption_width'])
+        order = [i for batch in batches for i in batch]
+        self.reorderTraining(order)
+
+        # Padding waste w.r.t. randomly composed batches. Reported once per epoch, even if the data generators
+        # silence the dataset.
+        n = self.bucketing['batch_size']
+        random_order = random.sample(range(self.len_train), self.len_train)
+        random_batches = [random_order[i:i + n] for i in range(0, self.len_train, n)]
+        self.bucketing_stats = {'caption': padding_waste(caption_lengths, batches),
+                                'caption_random': padding_waste(caption_lengths, random_batches),
+                                'video': padding_waste(video_lengths, batches),
+                                'video_random': padding_waste(video_lengths, random_batches)}
+        logging.info('Bucketed %d training batches. Caption padding waste: %.2f%% (random batches: %.2f%%). '
+                     'Video padding waste: %.2f%% (random batches: %.2f%%)' %
+                     (len(batches),
+                      100 * self.bucketing_stats['caption'], 100 * self.bucketing_stats['caption_random'],
+                      100 * self.bucketing_stats['video'], 100 * self.bucketing_stats['video_random']))
+
+    def reorderTraining(self, order):
+        """
+        Reorders the training samples: the new i-th sample is the old order[i]-th one.
+        """
+        for sample_id in self.X_train.keys():
+            self.X_train[sample_id] = [self.X_train[sample_id][i] for i in order]
+        for sample_id in self.Y_train.keys():
+            self.Y_train[sample_id] = [self.Y_train[sample_id][i] for i in order]
+
+        link_index_id = self.bucketing.get('link_index_id')
+        if link_index_id is not None and link_index_id in self.X_train:
+            new_position = dict([(old, new) for new, old in enumerate(order)])
+            self.X_train[link_index_id] = [new_position[int(link)] if int(link) >= 0 else link
+                                           for link in self.X_train[link_index_id]]
+
+
+def bucketed_dataset(ds):
+    """
+    BucketedDataset with the attributes of 'ds' (e.g. a Dataset stored without BUCKETED_BATCHES).
+    """
+    if isinstance(ds, BucketedDataset):
+        return ds
+    bucketed = BucketedDataset.__new__(BucketedDataset)
+    bucketed.__dict__.update(ds.__dict__)
+    return bucketed
+
+
+def enable_bucketing(ds, params):
+    """
+    Enables the length-bucketed batches (BUCKETED_BATCHES) on a dataset built or loaded by build_dataset.
+
+    :param ds: Dataset instance
+    :param params: configuration parameters (see config.py)
+    :return: BucketedDataset instance
+    """
+    # Datasets stored without bucketing share all their attributes with BucketedDataset
+    ds = bucketed_dataset(ds)
+    video_id = params['INPUTS_IDS_DATASET'][0]
+    if video_id not in getattr(ds, 'counts_frames', dict()):
+        video_id = None
+    if '-vidtext-embed' in params['DATASET_NAME']:
+        caption_id = params['INPUTS_IDS_DATASET'][1]
+    else:
+        caption_id = params['OUTPUTS_IDS_DATASET'][0]
+    link_index_id = 'link_index' if 'link_index' in params['INPUTS_IDS_DATASET'] else None
+    ds.setBucketing(params['BATCH_SIZE'],
+                    caption_id,
+                    video_id=video_id,
+                    video_width=params.get('BUCKET_VIDEO_WIDTH', 1),
+                    caption_width=params.get('BUCKET_CAPTION_WIDTH', 1),
+                    link_index_id=link_index_id)
+    logging.info('Using length-bucketed batches of ' + str(params['BATCH_SIZE']) + ' samples.')
+    return ds
@@ -5,11 +5,27 @@ import numpy as np
 
 from keras_wrapper.dataset import Dataset, saveDataset, loadDataset
 from keras_wrapper.extra.read_write import pkl2dict
+from utils import profiling
 
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
 
 
 def build_dataset(params):
+    """
+    Builds (or loads) the dataset. With PROFILING, each stage is timed (see utils/profiling.py).
+    """
+    with profiling.scope('build_dataset'), profiling.profile_methods(Dataset, ['setInput', 'setOutput']):
+        return _build_dataset(params)
+
+
+def _build_dataset(params):
+    if params.get('SHARED_DATASET', False) and not params['REBUILD_DATASET']:
+        # Attach to the copy published by another process (see data_engine/shared_dataset.py)
+        from data_engine.shared_dataset import attach_dataset
+        ds = attach_dataset(params)
+        if ds is not None:
+            return ds
+
     if params['REBUILD_DATASET']:  # We build a new dataset instance
         if params['VERBOSE'] > 0:
             silence = False
@@ -19,7 +35,11 @@ def build_dataset(params):
 
         base_path = params['DATA_ROOT_PATH']
         name = params['DATASET_NAME']
-        ds = Dataset(name, base_path, silence=silence)
+        if params.get('BUCKETED_BATCHES', False):
+            from data_engine.bucketing import BucketedDataset
+            ds = BucketedDataset(name, base_path, silence=silence)
+        else:
+            ds = Dataset(name, base_path, silence=silence)
 
         if not '-vidtext-embed' in params['DATASET_NAME']:
             # OUTPUT DATA
@@ -246,10 +266,12 @@ def build_dataset(params):
                             repeat_set=rep)
 
         # We have finished loading the dataset, now we can store it for using it in the future
-        saveDataset(ds, params['DATASET_STORE_PATH'])
+        with profiling.scope('saveDataset'):
+            saveDataset(ds, params['DATASET_STORE_PATH'])
     else:
         # We can easily recover it with a single line
-        ds = loadDataset(params['DATASET_STORE_PATH'] + '/Dataset_' + params['DATASET_NAME'] + '.pkl')
+        with profiling.scope('loadDataset'):
+            ds = loadDataset(params['DATASET_STORE_PATH'] + '/Dataset_' + params['DATASET_NAME'] + '.pkl')
 
     # Load vocabulary-related parameters of dataset used for pre-training
     if params['PRE_TRAINED_DATASET_NAME'] is not None:
@@ -267,9 +289,14 @@ def build_dataset(params):
             ds.vocabulary[id_new] = copy.deepcopy(dataset_pretrained_vocabulary[id_old])
             ds.vocabulary_len[id_new] = len(dataset_pretrained_vocabulary[id_old]['idx2words'])
 
+    if params.get('SHARED_DATASET', False):
+        from data_engine.shared_dataset import publish_dataset
+        ds = publish_dataset(ds, params)
+
     return ds
 
 
+@profiling.profiled()
 def keep_n_captions(ds, repeat, n=1, set_names=['val', 'test']):
     ''' Keeps only n captions per image and stores the rest in dictionaries for a later evaluation
     '''
@@ -326,6 +353,7 @@ def keep_n_captions(ds, repeat, n=1, set_names=['val', 'test']):
         logging.info('Samples reduced to ' + str(new_len) + ' in ' + s + ' set.')
 
 
+@profiling.profiled()
 def insertTemporallyLinkedCaptions(ds, params, set_names=['train'],
                                    upperbound=False,
                                    video=False, copy=False, force_nocopy=False, prev=False):
@@ -552,6 +580,7 @@ def insertTemporallyLinkedCaptions(ds, params, set_names=['train'],
     return ds, repeat_images
 
 
+@profiling.profiled()
 def insertTemporallyLinkedCaptionsVidText(ds, params, vidtext_set_names={'video': ['train'], 'text': ['train']}):
     """
         Inserts two additional input consisting of the videos and captions from the previous segment/event
@@ -749,6 +778,7 @@ def insertTemporallyLinkedCaptionsVidText(ds, params, vidtext_set_names={'video'
     return ds, repeat_images
 
 
+@profiling.profiled()
 def insertVidTextEmbedNegativeSamples(ds, params, repeat):
     """
     Inserts negative balanced examples for training a Video-Text Embedding model.
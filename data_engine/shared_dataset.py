@@ -0,0 +1,364 @@
+"""
+Dataset instances shared (read-only) by all the processes of a host.
+
+Every process calling build_dataset loads its own copy of the Dataset pickle, and most of its memory is taken by
+Python lists and dictionaries of small objects: the captions and text ids of each split, the frame paths and counts of
+the videos, the references of the evaluation splits and the vocabularies. With SHARED_DATASET, the first process
+publishes them once as NumPy arrays in SHARED_DATASET_PATH/Dataset_<DATASET_NAME>/ (by default in /dev/shm), and the
+other processes attach to them with read-only memory maps, so that all of them use the same physical memory:
+    * lists of strings or numbers -> SharedSequence (concatenated values and offsets)
+    * dictionaries (references of each split, vocabularies) -> SharedMapping (sorted keys and values)
+The remaining (small) attributes of the Dataset are stored in dataset.pkl and loaded by each process.
+
+The training split is shuffled by permuting an index array (SharedDataset.reorderTraining), so the shared arrays are
+never copied. The published dataset is rebuilt when the Dataset pickle in DATASET_STORE_PATH changes.
+"""
+import bisect
+import cPickle as pk
+import logging
+import os
+import random
+import shutil
+from collections import Mapping
+
+import numpy as np
+
+from data_engine.bucketing import BucketedDataset
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+SPLITS = ['train', 'val', 'test']
+
+
+def _kind(values):
+    """
+    Common type of a list of values ('str', 'unicode', 'int' or 'float'), or None.
+    """
+    for kind, types in [('str', str), ('unicode', unicode), ('int', (int, long, np.integer)),
+                        ('float', (float, np.floating))]:
+        if all([isinstance(v, types) and not isinstance(v, bool) for v in values]):
+            return kind
+    return None
+
+
+def _load_array(path):
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:  # Empty arrays cannot be memory-mapped
+        return np.load(path)
+
+
+class SharedSequence(object):
+    """
+    Read-only list of strings or numbers stored in (memory-mapped) .npy files, optionally seen through a permutation.
+    """
+
+    def __init__(self, path, kind, order=None, attach=True):
+        self.path = path
+        self.kind = kind
+        self.order = order
+        if attach:
+            self._attach()
+
+    @staticmethod
+    def write(values, path, kind):
+        """
+        Stores a list of values of the given kind in path.npy (and path_offsets.npy for strings).
+        """
+        if kind in ['str', 'unicode']:
+            encoded = [v.encode('utf-8') for v in values] if kind == 'unicode' else values
+            offsets = np.zeros((len(encoded) + 1,), dtype='int64')
+            offsets[1:] = np.cumsum([len(v) for v in encoded])
+            np.save(path + '_offsets.npy', offsets)
+            np.save(path + '.npy', np.frombuffer(''.join(encoded), dtype='uint8'))
+        else:
+            np.save(path + '.npy', np.asarray(values, dtype='int64' if kind == 'int' else 'float64'))
+
+    def _attach(self):
+        self.values = _load_array(self.path + '.npy')
+        self.offsets = _load_array(self.path + '_offsets.npy') if self.kind in ['str', 'unicode'] else None
+
+    def __getstate__(self):
+        return {'path': self.path, 'kind': self.kind, 'order': self.order}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def __len__(self):
+        if self.order is not None:
+            return len(self.order)
+        return len(self.offsets) - 1 if self.offsets is not None else len(self.values)
+
+    def _value(self, i):
+        if self.offsets is not None:
+            value = self.values[self.offsets[i]:self.offsets[i + 1]].tostring()
+            return value.decode('utf-8') if self.kind == 'unicode' else value
+        return int(self.values[i]) if self.kind == 'int' else float(self.values[i])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if self.offsets is None:
+                # Numeric values (e.g. sum(counts_frames[:idx]) for every video of a batch): converted at once
+                return (self.values[self.order[i]] if self.order is not None else self.values[i]).tolist()
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('SharedSequence index out of range')
+        return self._value(self.order[i] if self.order is not None else i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def permuted(self, order):
+        """
+        View of the sequence whose i-th element is the order[i]-th one of this sequence.
+        """
+        order = np.asarray(order, dtype='int64')
+        new = SharedSequence(self.path, self.kind, order=self.order[order] if self.order is not None else order,
+                             attach=False)
+        new.values = self.values
+        new.offsets = self.offsets
+        return new
+
+
+class SharedLists(object):
+    """
+    Read-only list of lists of strings or numbers (e.g. the references of each sample).
+    """
+
+    def __init__(self, items, starts):
+        """
+        :param items: SharedSequence of all the elements of the lists
+        :param starts: SharedSequence of the position of the first element of each list (plus the total length)
+        """
+        self.items = items
+        self.starts = starts
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        return self.items[self.starts[i]:self.starts[i + 1]]
+
+
+class SharedMapping(Mapping):
+    """
+    Read-only dictionary with sorted keys of a single type. Keys 0..n-1 are looked up directly, other keys by
+    bisection (the results are memoized by each process).
+    """
+
+    def __init__(self, keys, values, dense=False):
+        """
+        :param keys: SharedSequence of the sorted keys
+        :param values: SharedSequence or SharedLists of the values, in the order of the keys
+        :param dense: the keys are 0..n-1
+        """
+        self.keys_ = keys
+        self.values_ = values
+        self.dense = dense
+        self.memo = dict()
+
+    def __getstate__(self):
+        return {'keys_': self.keys_, 'values_': self.values_, 'dense': self.dense}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memo = dict()
+
+    def _position(self, key):
+        if self.dense:
+            if isinstance(key, (int, long, np.integer)) and 0 <= key < len(self.keys_):
+                return int(key)
+            return None
+        position = self.memo.get(key)
+        if position is None:
+            position = bisect.bisect_left(self.keys_, key)
+            if position == len(self.keys_) or self.keys_[position] != key:
+                return None
+            self.memo[key] = position
+        return position
+
+    def __getitem__(self, key):
+        position = self._position(key)
+        if position is None:
+            raise KeyError(key)
+        return self.values_[position]
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+
+class _Publisher(object):
+    """
+    Writes the shared arrays of a dataset in a folder, returning the (not yet attached) objects that replace the
+    original lists and dictionaries.
+    """
+
+    def __init__(self, write_path, final_path):
+        self.write_path = write_path
+        self.final_path = final_path
+        self.n_arrays = 0
+        self.n_shared = 0
+
+    def _sequence(self, values, kind):
+        name = '%05d' % self.n_arrays
+        self.n_arrays += 1
+        SharedSequence.write(values, os.path.join(self.write_path, name), kind)
+        return SharedSequence(os.path.join(self.final_path, name), kind, attach=False)
+
+    def _lists(self, lists, kind):
+        starts = np.zeros((len(lists) + 1,), dtype='int64')
+        starts[1:] = np.cumsum([len(l) for l in lists])
+        return SharedLists(self._sequence([v for l in lists for v in l], kind), self._sequence(starts.tolist(), 'int'))
+
+    def share(self, obj):
+        """
+        Shared version of a list of scalars or of a dictionary of scalars or lists of scalars (obj if not possible).
+        """
+        if isinstance(obj, list):
+            kind = _kind(obj)
+            if kind is None:
+                return obj
+            self.n_shared += 1
+            return self._sequence(obj, kind)
+        if isinstance(obj, dict):
+            keys = sorted(obj)
+            key_kind = _kind(keys)
+            if key_kind is None:
+                return obj
+            values = [obj[k] for k in keys]
+            value_kind = _kind(values)
+            if value_kind is not None:
+                shared_values = self._sequence(values, value_kind)
+            elif all([isinstance(v, list) for v in values]):
+                value_kind = _kind([x for v in values for x in v])
+                if value_kind is None:
+                    return obj
+                shared_values = self._lists(values, value_kind)
+            else:
+                return obj
+            self.n_shared += 1
+            return SharedMapping(self._sequence(keys, key_kind), shared_values,
+                                 dense=key_kind == 'int' and keys == range(len(keys)))
+        return obj
+
+
+class SharedDataset(BucketedDataset):
+    """
+    Dataset whose large attributes are shared read-only arrays (see publish_dataset). The training split is reordered
+    through permutations of the shared sequences.
+    """
+
+    def shuffleTraining(self):
+        """
+        Applies a random shuffling to the training samples (bucketed if setBucketing was called).
+        """
+        if getattr(self, 'bucketing', None) is not None:
+            return super(SharedDataset, self).shuffleTraining()
+        if not self.silence:
+            logging.info('Shuffling training samples.')
+        self.reorderTraining(random.sample(range(self.len_train), self.len_train))
+
+    def reorderTraining(self, order):
+        """
+        Reorders the training samples: the new i-th sample is the old order[i]-th one.
+        """
+        for samples in [self.X_train, self.Y_train]:
+            for sample_id in samples.keys():
+                if isinstance(samples[sample_id], SharedSequence):
+                    samples[sample_id] = samples[sample_id].permuted(order)
+                else:
+                    samples[sample_id] = [samples[sample_id][i] for i in order]
+
+        link_index_id = (getattr(self, 'bucketing', None) or dict()).get('link_index_id')
+        if link_index_id is not None and link_index_id in self.X_train:
+            new_position = dict([(old, new) for new, old in enumerate(order)])
+            self.X_train[link_index_id] = [new_position[int(link)] if int(link) >= 0 else link
+                                           for link in self.X_train[link_index_id]]
+
+
+def shared_dataset_path(params):
+    return os.path.join(params.get('SHARED_DATASET_PATH', '/dev/shm/'), 'Dataset_' + params['DATASET_NAME'])
+
+
+def _source_mtime(params):
+    source = params['DATASET_STORE_PATH'] + '/Dataset_' + params['DATASET_NAME'] + '.pkl'
+    return os.path.getmtime(source) if os.path.isfile(source) else None
+
+
+def attach_dataset(params):
+    """
+    Attaches to the published dataset. Returns None if it has not been published or if it is outdated.
+    """
+    path = shared_dataset_path(params)
+    skeleton_path = os.path.join(path, 'dataset.pkl')
+    if not os.path.isfile(skeleton_path):
+        return None
+    with open(skeleton_path, 'rb') as f:
+        ds = pk.load(f)
+    if getattr(ds, 'shared_source_mtime', None) != _source_mtime(params):
+        logger.info('The published dataset ' + path + ' is outdated')
+        return None
+    logger.info('Attached to the shared dataset ' + path)
+    return ds
+
+
+def publish_dataset(ds, params):
+    """
+    Publishes the dataset in SHARED_DATASET_PATH and returns the attached (shared) dataset. The lists and dictionaries
+    of ds are replaced by the shared ones.
+    """
+    final_path = shared_dataset_path(params)
+    write_path = final_path + '.tmp' + str(os.getpid())
+    if os.path.isdir(write_path):
+        shutil.rmtree(write_path)
+    os.makedirs(write_path)
+
+    publisher = _Publisher(write_path, final_path)
+    for s in SPLITS:
+        for attribute in ['X_' + s, 'Y_' + s]:
+            samples = getattr(ds, attribute, None) or dict()
+            for sample_id in samples.keys():
+                samples[sample_id] = publisher.share(samples[sample_id])
+        for attribute in ['paths_frames', 'counts_frames']:
+            for data_id, splits in (getattr(ds, attribute, None) or dict()).iteritems():
+                if s in splits:
+                    splits[s] = publisher.share(splits[s])
+        extra = (getattr(ds, 'extra_variables', None) or dict()).get(s)
+        if isinstance(extra, dict):
+            for data_id in extra.keys():
+                extra[data_id] = publisher.share(extra[data_id])
+    for vocabulary in (getattr(ds, 'vocabulary', None) or dict()).values():
+        for key in ['words2idx', 'idx2words']:
+            if key in vocabulary:
+                vocabulary[key] = publisher.share(vocabulary[key])
+
+    if not isinstance(ds, SharedDataset):
+        # Datasets stored without sharing have all the attributes of SharedDataset
+        ds.__class__ = SharedDataset
+    ds.shared_source_mtime = _source_mtime(params)
+    with open(os.path.join(write_path, 'dataset.pkl'), 'wb') as f:
+        pk.dump(ds, f, protocol=pk.HIGHEST_PROTOCOL)
+
+    if os.path.isdir(final_path):
+        # Processes attached to the previous version keep their (unlinked) files mapped
+        shutil.rmtree(final_path, ignore_errors=True)
+    try:
+        os.rename(write_path, final_path)
+        logger.info('Published %d shared arrays of the dataset in %s' % (publisher.n_shared, final_path))
+    except OSError:
+        # Published at the same time by another process
+        shutil.rmtree(write_path, ignore_errors=True)
+    with open(os.path.join(final_path, 'dataset.pkl'), 'rb') as f:
+        return pk.load(f)
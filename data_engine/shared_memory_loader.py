@@ -0,0 +1,310 @@
+"""
+Multi-process training data loader with shared-memory batches.
+
+The parallel loaders of keras_wrapper send each batch back to the trainer pickled through a queue, which for
+(BATCH_SIZE x NUM_FRAMES x IMG_FEAT_SIZE) float32 video tensors costs as much as loading the batch. Here, the worker
+processes write the batches (the output of net.prepareData) into a ring of preallocated shared-memory slots and only
+send their layout (dtypes, shapes and offsets) through the queue. The trainer builds NumPy views on the slots, so the
+arrays are never copied nor pickled.
+
+Batch g is always written to slot g % n_slots. A slot is handed back to the workers once the trainer has asked for
+'consumer_lag' more batches: Keras keeps at most max_q_size batches in its queue plus the one being trained on, so a
+lag of max_q_size + 2 guarantees that a batch is no longer used when its slot is overwritten. The ring has
+prefetch_depth + consumer_lag slots.
+
+As in Data_Batch_Generator, the training split is shuffled (Dataset.shuffleTraining, so bucketing is preserved) at the
+beginning of each epoch. The workers of each epoch are forked after the shuffling, so they read the samples in the
+new order. The workers of the next epoch are started as soon as the current epoch begins, so prefetching does not stop
+at epoch boundaries.
+
+Enabled with SHARED_MEMORY_LOADER (see VideoDesc_Model.trainNet). PARALLEL_LOADERS sets the number of workers and
+LOADER_PREFETCH the prefetch depth (in batches).
+"""
+import logging
+import multiprocessing
+import traceback
+from contextlib import contextmanager
+from Queue import Empty
+from timeit import default_timer as timer
+
+import numpy as np
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+ALIGNMENT = 64
+
+
+def flatten_batch(data):
+    """
+    Splits a (nested) batch into its arrays and a template for rebuilding it.
+    """
+    if isinstance(data, np.ndarray):
+        return ('array', 0), [data]
+    if isinstance(data, dict):
+        keys = sorted(data.keys())
+        templates, arrays = [], []
+        for key in keys:
+            template, key_arrays = flatten_batch(data[key])
+            templates.append(_shift(template, len(arrays)))
+            arrays += key_arrays
+        return ('dict', zip(keys, templates)), arrays
+    if isinstance(data, (list, tuple)):
+        templates, arrays = [], []
+        for item in data:
+            template, item_arrays = flatten_batch(item)
+            templates.append(_shift(template, len(arrays)))
+            arrays += item_arrays
+        return ('tuple' if isinstance(data, tuple) else 'list', templates), arrays
+    return ('value', data), []
+
+
+def _shift(template, offset):
+    kind, content = template
+    if kind == 'array':
+        return kind, content + offset
+    if kind == 'dict':
+        return kind, [(key, _shift(t, offset)) for key, t in content]
+    if kind in ['list', 'tuple']:
+        return kind, [_shift(t, offset) for t in content]
+    return template
+
+
+def unflatten_batch(template, arrays):
+    """
+    Inverse of flatten_batch.
+    """
+    kind, content = template
+    if kind == 'array':
+        return arrays[content]
+    if kind == 'dict':
+        return dict([(key, unflatten_batch(t, arrays)) for key, t in content])
+    if kind == 'list':
+        return [unflatten_batch(t, arrays) for t in content]
+    if kind == 'tuple':
+        return tuple([unflatten_batch(t, arrays) for t in content])
+    return content
+
+
+def _layout(arrays):
+    """
+    Offsets of the arrays in a slot, and the total size needed.
+    """
+    layout = []
+    offset = 0
+    for a in arrays:
+        layout.append((a.dtype.str, a.shape, offset))
+        offset += (a.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    return layout, offset
+
+
+class SharedMemoryBatchGenerator(object):
+    """
+    Same interface as Data_Batch_Generator (for the training split) with shared-memory worker processes.
+    """
+
+    def __init__(self, set_split, net, dataset, num_iterations, batch_size=50, normalization=False,
+                 normalization_type=None, data_augmentation=True, wo_da_patch_type='whole',
+                 da_patch_type='resize_and_rndcrop', da_enhance_list=None, mean_substraction=False, shuffle=True,
+                 n_workers=4, prefetch_depth=8, consumer_lag=3, slot_size=None, **kwargs):
+        """
+        :param n_workers: number of worker processes
+        :param prefetch_depth: number of batches that can be prepared ahead of the trainer
+        :param consumer_lag: number of batches requested after a batch until its slot can be reused
+        :param slot_size: size (in bytes) of each slot (None: twice the size of the first batch). Larger batches are
+                          sent pickled.
+        (The other parameters are those of Data_Batch_Generator.)
+        """
+        self.set_split = set_split
+        self.net = net
+        self.dataset = dataset
+        self.params = {'batch_size': batch_size,
+                       'data_augmentation': data_augmentation,
+                       'wo_da_patch_type': wo_da_patch_type,
+                       'da_patch_type': da_patch_type,
+                       'da_enhance_list': da_enhance_list if da_enhance_list is not None else [],
+                       'mean_substraction': mean_substraction,
+                       'normalization': normalization,
+                       'normalization_type': normalization_type,
+                       'num_iterations': num_iterations,
+                       'shuffle': shuffle}
+        self.n_workers = max(n_workers, 1)
+        self.consumer_lag = max(consumer_lag, 1)
+        self.n_slots = max(prefetch_depth, 1) + self.consumer_lag
+        self.slot_size = slot_size
+        self.stats = {'batches': 0, 'wait_time': 0., 'consumer_time': 0., 'pickled_batches': 0}
+
+    def loadBatch(self, indices):
+        """
+        Loads and prepares the batch with the given sample indices (as Data_Batch_Generator).
+        """
+        X_batch, Y_batch = self.dataset.getXY_FromIndices(self.set_split, indices,
+                                                          normalization=self.params['normalization'],
+                                                          normalization_type=self.params['normalization_type'],
+                                                          meanSubstraction=self.params['mean_substraction'],
+                                                          dataAugmentation=self.params['data_augmentation'],
+                                                          wo_da_patch_type=self.params['wo_da_patch_type'],
+                                                          da_patch_type=self.params['da_patch_type'],
+                                                          da_enhance_list=self.params['da_enhance_list'])
+        return self.net.prepareData(X_batch, Y_batch)
+
+    def batchIndices(self, it):
+        """
+        Sample indices of the it-th batch of an epoch.
+        """
+        n_samples = getattr(self.dataset, 'len_' + self.set_split)
+        return range(it * self.params['batch_size'], min((it + 1) * self.params['batch_size'], n_samples))
+
+    def _worker(self, worker_id, first_batch):
+        """
+        Loads the batches worker_id, worker_id + n_workers, ... of the epoch starting at global batch 'first_batch'.
+        """
+        try:
+            for it in range(worker_id, self.params['num_iterations'], self.n_workers):
+                g = first_batch + it
+                template, arrays = flatten_batch(self.loadBatch(self.batchIndices(it)))
+                layout, size = _layout(arrays)
+                slot = g % self.n_slots
+                with self.turn_condition:
+                    while self.slot_turns[slot] != g:
+                        self.turn_condition.wait()
+                if size > self.slot_size:
+                    self.results.put((g, slot, 'pickled', (template, arrays)))
+                    continue
+                buf = self.slots[slot]
+                for a, (dtype, shape, offset) in zip(arrays, layout):
+                    view = np.frombuffer(buf, dtype=np.dtype(dtype), count=a.size, offset=offset)
+                    view[:] = a.ravel()
+                self.results.put((g, slot, 'shared', (template, layout)))
+        except Exception:
+            self.results.put((-1, -1, 'error', traceback.format_exc()))
+
+    def _start_epoch(self, epoch):
+        if self.params['shuffle']:
+            silence = self.dataset.silence
+            self.dataset.silence = True
+            self.dataset.shuffleTraining()
+            self.dataset.silence = silence
+        workers = [multiprocessing.Process(target=self._worker,
+                                           args=(worker_id, epoch * self.params['num_iterations']))
+                   for worker_id in range(self.n_workers)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        return workers
+
+    def _get(self, g, pending, workers):
+        while g not in pending:
+            try:
+                message = self.results.get(timeout=1.)
+            except Empty:
+                if not any([w.is_alive() for epoch_workers in workers.values() for w in epoch_workers]) and \
+                        self.results.empty():
+                    raise Exception('The data loader workers finished without producing batch ' + str(g))
+                continue
+            if message[2] == 'error':
+                raise Exception('Error in a data loader worker:\n' + message[3])
+            pending[message[0]] = message
+        _, slot, kind, content = pending.pop(g)
+        if kind == 'pickled':
+            self.stats['pickled_batches'] += 1
+            template, arrays = content
+            return unflatten_batch(template, arrays), slot
+        template, layout = content
+        arrays = [np.frombuffer(self.slots[slot], dtype=np.dtype(dtype), count=int(np.prod(shape)),
+                                offset=offset).reshape(shape) for dtype, shape, offset in layout]
+        return unflatten_batch(template, arrays), slot
+
+    def _release(self, g):
+        with self.turn_condition:
+            self.slot_turns[g % self.n_slots] = g + self.n_slots
+            self.turn_condition.notify_all()
+
+    def report(self):
+        total = self.stats['wait_time'] + self.stats['consumer_time']
+        logger.info('Data loader: %d batches, waiting for data %.1fs (%.1f%%), consumer %.1fs, %d batches pickled '
+                    '(larger than the %.1f MB slots)' %
+                    (self.stats['batches'], self.stats['wait_time'], 100. * self.stats['wait_time'] / max(total, 1e-8),
+                     self.stats['consumer_time'], self.stats['pickled_batches'], self.slot_size / 1024. ** 2))
+
+    def generator(self):
+        """
+        Gets and processes the data
+        :return: generator with the data
+        """
+        if self.slot_size is None:
+            _, size = _layout(flatten_batch(self.loadBatch(self.batchIndices(0)))[1])
+            self.slot_size = 2 * size
+        self.slots = [multiprocessing.RawArray('b', self.slot_size) for _ in range(self.n_slots)]
+        self.slot_turns = multiprocessing.RawArray('l', range(self.n_slots))
+        self.turn_condition = multiprocessing.Condition()
+        self.results = multiprocessing.Queue()
+        logger.info('Shared-memory data loader: %d workers, %d slots of %.1f MB' %
+                    (self.n_workers, self.n_slots, self.slot_size / 1024. ** 2))
+
+        workers = {0: self._start_epoch(0)}
+        pending = dict()
+        g = 0
+        last_yield = None
+        try:
+            while True:
+                epoch, it = divmod(g, self.params['num_iterations'])
+                if it == 0:
+                    # Prefetch across the epoch boundary
+                    for old_epoch in [e for e in workers.keys() if e < epoch]:
+                        for w in workers.pop(old_epoch):
+                            w.join()
+                    if epoch > 0:
+                        self.report()
+                    workers[epoch + 1] = self._start_epoch(epoch + 1)
+
+                start_time = timer()
+                if last_yield is not None:
+                    self.stats['consumer_time'] += start_time - last_yield
+                if g >= self.consumer_lag:
+                    self._release(g - self.consumer_lag)
+                data, _ = self._get(g, pending, workers)
+                self.stats['wait_time'] += timer() - start_time
+                self.stats['batches'] += 1
+                g += 1
+                last_yield = timer()
+                yield data
+        finally:
+            for epoch_workers in workers.values():
+                for w in epoch_workers:
+                    if w.is_alive():
+                        w.terminate()
+
+
+@contextmanager
+def shared_memory_generators(n_workers, prefetch_depth, max_q_size):
+    """
+    Makes the Model_Wrapper training loop (keras_wrapper.cnn_model) use SharedMemoryBatchGenerator for the training
+    split. The other generators are unchanged.
+
+    :param n_workers: number of worker processes
+    :param prefetch_depth: number of batches prepared ahead of the trainer
+    :param max_q_size: size of the Keras generator queue
+    """
+    import keras_wrapper.cnn_model as cnn_model
+
+    original_generators = {'Data_Batch_Generator': cnn_model.Data_Batch_Generator,
+                           'Parallel_Data_Batch_Generator': cnn_model.Parallel_Data_Batch_Generator}
+
+    def generator_class(name):
+        def build(set_split, net, dataset, num_iterations, **kwargs):
+            if set_split != 'train' or kwargs.get('predict', False) or kwargs.get('random_samples', -1) > 0:
+                return original_generators[name](set_split, net, dataset, num_iterations, **kwargs)
+            kwargs.pop('n_parallel_loaders', None)
+            return SharedMemoryBatchGenerator(set_split, net, dataset, num_iterations, n_workers=n_workers,
+                                              prefetch_depth=prefetch_depth, consumer_lag=max_q_size + 2, **kwargs)
+
+        return build
+
+    for name in original_generators:
+        setattr(cnn_model, name, generator_class(name))
+    try:
+        yield
+    finally:
+        for name, original in original_generators.iteritems():
+            setattr(cnn_model, name, original)
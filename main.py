@@ -3,39 +3,65 @@ import logging
 import sys
 from timeit import default_timer as timer
 
-from config import load_parameters
-from data_engine.prepare_data import build_dataset
-from keras_wrapper.cnn_model import loadModel, transferWeights, updateModel
-from keras_wrapper.extra.callbacks import EvalPerformance, Sample
-from keras_wrapper.extra.evaluation import selectMetric
-from keras_wrapper.extra.read_write import dict2pkl, list2file
-from keras_wrapper.utils import decode_predictions_beam_search, decode_predictions
-from viddesc_model import VideoDesc_Model
+# The data, model and evaluation subsystems are imported in the functions that need them, so that each mode only
+# pays for its own imports (see --profile-startup)
 
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
 logger = logging.getLogger(__name__)
 
 
-def train_model(params):
+def train_model(params, dataset=None, callback_builders=None):
     """
     Training function. Sets the training parameters from params. Build or loads the model and launches the training.
     :param params: Dictionary of network hyperparameters.
+    :param dataset: already built Dataset instance (e.g. shared by the hyperparameter search trials). Built if None.
+    :param callback_builders: list of functions model -> callback, building extra training callbacks.
     :return: None
     """
+    from data_engine.bucketing import enable_bucketing
+    from data_engine.prepare_data import build_dataset
 
     if params['RELOAD'] > 0:
         logging.info('Resuming training.')
 
     check_params(params)
 
+    training_metrics = None
+    if params.get('TRAINING_METRICS', False):
+        from utils.training_metrics import TrainingMetrics
+        training_metrics = TrainingMetrics(params)
+
     ########### Load data
-    dataset = build_dataset(params)
+    if dataset is None:
+        dataset = build_dataset(params)
+        if params.get('DISTILLATION', False):
+            # Train on the captions of the teacher (decoded in a worker process)
+            from utils.distillation import distill_dataset
+            distill_dataset(dataset, params)
+        if params.get('BUCKETED_BATCHES', False):
+            dataset = enable_bucketing(dataset, params)
     if not '-vidtext-embed' in params['DATASET_NAME']:
         params['OUTPUT_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['OUTPUTS_IDS_DATASET'][0]]
     else:
         params['OUTPUT_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['INPUTS_IDS_DATASET'][1]]
+    if training_metrics is not None:
+        training_metrics.phase('dataset')
     ###########
 
+    # The evaluation worker is forked before the backend is imported, so that it can use its own device
+    async_evaluator = None
+    if params['METRICS'] and params.get('ASYNC_EVALUATION', False):
+        from utils.async_evaluation import AsyncEvaluator
+        async_evaluator = AsyncEvaluator(params, dataset,
+                                         lambda eval_model: buildEvalPerformance(params, eval_model, dataset))
+        async_evaluator.start()
+
+    from keras_wrapper.cnn_model import loadModel, transferWeights, updateModel
+    from keras_wrapper.extra.read_write import dict2pkl
+    from utils import profiling
+    from viddesc_model import VideoDesc_Model
+
+    loadModel = profiling.profiled('loadModel')(loadModel)
 
     ########### Build model
 
@@ -117,6 +143,11 @@ def train_model(params):
     # Update optimizer either if we are loading or building a model
     video_model.params = params
     video_model.setOptimizer()
+    setFunctionCache(params, video_model)
+    setDecodeCache(params, video_model)
+    setShortlist(params, video_model, dataset)
+    if training_metrics is not None:
+        training_metrics.phase('model')
     ###########
 
 
@@ -127,7 +158,12 @@ def train_model(params):
 
 
     ########### Callbacks
-    callbacks = buildCallbacks(params, video_model, dataset)
+    callbacks = buildCallbacks(params, video_model, dataset, async_evaluator=async_evaluator)
+    for build_callback in callback_builders or []:
+        callbacks.append(build_callback(video_model))
+    if training_metrics is not None:
+        training_metrics.phase('callbacks')
+        callbacks.insert(0, training_metrics.callback(callbacks, dataset))
     ###########
 
 
@@ -138,15 +174,20 @@ def train_model(params):
     training_params = {'n_epochs': params['MAX_EPOCH'], 'batch_size': params['BATCH_SIZE'],
                        'homogeneous_batches': params['HOMOGENEOUS_BATCHES'], 'maxlen': params['MAX_OUTPUT_TEXT_LEN'],
                        'lr_decay': params['LR_DECAY'], 'lr_gamma': params['LR_GAMMA'],
-                       'epochs_for_save': params['EPOCHS_FOR_SAVE'], 'verbose': params['VERBOSE'],
+                       # with CHECKPOINT_MANAGER, the models are saved by the CheckpointCallback
+                       'epochs_for_save': None if params.get('CHECKPOINT_MANAGER', False) else params['EPOCHS_FOR_SAVE'],
+                       'verbose': params['VERBOSE'],
                        'eval_on_sets': params['EVAL_ON_SETS_KERAS'], 'n_parallel_loaders': params['PARALLEL_LOADERS'],
                        'extra_callbacks': callbacks, 'reload_epoch': params['RELOAD'], 'epoch_offset': params['RELOAD'],
                        'data_augmentation': params['DATA_AUGMENTATION'],
                        'patience': params.get('PATIENCE', 0),  # early stopping parameters
-                       'metric_check': params.get('STOP_METRIC', None),
+                       # with ASYNC_EVALUATION, early stopping is applied by the AsyncEvalPerformance callback
+                       'metric_check': params.get('STOP_METRIC', None) if async_evaluator is None else None,
                        'eval_on_epochs': params.get('EVAL_EACH_EPOCHS', True),
                        'each_n_epochs': params.get('EVAL_EACH', 1),
-                       'start_eval_on_epoch': params.get('START_EVAL_ON_EPOCH', 0)
+                       'start_eval_on_epoch': params.get('START_EVAL_ON_EPOCH', 0),
+                       'shared_memory_loader': params.get('SHARED_MEMORY_LOADER', False),
+                       'loader_prefetch': params.get('LOADER_PREFETCH', 8)
                        }
 
     video_model.trainNet(dataset, training_params)
@@ -154,12 +195,25 @@ def train_model(params):
     total_end_time = timer()
     time_difference = total_end_time - total_start_time
     logging.info('In total is {0:.2f}s = {1:.2f}m'.format(time_difference, time_difference / 60.0))
+    if training_metrics is not None:
+        training_metrics.phase('training')
+        training_metrics.close()
 
 
 def apply_Video_model(params):
     """
         Function for using a previously trained model for sampling.
     """
+    from data_engine.prepare_data import build_dataset
+    from keras_wrapper.cnn_model import loadModel
+    from keras_wrapper.extra.evaluation import selectMetric
+    from keras_wrapper.extra.read_write import list2file
+    from keras_wrapper.utils import decode_predictions_beam_search, decode_predictions
+    from utils import profiling
+    from utils.coco_evaluation import register_metrics
+
+    register_metrics()
+    loadModel = profiling.profiled('loadModel')(loadModel)
 
     ########### Load data
     dataset = build_dataset(params)
@@ -171,9 +225,17 @@ def apply_Video_model(params):
 
 
     ########### Load model
+    # The ensemble workers are forked before any model is loaded
+    ensemble = buildEnsemble(params)
     video_model = loadModel(params['STORE_PATH'], params['SAMPLING_RELOAD_POINT'],
                             reload_epoch=params['SAMPLING_RELOAD_EPOCH'])
     video_model.setOptimizer()
+    setFunctionCache(params, video_model)
+    setDecodeCache(params, video_model)
+    setShortlist(params, video_model, dataset)
+    if ensemble is not None:
+        ensemble.add_model(video_model)
+        video_model.setEnsemble(ensemble)
     ###########
 
 
@@ -181,6 +243,7 @@ def apply_Video_model(params):
     extra_vars = dict()
     extra_vars['tokenize_f'] = eval('dataset.' + params['TOKENIZATION_METHOD'])
     extra_vars['language'] = params.get('TRG_LAN', 'en')
+    reference_indices = loadReferenceIndices(params, dataset)
 
     for s in params["EVAL_ON_SETS"]:
 
@@ -200,6 +263,7 @@ def apply_Video_model(params):
             params_prediction['maxlen'] = params['MAX_OUTPUT_TEXT_LEN_TEST']
             params_prediction['optimized_search'] = params['OPTIMIZED_SEARCH'] and '-upperbound' not in params[
                 'DATASET_NAME']
+            params_prediction['batched_search'] = params.get('BATCHED_SEARCH', False)
             params_prediction['model_inputs'] = params['INPUTS_IDS_MODEL']
             params_prediction['model_outputs'] = params['OUTPUTS_IDS_MODEL']
             params_prediction['dataset_inputs'] = params['INPUTS_IDS_DATASET']
@@ -232,6 +296,8 @@ def apply_Video_model(params):
             # Evaluate on the chosen metric
             extra_vars[s] = dict()
             extra_vars[s]['references'] = dataset.extra_variables[s][params['OUTPUTS_IDS_DATASET'][0]]
+            if s in reference_indices:
+                extra_vars[s]['reference_index'] = reference_indices[s]
             metrics = selectMetric[metric](
                 pred_list=predictions,
                 verbose=1,
@@ -250,96 +316,80 @@ def apply_Video_model(params):
                 f.write(line + '\n')
             logging.info('Done evaluating on metric ' + metric)
 
+    if ensemble is not None:
+        ensemble.close()
+
+
+def build_dataset_only(params, n_batches=20):
+    """
+    Data-only mode: builds and stores the Dataset instance (and the shortlist and reference indices if SHORTLIST and
+    REFERENCE_INDEX) without importing the model stack, and reports size and loading throughput statistics.
+    :param params: Dictionary of network hyperparameters.
+    :param n_batches: number of training batches loaded for measuring the throughput.
+    :return: None
+    """
+    import os
+    from data_engine.prepare_data import build_dataset
 
-def buildCallbacks(params, model, dataset):
+    params['REBUILD_DATASET'] = True
+    start_time = timer()
+    dataset = build_dataset(params)
+    build_time = timer() - start_time
+    dataset_path = params['DATASET_STORE_PATH'] + '/Dataset_' + params['DATASET_NAME'] + '.pkl'
+
+    if params.get('SHORTLIST', False):
+        from utils.shortlist import load_shortlist_index
+        index_path = params['DATASET_STORE_PATH'] + '/Shortlist_' + params['DATASET_NAME'] + '.pkl'
+        if os.path.isfile(index_path):
+            os.remove(index_path)  # Built from the previous dataset instance
+        load_shortlist_index(dataset, params)
+    if params.get('REFERENCE_INDEX', False) and not '-vidtext-embed' in params['DATASET_NAME']:
+        from utils.reference_index import load_reference_index
+        for s in params['EVAL_ON_SETS']:
+            load_reference_index(dataset, params, s)
+
+    # Loading throughput of the training inputs
+    n_samples = min(n_batches * params['BATCH_SIZE'], dataset.len_train)
+    n_bytes = 0
+    start_time = timer()
+    for i in range(0, n_samples, params['BATCH_SIZE']):
+        X = dataset.getX_FromIndices('train', range(i, min(i + params['BATCH_SIZE'], n_samples)),
+                                     dataAugmentation=False)
+        n_bytes += sum([getattr(x, 'nbytes', 0) for x in X])
+    load_time = max(timer() - start_time, 1e-8)
+
+    print '\nDataset ' + params['DATASET_NAME'] + ' stored in ' + dataset_path
+    print '\tsize: %.2f MB' % (os.path.getsize(dataset_path) / 1024. ** 2)
+    print '\tbuilding time: %.2f s' % build_time
+    for s in ['train', 'val', 'test']:
+        print '\t%s samples: %d' % (s, eval('dataset.len_' + s))
+    for vocabulary_id in sorted(dataset.vocabulary_len):
+        print '\tvocabulary %s: %d words' % (vocabulary_id, dataset.vocabulary_len[vocabulary_id])
+    print '\ttraining inputs loading: %.1f samples/s, %.1f MB/s (%d samples)' % \
+          (n_samples / load_time, n_bytes / 1024. ** 2 / load_time, n_samples)
+
+
+def buildCallbacks(params, model, dataset, async_evaluator=None):
     """
     Builds the selected set of callbacks run during the training of the model.
 
     :param params: Dictionary of network hyperparameters.
     :param model: Model instance on which to apply the callback.
     :param dataset: Dataset instance on which to apply the callback.
+    :param async_evaluator: AsyncEvaluator running the evaluations (if ASYNC_EVALUATION).
     :return:
     """
+    from keras_wrapper.extra.callbacks import Sample
 
     callbacks = []
 
     if params['METRICS']:
         # Evaluate training
-        extra_vars = {'language': params.get('TRG_LAN', 'en'),
-                      'n_parallel_loaders': params['PARALLEL_LOADERS'],
-                      'tokenize_f': eval('dataset.' + params['TOKENIZATION_METHOD'])}
-
-        if not '-vidtext-embed' in params['DATASET_NAME']:
-            vocab = dataset.vocabulary[params['OUTPUTS_IDS_DATASET'][0]]['idx2words']
-            for s in params['EVAL_ON_SETS']:
-                extra_vars[s] = dict()
-                extra_vars[s]['references'] = dataset.extra_variables[s][params['OUTPUTS_IDS_DATASET'][0]]
+        if async_evaluator is not None:
+            from utils.async_evaluation import build_async_callback
+            callback_metric = build_async_callback(params, model, async_evaluator)
         else:
-            vocab = None
-            extra_vars['n_classes'] = len(dataset.dic_classes[params['OUTPUTS_IDS_DATASET'][0]].values())
-            for s in params['EVAL_ON_SETS']:
-                extra_vars[s] = dict()
-                extra_vars[s]['references'] = eval('dataset.Y_' + s + '["' + params['OUTPUTS_IDS_DATASET'][0] + '"]')
-
-        if params['BEAM_SEARCH']:
-            extra_vars['beam_size'] = params.get('BEAM_SIZE', 6)
-            extra_vars['state_below_index'] = params.get('BEAM_SEARCH_COND_INPUT', -1)
-            extra_vars['maxlen'] = params.get('MAX_OUTPUT_TEXT_LEN_TEST', 30)
-            extra_vars['optimized_search'] = params.get('OPTIMIZED_SEARCH', True) and '-upperbound' not in params[
-                'DATASET_NAME']
-            extra_vars['model_inputs'] = params['INPUTS_IDS_MODEL']
-            extra_vars['model_outputs'] = params['OUTPUTS_IDS_MODEL']
-            extra_vars['dataset_inputs'] = params['INPUTS_IDS_DATASET']
-            extra_vars['dataset_outputs'] = params['OUTPUTS_IDS_DATASET']
-            extra_vars['normalize_probs'] = params.get('NORMALIZE_SAMPLING', False)
-            extra_vars['alpha_factor'] = params.get('ALPHA_FACTOR', 1.)
-            extra_vars['temporally_linked'] = '-linked' in params['DATASET_NAME'] and '-upperbound' not in params[
-                'DATASET_NAME'] and '-video' not in params['DATASET_NAME']
-            input_text_id = None
-            vocab_src = None
-
-            callback_metric = EvalPerformance(model,
-                                              dataset,
-                                              gt_id=params['OUTPUTS_IDS_DATASET'][0],
-                                              metric_name=params['METRICS'],
-                                              set_name=params['EVAL_ON_SETS'],
-                                              batch_size=params['BATCH_SIZE'],
-                                              each_n_epochs=params['EVAL_EACH'],
-                                              extra_vars=extra_vars,
-                                              reload_epoch=params['RELOAD'],
-                                              is_text=True,
-                                              input_text_id=input_text_id,
-                                              index2word_y=vocab,
-                                              index2word_x=vocab_src,
-                                              sampling_type=params['SAMPLING'],
-                                              beam_search=params['BEAM_SEARCH'],
-                                              save_path=model.model_path,
-                                              start_eval_on_epoch=params['START_EVAL_ON_EPOCH'],
-                                              write_samples=True,
-                                              write_type=params['SAMPLING_SAVE_MODE'],
-                                              eval_on_epochs=params['EVAL_EACH_EPOCHS'],
-                                              save_each_evaluation=params['SAVE_EACH_EVALUATION'],
-                                              verbose=params['VERBOSE'])
-        else:
-            callback_metric = EvalPerformance(model,
-                                              dataset,
-                                              gt_id=params['OUTPUTS_IDS_DATASET'][0],
-                                              metric_name=params['METRICS'],
-                                              set_name=params['EVAL_ON_SETS'],
-                                              batch_size=params['BATCH_SIZE'],
-                                              each_n_epochs=params['EVAL_EACH'],
-                                              extra_vars=extra_vars,
-                                              reload_epoch=params['RELOAD'],
-                                              save_path=model.model_path,
-                                              start_eval_on_epoch=params[
-                                                  'START_EVAL_ON_EPOCH'],
-                                              write_samples=True,
-                                              write_type=params['SAMPLING_SAVE_MODE'],
-                                              eval_on_epochs=params['EVAL_EACH_EPOCHS'],
-                                              save_each_evaluation=params[
-                                                  'SAVE_EACH_EVALUATION'],
-                                              verbose=params['VERBOSE'])
-
+            callback_metric = buildEvalPerformance(params, model, dataset)
         callbacks.append(callback_metric)
 
     if params['SAMPLE_ON_SETS']:
@@ -381,19 +431,215 @@ def buildCallbacks(params, model, dataset):
                                    verbose=params['VERBOSE'])
         callbacks.append(callback_sampling)
 
+    if params.get('CHECKPOINT_MANAGER', False):
+        # Replaces the synchronous saves of the evaluation and of trainNet
+        from utils.checkpoints import build_checkpoint_callback
+        callbacks.append(build_checkpoint_callback(params, model))
+
     return callbacks
 
 
+def buildEvalPerformance(params, model, dataset):
+    """
+    Builds the EvalPerformance callback evaluating the model on EVAL_ON_SETS.
+
+    :param params: Dictionary of network hyperparameters.
+    :param model: Model instance to evaluate.
+    :param dataset: Dataset instance on which to evaluate.
+    :return: EvalPerformance callback
+    """
+    from keras_wrapper.extra.callbacks import EvalPerformance
+    from utils.coco_evaluation import register_metrics
+
+    register_metrics()
+    # With CHECKPOINT_MANAGER, the evaluated models are saved by the CheckpointCallback
+    save_each_evaluation = params['SAVE_EACH_EVALUATION'] and not params.get('CHECKPOINT_MANAGER', False)
+    extra_vars = {'language': params.get('TRG_LAN', 'en'),
+                  'n_parallel_loaders': params['PARALLEL_LOADERS'],
+                  'tokenize_f': eval('dataset.' + params['TOKENIZATION_METHOD'])}
+
+    if not '-vidtext-embed' in params['DATASET_NAME']:
+        vocab = dataset.vocabulary[params['OUTPUTS_IDS_DATASET'][0]]['idx2words']
+        reference_indices = loadReferenceIndices(params, dataset)
+        for s in params['EVAL_ON_SETS']:
+            extra_vars[s] = dict()
+            extra_vars[s]['references'] = dataset.extra_variables[s][params['OUTPUTS_IDS_DATASET'][0]]
+            if s in reference_indices:
+                extra_vars[s]['reference_index'] = reference_indices[s]
+    else:
+        vocab = None
+        extra_vars['n_classes'] = len(dataset.dic_classes[params['OUTPUTS_IDS_DATASET'][0]].values())
+        for s in params['EVAL_ON_SETS']:
+            extra_vars[s] = dict()
+            extra_vars[s]['references'] = eval('dataset.Y_' + s + '["' + params['OUTPUTS_IDS_DATASET'][0] + '"]')
+
+    if params['BEAM_SEARCH']:
+        extra_vars['beam_size'] = params.get('BEAM_SIZE', 6)
+        extra_vars['state_below_index'] = params.get('BEAM_SEARCH_COND_INPUT', -1)
+        extra_vars['maxlen'] = params.get('MAX_OUTPUT_TEXT_LEN_TEST', 30)
+        extra_vars['optimized_search'] = params.get('OPTIMIZED_SEARCH', True) and '-upperbound' not in params[
+            'DATASET_NAME']
+        extra_vars['model_inputs'] = params['INPUTS_IDS_MODEL']
+        extra_vars['model_outputs'] = params['OUTPUTS_IDS_MODEL']
+        extra_vars['dataset_inputs'] = params['INPUTS_IDS_DATASET']
+        extra_vars['dataset_outputs'] = params['OUTPUTS_IDS_DATASET']
+        extra_vars['normalize_probs'] = params.get('NORMALIZE_SAMPLING', False)
+        extra_vars['alpha_factor'] = params.get('ALPHA_FACTOR', 1.)
+        extra_vars['temporally_linked'] = '-linked' in params['DATASET_NAME'] and '-upperbound' not in params[
+            'DATASET_NAME'] and '-video' not in params['DATASET_NAME']
+        input_text_id = None
+        vocab_src = None
+
+        callback_metric = EvalPerformance(model,
+                                          dataset,
+                                          gt_id=params['OUTPUTS_IDS_DATASET'][0],
+                                          metric_name=params['METRICS'],
+                                          set_name=params['EVAL_ON_SETS'],
+                                          batch_size=params['BATCH_SIZE'],
+                                          each_n_epochs=params['EVAL_EACH'],
+                                          extra_vars=extra_vars,
+                                          reload_epoch=params['RELOAD'],
+                                          is_text=True,
+                                          input_text_id=input_text_id,
+                                          index2word_y=vocab,
+                                          index2word_x=vocab_src,
+                                          sampling_type=params['SAMPLING'],
+                                          beam_search=params['BEAM_SEARCH'],
+                                          save_path=model.model_path,
+                                          start_eval_on_epoch=params['START_EVAL_ON_EPOCH'],
+                                          write_samples=True,
+                                          write_type=params['SAMPLING_SAVE_MODE'],
+                                          eval_on_epochs=params['EVAL_EACH_EPOCHS'],
+                                          save_each_evaluation=save_each_evaluation,
+                                          verbose=params['VERBOSE'])
+    else:
+        callback_metric = EvalPerformance(model,
+                                          dataset,
+                                          gt_id=params['OUTPUTS_IDS_DATASET'][0],
+                                          metric_name=params['METRICS'],
+                                          set_name=params['EVAL_ON_SETS'],
+                                          batch_size=params['BATCH_SIZE'],
+                                          each_n_epochs=params['EVAL_EACH'],
+                                          extra_vars=extra_vars,
+                                          reload_epoch=params['RELOAD'],
+                                          save_path=model.model_path,
+                                          start_eval_on_epoch=params[
+                                              'START_EVAL_ON_EPOCH'],
+                                          write_samples=True,
+                                          write_type=params['SAMPLING_SAVE_MODE'],
+                                          eval_on_epochs=params['EVAL_EACH_EPOCHS'],
+                                          save_each_evaluation=save_each_evaluation,
+                                          verbose=params['VERBOSE'])
+
+    return callback_metric
+
+
+def loadReferenceIndices(params, dataset):
+    """
+    Loads (or builds) the reference indices of EVAL_ON_SETS used by the 'coco_parallel' metric, if REFERENCE_INDEX.
+    :param params: Dictionary of network hyperparameters.
+    :param dataset: Dataset instance.
+    :return: dictionary of reference indices (split, index)
+    """
+    if not params.get('REFERENCE_INDEX', False) or 'coco_parallel' not in params['METRICS'] or \
+            '-vidtext-embed' in params['DATASET_NAME']:
+        return dict()
+    from utils.reference_index import load_reference_index
+    return dict([(s, load_reference_index(dataset, params, s)) for s in params['EVAL_ON_SETS']])
+
+
+def setFunctionCache(params, model):
+    """
+    Sets (or disables) the on-disk cache of compiled functions of the model according to params.
+
+    :param params: Dictionary of network hyperparameters.
+    :param model: Model instance on which to set the cache.
+    :return: None
+    """
+    if params.get('FUNCTION_CACHE', False):
+        from utils.function_cache import FunctionCache
+        model.setFunctionCache(FunctionCache(params['FUNCTION_CACHE_PATH'], params, verbose=params['VERBOSE']))
+    else:
+        model.setFunctionCache(None)
+
+
+def setDecodeCache(params, model):
+    """
+    Sets (or disables) the on-disk cache of beam search results of the model according to params.
+
+    :param params: Dictionary of network hyperparameters.
+    :param model: Model instance on which to set the cache.
+    :return: None
+    """
+    if params.get('DECODE_CACHE', False):
+        from utils.decode_cache import DecodeCache
+        model.setDecodeCache(DecodeCache(params['DECODE_CACHE_PATH'] + '/' + params['MODEL_NAME'],
+                                         max_size=params.get('DECODE_CACHE_MAX_SIZE', 512),
+                                         verbose=params['VERBOSE']))
+    else:
+        model.setDecodeCache(None)
+
+
+def setShortlist(params, model, dataset):
+    """
+    Sets (or disables) the vocabulary shortlist used when decoding, according to params['SHORTLIST'].
+    :param params: Dictionary of network hyperparameters.
+    :param model: Model instance on which to set the shortlist.
+    :param dataset: Dataset instance used for building the shortlist index.
+    :return: None
+    """
+    if params.get('SHORTLIST', False):
+        from utils.shortlist import Shortlist, load_shortlist_index, shortlist_index_path
+        model.setShortlist(Shortlist(load_shortlist_index(dataset, params),
+                                     n_frequent=params.get('SHORTLIST_FREQUENT', 500),
+                                     n_neighbours=params.get('SHORTLIST_NEIGHBOURS', 10),
+                                     special_words=sorted(dataset.extra_words.values()),
+                                     index_path=shortlist_index_path(params)))
+    else:
+        model.setShortlist(None)
+
+
+def buildEnsemble(params):
+    """
+    Builds the Ensemble of the ENSEMBLE_MODELS checkpoints (see utils/ensemble.py), without the sampled model, which is
+    added once loaded.
+    :param params: Dictionary of network hyperparameters.
+    :return: Ensemble instance or None if ENSEMBLE_MODELS is empty
+    """
+    if not params.get('ENSEMBLE_MODELS', []):
+        return None
+    from utils.ensemble import Ensemble, ensemble_members
+    if params.get('SHORTLIST', False):
+        logger.warning('The vocabulary shortlist is not applied when decoding with an ensemble.')
+    return Ensemble(ensemble_members(params),
+                    max_batch_size=params['BATCH_SIZE'],
+                    workers=params.get('ENSEMBLE_WORKERS', False),
+                    reload_epoch=params['SAMPLING_RELOAD_EPOCH'])
+
+
 def check_params(params):
     if 'Glove' in params['MODEL_TYPE'] and params['GLOVE_VECTORS'] is None:
         logger.warning("You set a model that uses pretrained word vectors but you didn't specify a vector file."
                        "We'll train WITHOUT pretrained embeddings!")
     if params["USE_DROPOUT"] and params["USE_BATCH_NORMALIZATION"]:
         logger.warning("It's not recommended to use both dropout and batch normalization")
+    if params.get('BUCKETED_BATCHES', False) and params['HOMOGENEOUS_BATCHES']:
+        logger.warning("BUCKETED_BATCHES only applies to the default data generators. Set HOMOGENEOUS_BATCHES = False "
+                       "for using the length-bucketed batches.")
 
 
 if __name__ == "__main__":
 
+    # --profile-startup: print the import times of the selected mode
+    import_profiler = None
+    if '--profile-startup' in sys.argv:
+        sys.argv.remove('--profile-startup')
+        from utils.import_profiler import ImportProfiler
+        import_profiler = ImportProfiler()
+        import_profiler.install()
+
+    from config import load_parameters
+
     parameters = load_parameters()
     try:
         for arg in sys.argv[1:]:
@@ -403,11 +649,24 @@ if __name__ == "__main__":
         print 'Overwritten arguments must have the form key=Value'
         exit(1)
     check_params(parameters)
-    if parameters['MODE'] == 'training' or parameters['MODE'] == 'finetuning':
-        logging.info('Running training.')
-        train_model(parameters)
-    elif parameters['MODE'] == 'sampling':
-        logging.info('Running sampling.')
-        apply_Video_model(parameters)
 
+    # PROFILING: time the dataset, model and decoding stages (see utils/profiling.py)
+    from utils import profiling
+    profiling.start(parameters)
+    try:
+        if parameters['MODE'] == 'training' or parameters['MODE'] == 'finetuning':
+            logging.info('Running training.')
+            train_model(parameters)
+        elif parameters['MODE'] == 'sampling':
+            logging.info('Running sampling.')
+            apply_Video_model(parameters)
+        elif parameters['MODE'] == 'build_dataset':
+            logging.info('Building the dataset.')
+            build_dataset_only(parameters)
+    finally:
+        profiling.stop()
+
+    if import_profiler is not None:
+        import_profiler.uninstall()
+        import_profiler.report()
     logging.info('Done!')
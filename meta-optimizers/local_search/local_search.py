@@ -0,0 +1,302 @@
+"""
+Local parallel hyperparameter search with asynchronous successive halving.
+
+Runs the trials of a random search over the variables of a Spearmint-like configuration file (see
+../spearmint/config.json) concurrently, each in its own worker process:
+    * The dataset is built once by the driver, before any backend is imported, and the trial processes are forked from
+      it, so that they all share the same (read-only) Dataset instance instead of rebuilding it.
+    * Each trial runs train_model with an extra callback that reports every new value of STOP_METRIC on the 'val' split
+      (read from the in-memory log of the model) to the driver.
+    * The driver stops the unpromising trials, successive-halving style: when a trial reaches 'min-evals' * eta^k
+      evaluations, it only goes on if its best score so far is in the top 1/eta of the scores recorded by all the
+      trials at that point.
+The results of all the trials are stored in <search-path>/results.json.
+
+Usage (from the root of the repository):
+    python meta-optimizers/local_search/local_search.py [--config config.json] [--trials 27] [--workers 4]
+        [--eta 3] [--min-evals 1] [--devices cpu,cuda0] [key=Value ...]
+"""
+import argparse
+import ast
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import traceback
+from Queue import Empty
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../')))
+
+from config import load_parameters
+from main import check_params
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description='Parallel hyperparameter search with successive halving.')
+parser.add_argument('--config', type=str,
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '../spearmint/config.json'),
+                    help='Search space (Spearmint configuration file)')
+parser.add_argument('--trials', type=int, default=27, help='Number of sampled configurations')
+parser.add_argument('--workers', type=int, default=max(multiprocessing.cpu_count() // 4, 1),
+                    help='Number of trials run concurrently')
+parser.add_argument('--eta', type=int, default=3, help='Successive halving reduction factor')
+parser.add_argument('--min-evals', type=int, default=1,
+                    help='Number of evaluations before a trial can be stopped')
+parser.add_argument('--devices', type=str, default=None,
+                    help='Comma-separated Theano devices assigned to the workers (e.g. cuda0,cuda1)')
+parser.add_argument('--seed', type=int, default=1234, help='Random seed of the search')
+parser.add_argument('--search-path', type=str, default='trained_models/local_search/',
+                    help='Folder of the trained models and results')
+parser.add_argument('changes', nargs='*', help='Changes to the config (key=Value)', default=[])
+
+
+class TrialStopped(Exception):
+    pass
+
+
+def sample_configuration(variables, rng):
+    """
+    Samples a value for each variable (INT, FLOAT or ENUM, as in Spearmint).
+    """
+    configuration = dict()
+    for name in sorted(variables):
+        spec = variables[name]
+        values = []
+        for _ in range(spec.get('size', 1)):
+            if spec['type'] == 'INT':
+                values.append(rng.randint(spec['min'], spec['max']))
+            elif spec['type'] == 'FLOAT':
+                values.append(rng.uniform(spec['min'], spec['max']))
+            elif spec['type'] == 'ENUM':
+                values.append(rng.choice(spec['options']))
+            else:
+                raise Exception('Unknown variable type ' + str(spec['type']))
+        configuration[name] = values[0] if len(values) == 1 else values
+    return configuration
+
+
+class SuccessiveHalving(object):
+    """
+    Asynchronous successive halving stopping rule.
+    """
+
+    def __init__(self, eta=3, min_evaluations=1, maximize=True):
+        self.eta = eta
+        self.min_evaluations = min_evaluations
+        self.maximize = maximize
+        self.rungs = dict()  # number of evaluations -> best scores of the trials that reached it
+
+    def is_rung(self, n_evaluations):
+        rung = self.min_evaluations
+        while rung < n_evaluations:
+            rung *= self.eta
+        return rung == n_evaluations
+
+    def keep(self, n_evaluations, score):
+        """
+        Whether a trial with the given best score after n_evaluations evaluations goes on.
+        """
+        if not self.is_rung(n_evaluations):
+            return True
+        scores = self.rungs.setdefault(n_evaluations, [])
+        scores.append(score)
+        if len(scores) < self.eta:
+            return True
+        cutoff = sorted(scores, reverse=self.maximize)[len(scores) // self.eta - 1]
+        return score >= cutoff if self.maximize else score <= cutoff
+
+
+def build_report_callback(trial_id, model_wrapper, metric, reports, decisions):
+    """
+    Callback sending every new value of the metric on the 'val' split to the driver, and stopping the training if the
+    driver says so.
+    """
+    from keras.callbacks import Callback as KerasCallback
+
+    class ReportCallback(KerasCallback):
+
+        def __init__(self):
+            super(ReportCallback, self).__init__()
+            self.n_reported = 0
+
+        def on_batch_end(self, batch, logs=None):
+            self.report()
+
+        def on_epoch_end(self, epoch, logs=None):
+            self.report()
+
+        def report(self):
+            values = [v for v in model_wrapper.getLog('val', metric) if v is not None]
+            while self.n_reported < len(values):
+                self.n_reported += 1
+                reports.put(('report', trial_id, (self.n_reported, values[self.n_reported - 1])))
+                if not decisions.get():
+                    self.model.stop_training = True
+                    raise TrialStopped()
+
+    return ReportCallback()
+
+
+def run_trial(trial_id, params, dataset, reports, decisions, n_threads, device):
+    """
+    Trial process: trains the model on the shared dataset, reporting to the driver.
+    """
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    if device is not None:
+        os.environ['THEANO_FLAGS'] = ','.join([f for f in os.environ.get('THEANO_FLAGS', '').split(',')
+                                               if f and not f.startswith('device=')] + ['device=' + device])
+    try:
+        from main import train_model
+        train_model(params, dataset=dataset,
+                    callback_builders=[lambda model: build_report_callback(trial_id, model, params['STOP_METRIC'],
+                                                                           reports, decisions)])
+        reports.put(('completed', trial_id, None))
+    except TrialStopped:
+        reports.put(('stopped', trial_id, None))
+    except SystemExit:  # Early stopping (PATIENCE)
+        reports.put(('completed', trial_id, None))
+    except Exception:
+        reports.put(('failed', trial_id, traceback.format_exc()))
+    reports.close()
+    reports.join_thread()
+    # Do not wait for the data loading processes of the training
+    os._exit(0)
+
+
+def trial_parameters(base_params, configuration, trial_id, search_path):
+    params = dict(base_params)
+    params.update(configuration)
+    params['SKIP_VECTORS_HIDDEN_SIZE'] = params['TARGET_TEXT_EMBEDDING_SIZE']
+    params['MODEL_NAME'] = params['MODEL_TYPE'] + '_trial_' + str(trial_id) + ''.join(
+        ['_' + name + '_' + str(configuration[name]) for name in sorted(configuration)])
+    params['STORE_PATH'] = os.path.join(search_path, 'trial_' + str(trial_id)) + '/'
+    params['RELOAD'] = 0
+    return params
+
+
+def store_results(trials, search_path):
+    with open(os.path.join(search_path, 'results.json'), 'w') as f:
+        json.dump([dict([(k, v) for k, v in trial.iteritems() if k != 'params']) for trial in trials], f, indent=1)
+
+
+def search(params, variables, n_trials, n_workers, eta, min_evaluations, devices, seed, search_path):
+    """
+    Runs the search. Returns the list of trials (configuration, scores, best score, status, time).
+    """
+    from data_engine.bucketing import enable_bucketing
+    from data_engine.prepare_data import build_dataset
+
+    assert params['MODE'] == 'training', 'You can only launch the search when training!'
+    assert 'val' in params['EVAL_ON_SETS'], 'The trials are compared on the val split: add it to EVAL_ON_SETS'
+    metric = params['STOP_METRIC']
+    maximize = 'TER' not in metric
+
+    ########### Shared dataset
+    dataset = build_dataset(params)
+    if params.get('BUCKETED_BATCHES', False):
+        dataset = enable_bucketing(dataset, params)
+
+    rng = random.Random(seed)
+    if not os.path.isdir(search_path):
+        os.makedirs(search_path)
+    trials = []
+    for trial_id in range(n_trials):
+        configuration = sample_configuration(variables, rng)
+        trials.append({'id': trial_id, 'configuration': configuration, 'scores': [], 'best': None,
+                       'status': 'pending', 'time': None,
+                       'params': trial_parameters(params, configuration, trial_id, search_path)})
+
+    halving = SuccessiveHalving(eta=eta, min_evaluations=min_evaluations, maximize=maximize)
+    reports = multiprocessing.Queue()
+    n_threads = max(multiprocessing.cpu_count() // n_workers, 1)
+    pending = list(trials)
+    running = dict()  # id -> (process, decisions queue, worker slot, start time)
+    free_slots = range(n_workers)
+    start_time = timer()
+    while pending or running:
+        while pending and free_slots:
+            trial = pending.pop(0)
+            slot = free_slots.pop(0)
+            decisions = multiprocessing.Queue()
+            device = devices[slot % len(devices)] if devices else None
+            process = multiprocessing.Process(target=run_trial,
+                                              args=(trial['id'], trial['params'], dataset, reports, decisions,
+                                                    n_threads, device))
+            process.start()
+            running[trial['id']] = (process, decisions, slot, timer())
+            trial['status'] = 'running'
+            logger.info('Trial %d started (%s)' % (trial['id'], str(trial['configuration'])))
+
+        try:
+            kind, trial_id, content = reports.get(timeout=30)
+        except Empty:
+            for trial_id, (process, _, slot, trial_start) in running.items():
+                # A process may exit right after its last message: read the queue before declaring it dead
+                if not process.is_alive() and reports.empty():
+                    trials[trial_id]['status'] = 'failed'
+                    trials[trial_id]['time'] = timer() - trial_start
+                    del running[trial_id]
+                    free_slots.append(slot)
+                    logger.info('Trial %d died' % trial_id)
+            continue
+
+        trial = trials[trial_id]
+        if trial_id not in running:
+            # Late message of a trial already declared dead
+            if kind != 'report':
+                trial['status'] = kind
+                store_results(trials, search_path)
+            logger.info('Trial %d: ignoring a late %s message' % (trial_id, kind))
+            continue
+        process, decisions, slot, trial_start = running[trial_id]
+        if kind == 'report':
+            n_evaluations, score = content
+            trial['scores'].append(score)
+            best = max(trial['scores']) if maximize else min(trial['scores'])
+            trial['best'] = best
+            keep = halving.keep(n_evaluations, best)
+            decisions.put(keep)
+            logger.info('Trial %d: %s %f after %d evaluations (best %f)%s' %
+                        (trial_id, metric, score, n_evaluations, best, '' if keep else '. Stopping it.'))
+        else:
+            process.join()
+            trial['status'] = kind
+            trial['time'] = timer() - trial_start
+            del running[trial_id]
+            free_slots.append(slot)
+            logger.info('Trial %d %s in %.1f s' % (trial_id, kind, trial['time']))
+            if kind == 'failed':
+                logger.error(content)
+        store_results(trials, search_path)
+
+    logger.info('Search finished in %.1f s' % (timer() - start_time))
+    return trials
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    parameters = load_parameters()
+    try:
+        for arg in args.changes:
+            k, v = arg.split('=')
+            parameters[k] = ast.literal_eval(v)
+    except ValueError:
+        print 'Overwritten arguments must have the form key=Value'
+        exit(1)
+    check_params(parameters)
+    with open(args.config) as f:
+        search_variables = json.load(f)['variables']
+    results = search(parameters, search_variables, args.trials, args.workers, args.eta, args.min_evals,
+                     args.devices.split(',') if args.devices else None, args.seed, args.search_path)
+
+    scored = [t for t in results if t['best'] is not None]
+    scored.sort(key=lambda t: t['best'], reverse='TER' not in parameters['STOP_METRIC'])
+    print '\n%6s %10s %8s %12s  %s' % ('trial', 'status', 'evals', parameters['STOP_METRIC'], 'configuration')
+    for t in scored:
+        print '%6d %10s %8d %12.4f  %s' % (t['id'], t['status'], len(t['scores']), t['best'], str(t['configuration']))
+    if scored:
+        print '\nBest configuration: ' + str(scored[0]['configuration'])
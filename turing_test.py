@@ -1,100 +1,237 @@
+"""
+Interactive Turing test on temporally-linked datasets ('-linked').
+
+Shows the description of an event and asks which one is the description of the following event, among the true one
+and some distractors taken from random events.
+
+Only the text is needed, so the descriptions of the split are extracted once from the dataset (tokenized and with the
+out-of-vocabulary words replaced by <unk>, as the model sees them) and stored in a compact file:
+    DATASET_STORE_PATH/TuringTest_<DATASET_NAME>_<split>.pkl
+Later runs load this file instead of building the dataset, unless the settings it was extracted with (tokenization,
+maximum length, vocabulary parameters and stored Dataset instance) have changed. The questions are prepared by a background thread, which
+keeps a pool of them ahead of the user, and every answer is appended to the log file as soon as it is given (one JSON
+object per line).
+
+Usage:
+    python turing_test.py [--split train] [--distractors 4] [--pool 32] [--log turing_test.jsonl] [--rebuild]
+        [KEY=VALUE ...]
+"""
+import argparse
+import ast
+import json
 import logging
-import random
+import os
 import sys
+import threading
+import time
+from Queue import Queue
 
 import numpy as np
 
 from config import load_parameters
-from data_engine.prepare_data import build_dataset
-from viddesc_model import VideoDesc_Model
 
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
 logger = logging.getLogger(__name__)
 
 
-def build(params):
-    ds = build_dataset(params)
-    params['OUTPUT_VOCABULARY_SIZE'] = ds.vocabulary_len[params['OUTPUTS_IDS_DATASET'][0]]
-    vocab = ds.vocabulary[params['OUTPUTS_IDS_DATASET'][0]]['idx2words']
-
-    # We only want the model for decoding
-    video_model = VideoDesc_Model(params,
-                                  type=params['MODEL_TYPE'],
-                                  verbose=0,
-                                  model_name=params['MODEL_NAME'],
-                                  vocabularies=ds.vocabulary,
-                                  store_path=params['STORE_PATH'],
-                                  set_optimizer=False)
-
-    return ds, vocab, video_model
-
+def compact_dataset_path(params, split):
+    return os.path.join(params['DATASET_STORE_PATH'], 'TuringTest_' + params['DATASET_NAME'] + '_' + split + '.pkl')
 
-def sample(ds, vocab, video_model, n_samples, split='train', verbose=1):
-    truth_data = np.random.randint(0, high=eval('ds.len_' + split), size=n_samples)
 
-    matches = 0
-    misses = 0
-    guesses = 0
+def compact_dataset_settings(params):
+    """
+    Settings that change the extracted descriptions. The vocabulary is identified by the stored Dataset instance.
+    """
+    dataset_path = params['DATASET_STORE_PATH'] + '/Dataset_' + params['DATASET_NAME'] + '.pkl'
+    return {'TOKENIZATION_METHOD': params['TOKENIZATION_METHOD'],
+            'MAX_OUTPUT_TEXT_LEN': params['MAX_OUTPUT_TEXT_LEN'],
+            'OUTPUT_VOCABULARY_SIZE': params['OUTPUT_VOCABULARY_SIZE'],
+            'MIN_OCCURRENCES_VOCAB': params['MIN_OCCURRENCES_VOCAB'],
+            'INPUTS_IDS_DATASET': list(params['INPUTS_IDS_DATASET']),
+            'OUTPUTS_IDS_DATASET': list(params['OUTPUTS_IDS_DATASET']),
+            'dataset_mtime': os.path.getmtime(dataset_path) if os.path.isfile(dataset_path) else None}
 
-    [truth_X, truth_Y] = ds.getXY_FromIndices('train', truth_data)
 
-    truth_Xs = video_model.decode_predictions_beam_search(np.asarray(truth_X[-2]), vocab, verbose=0, pad_sequences=True)
-    truth_Ys = video_model.decode_predictions_one_hot(np.asarray(truth_Y[0][0]), vocab)
+def build_compact_dataset(params, split='train'):
+    """
+    Extracts the (previous description, description) pairs of the split from the dataset.
+    :return: dictionary with the lists 'previous' and 'descriptions' and the 'settings' they were extracted with
+    """
+    from data_engine.prepare_data import build_dataset
 
-    for i, (truth_X, truth_Y) in enumerate(zip(truth_Xs, truth_Ys)):
+    ds = build_dataset(params)
+    if len(params['INPUTS_IDS_DATASET']) < 3:
+        raise Exception('The Turing test needs the previous descriptions of a temporally-linked dataset '
+                        '(DATASET_NAME with "-linked").')
+    prev_id = params['INPUTS_IDS_DATASET'][2]
+    output_id = params['OUTPUTS_IDS_DATASET'][0]
+    if prev_id not in getattr(ds, 'X_' + split):
+        raise Exception('The Turing test needs the previous descriptions of a temporally-linked dataset '
+                        '(DATASET_NAME with "-linked").')
+    words2idx = ds.vocabulary[output_id]['words2idx']
+    tokenize_f = getattr(ds, params['TOKENIZATION_METHOD'])
+    max_len = params['MAX_OUTPUT_TEXT_LEN']
+
+    def decode(caption):
+        words = tokenize_f(caption).split()[:max_len]
+        return ' '.join([w if w in words2idx else '<unk>' for w in words])
+
+    compact = {'previous': [decode(c) for c in getattr(ds, 'X_' + split)[prev_id]],
+               'descriptions': [decode(c) for c in getattr(ds, 'Y_' + split)[output_id]],
+               'settings': compact_dataset_settings(params)}
+    return compact
+
+
+def load_compact_dataset(params, split='train', rebuild=False):
+    """
+    Loads the compact dataset of the split, extracting it from the dataset if it is not stored, if it was extracted
+    with other settings or if rebuild.
+    """
+    from keras_wrapper.extra.read_write import dict2pkl, pkl2dict
+
+    path = compact_dataset_path(params, split)
+    if not rebuild and os.path.isfile(path):
+        compact = pkl2dict(path)
+        if compact.get('settings') == compact_dataset_settings(params):
+            logger.info('Loading the Turing test descriptions from ' + path)
+            return compact
+        logger.info('The Turing test descriptions of ' + path + ' are outdated. Extracting them again.')
+    compact = build_compact_dataset(params, split)
+    if not os.path.isdir(params['DATASET_STORE_PATH']):
+        os.makedirs(params['DATASET_STORE_PATH'])
+    dict2pkl(compact, path)
+    logger.info('Stored the Turing test descriptions in ' + path)
+    return compact
+
+
+class QuestionPool(object):
+    """
+    Prepares the questions in a background thread, keeping 'size' of them ahead.
+    """
+
+    def __init__(self, compact, n_distractors=4, size=32, seed=None):
+        self.previous = compact['previous']
+        self.descriptions = compact['descriptions']
+        if len(set(self.descriptions)) <= n_distractors:
+            raise Exception('Not enough different descriptions for %d distractors.' % n_distractors)
+        self.n_distractors = n_distractors
+        self.rng = np.random.RandomState(seed)
+        self.queue = Queue(maxsize=size)
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self):
+        while True:
+            self.queue.put(self._question())
+
+    def _question(self):
+        n = len(self.descriptions)
+        index = self.rng.randint(0, n)
+        truth = self.descriptions[index]
+        distractors = []
+        while len(distractors) < self.n_distractors:
+            candidate = self.descriptions[self.rng.randint(0, n)]
+            if candidate != truth and candidate not in distractors:
+                distractors.append(candidate)
+        options = [truth] + distractors
+        order = self.rng.permutation(len(options))
+        return {'index': int(index),
+                'previous': self.previous[index],
+                'options': [options[o] for o in order],
+                'correct': int(np.where(order == 0)[0][0])}
+
+    def next(self):
+        return self.queue.get()
+
+
+def ask(question):
+    """
+    Shows the question and reads the answer of the user.
+    :return: index of the selected option
+    """
+    print "Input", question['index'], ":", question['previous']
+    print "Which is the following event?"
+    for j, answer in enumerate(question['options']):
+        print "\t", j, ":", answer
+    while True:
         try:
-            fake_data = np.random.randint(0, high=eval('ds.len_' + split), size=n_samples)
-            [fake_X, fake_Y] = ds.getXY_FromIndices('train', fake_data)
-            fake_Xs = video_model.decode_predictions_beam_search(np.asarray(fake_X[-2]), vocab, verbose=0,
-                                                                 pad_sequences=True)
-            fake_Ys = video_model.decode_predictions_one_hot(np.asarray(fake_Y[0][0]), vocab)
-
-            print "Input", i, ":", truth_X
-            print "Which is the following event?"
-
-            answer_list = [truth_Y] + fake_Ys
-            correctness_list = [True] + [False] * len(fake_Ys)
-            answer_correctness_list = list(zip(answer_list, correctness_list))
-            random.shuffle(answer_correctness_list)
-            shuffled_answer_list, shuffled_correctness_list = zip(*answer_correctness_list)
-            for j, answer in enumerate(shuffled_answer_list):
-                print "\t", j, ":", answer
             action = int(raw_input('Select the upcoming event. \n'))
-            if shuffled_correctness_list[action]:
+            if 0 <= action < len(question['options']):
+                return action
+        except ValueError:
+            pass
+        print "Please, enter a number between 0 and %d." % (len(question['options']) - 1)
+
+
+def run(pool, log_path, verbose=1):
+    """
+    Asks questions until the user interrupts the test (Ctrl+C or end of input), appending each answer to the log.
+    :return: matches, guesses
+    """
+    matches = 0
+    guesses = 0
+    with open(log_path, 'a') as log:
+        while True:
+            try:
+                question = pool.next()
+                start_time = time.time()
+                action = ask(question)
+            except (KeyboardInterrupt, EOFError):
+                return matches, guesses
+            correct = action == question['correct']
+            log.write(json.dumps({'time': start_time,
+                                  'response_time': time.time() - start_time,
+                                  'index': question['index'],
+                                  'previous': question['previous'],
+                                  'options': question['options'],
+                                  'correct': question['correct'],
+                                  'answer': action,
+                                  'match': correct}) + '\n')
+            log.flush()
+            guesses += 1
+            if correct:
                 matches += 1
                 if verbose:
                     print "Correct!"
-            else:
-                misses += 1
-                if verbose:
-                    print "Not correct!. The correct one was:", shuffled_answer_list[
-                        shuffled_correctness_list.index(True)]
-            guesses += 1
+            elif verbose:
+                print "Not correct!. The correct one was:", question['options'][question['correct']]
             print ""
             print ""
-        except KeyboardInterrupt:
-            return matches, misses, guesses
 
-    return matches, misses, guesses
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Interactive Turing test on temporally-linked descriptions.')
+    parser.add_argument('--split', type=str, default='train', help='Split of the questions')
+    parser.add_argument('--distractors', type=int, default=4, help='Number of wrong options of each question')
+    parser.add_argument('--pool', type=int, default=32, help='Number of questions prepared ahead')
+    parser.add_argument('--log', type=str, default='turing_test.jsonl', help='File where the answers are appended')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    parser.add_argument('--rebuild', action='store_true', help='Extract the descriptions from the dataset again')
+    parser.add_argument('--verbose', type=int, default=0, help='Tell whether each answer was correct')
+    parser.add_argument('changes', nargs='*', help='Changes to the config, with the form KEY=VALUE', default=[])
+    return parser
 
 
 if __name__ == "__main__":
 
+    args = build_parser().parse_args()
     parameters = load_parameters()
+    try:
+        for arg in args.changes:
+            k, v = arg.split('=')
+            parameters[k] = ast.literal_eval(v)
+    except ValueError:
+        print 'Overwritten arguments must have the form key=Value'
+        exit(1)
     ###########
-    ds, vocab, model = build(parameters)
-    total_matches = 0
-    total_misses = 0
-    total_guesses = 0
-    while True:
-        try:
-            matches, misses, guesses = sample(ds, vocab, model, 4, split='train', verbose=0)
-            total_matches += matches
-            total_misses += misses
-            total_guesses += guesses
-        except KeyboardInterrupt:
-            print "Interrupted!"
-            print "Total number of matches: %d/%d" % (total_matches, total_guesses)
-            print "Total number of misses: %d/%d" % (total_misses, total_guesses)
-            print "Precision: %f" % (float(total_matches) / total_guesses)
-            sys.exit(0)
+    compact_dataset = load_compact_dataset(parameters, split=args.split, rebuild=args.rebuild)
+    question_pool = QuestionPool(compact_dataset, n_distractors=args.distractors, size=args.pool, seed=args.seed)
+    total_matches, total_guesses = run(question_pool, args.log, verbose=args.verbose)
+    print "Interrupted!"
+    print "Total number of matches: %d/%d" % (total_matches, total_guesses)
+    print "Total number of misses: %d/%d" % (total_guesses - total_matches, total_guesses)
+    if total_guesses > 0:
+        print "Precision: %f" % (float(total_matches) / total_guesses)
+    print "Answers stored in", args.log
+    sys.exit(0)
@@ -0,0 +1,262 @@
+"""
+Asynchronous evaluation during training.
+
+EvalPerformance decodes and scores EVAL_ON_SETS inside the training loop, so training stalls during the whole
+evaluation. With ASYNC_EVALUATION, the evaluation runs in a separate worker process:
+    * AsyncEvaluator forks the worker before Keras is imported by the trainer (so it gets its own backend, which can
+      be set to another device with ASYNC_EVALUATION_DEVICE) and shares the already built dataset with it. The worker
+      builds its own model and evaluator (the same EvalPerformance used in synchronous mode).
+    * At each evaluation point, AsyncEvalPerformance snapshots the weights to disk and hands them to the worker. The
+      worker decodes, scores and writes the results files, and sends back the logged values.
+    * The trainer keeps training meanwhile. The results are added to the model log as they arrive, and early stopping
+      (PATIENCE / STOP_METRIC) is applied on them. At most ASYNC_EVALUATION_MAX_PENDING evaluations can be waiting;
+      beyond that, training waits for the worker.
+"""
+import logging
+import multiprocessing
+import os
+import traceback
+from Queue import Empty
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def _evaluation_worker(params, dataset, build_evaluator, jobs, results, device):
+    """
+    Worker process: builds the model and the evaluator, and evaluates the snapshots received through 'jobs'.
+    """
+    try:
+        if device is not None:
+            os.environ['THEANO_FLAGS'] = ','.join([f for f in os.environ.get('THEANO_FLAGS', '').split(',')
+                                                   if f and not f.startswith('device=')] + ['device=' + device])
+        from viddesc_model import VideoDesc_Model
+
+        model = VideoDesc_Model(params,
+                                type=params['MODEL_TYPE'],
+                                verbose=0,
+                                model_name=params['MODEL_NAME'],
+                                vocabularies=dataset.vocabulary,
+                                store_path=params['STORE_PATH'],
+                                set_optimizer=False,
+                                clear_dirs=False)
+        set_mappings(model, dataset, params)
+        evaluator = build_evaluator(model)
+        # The trainer stores the evaluated checkpoints
+        evaluator.save_each_evaluation = False
+
+        records = []
+        log = model.log
+
+        def record(set_name, metric, value):
+            records.append((set_name, metric, value))
+            log(set_name, metric, value)
+
+        model.log = record
+        results.put(('ready', None, None, None))
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            counter_name, counter, weights_path = job
+            model.model.load_weights(weights_path)
+            os.remove(weights_path)
+            del records[:]
+            evaluator.evaluate(counter, counter_name=counter_name)
+            results.put(('result', counter_name, counter, list(records)))
+    except Exception:
+        results.put(('error', None, None, traceback.format_exc()))
+
+
+def set_mappings(model, dataset, params):
+    """
+    Maps the dataset inputs and outputs to the model ones (as in main.train_model).
+    """
+    inputMapping = dict()
+    for i, id_in in enumerate(params['INPUTS_IDS_DATASET']):
+        if len(model.ids_inputs) > i:
+            inputMapping[model.ids_inputs[i]] = dataset.ids_inputs.index(id_in)
+    model.setInputsMapping(inputMapping)
+
+    outputMapping = dict()
+    for i, id_out in enumerate(params['OUTPUTS_IDS_DATASET']):
+        if len(model.ids_outputs) > i:
+            outputMapping[model.ids_outputs[i]] = dataset.ids_outputs.index(id_out)
+    model.setOutputsMapping(outputMapping)
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluation worker process and its job/result queues.
+    """
+
+    def __init__(self, params, dataset, build_evaluator):
+        """
+        :param params: Dictionary of network hyperparameters.
+        :param dataset: Dataset instance (shared with the worker)
+        :param build_evaluator: function model -> EvalPerformance callback evaluating that model
+        """
+        self.params = params
+        self.dataset = dataset
+        self.build_evaluator = build_evaluator
+        self.snapshot_path = os.path.join(params['STORE_PATH'], 'async_eval')
+        self.max_pending = max(params.get('ASYNC_EVALUATION_MAX_PENDING', 2), 1)
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.process = None
+        self.pending = 0
+
+    def start(self):
+        """
+        Forks the worker. Must be called before the trainer imports Keras.
+        """
+        if 'theano' in os.sys.modules:
+            logger.warning('The asynchronous evaluation worker is started after the backend was imported.')
+        if not os.path.isdir(self.snapshot_path):
+            os.makedirs(self.snapshot_path)
+        self.process = multiprocessing.Process(target=_evaluation_worker,
+                                               args=(self.params, self.dataset, self.build_evaluator, self.jobs,
+                                                     self.results, self.params.get('ASYNC_EVALUATION_DEVICE')))
+        self.process.daemon = True
+        self.process.start()
+        logger.info('Started the asynchronous evaluation worker (pid %d)' % self.process.pid)
+
+    def submit(self, keras_model, counter_name, counter):
+        """
+        Snapshots the weights of keras_model and queues their evaluation.
+        """
+        weights_path = os.path.join(self.snapshot_path, '%s_%d_weights.h5' % (counter_name, counter))
+        keras_model.save_weights(weights_path, overwrite=True)
+        self.jobs.put((counter_name, counter, weights_path))
+        self.pending += 1
+
+    def poll(self, block=False):
+        """
+        Returns the finished evaluations, as a list of [counter_name, counter, logged (set, metric, value) records].
+        If block, waits for at least one of them.
+        """
+        finished = []
+        while True:
+            try:
+                kind, counter_name, counter, content = self.results.get(block=block and len(finished) == 0,
+                                                                        timeout=10. if block else None)
+            except Empty:
+                if block and len(finished) == 0 and self.pending > 0:
+                    if not self.process.is_alive():
+                        raise Exception('The asynchronous evaluation worker died.')
+                    continue
+                return finished
+            if kind == 'error':
+                raise Exception('Error in the asynchronous evaluation worker:\n' + content)
+            if kind == 'result':
+                self.pending -= 1
+                finished.append([counter_name, counter, content])
+
+    def stop(self):
+        """
+        Stops the worker once the queued evaluations are done.
+        """
+        if self.process is not None and self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join()
+        self.process = None
+
+
+def build_async_callback(params, model, evaluator):
+    """
+    Builds the AsyncEvalPerformance callback of the training of 'model' (see buildCallbacks in main.py).
+    """
+    from keras_wrapper.cnn_model import saveModel
+    from keras.callbacks import Callback as KerasCallback
+
+    class AsyncEvalPerformance(KerasCallback):
+        """
+        Submits the evaluations to the AsyncEvaluator and consumes their results (with early stopping).
+        """
+
+        def __init__(self):
+            super(AsyncEvalPerformance, self).__init__()
+            self.model_to_eval = model
+            self.evaluator = evaluator
+            self.eval_on_epochs = params['EVAL_EACH_EPOCHS']
+            self.each_n_epochs = params['EVAL_EACH']
+            self.start_eval_on_epoch = params['START_EVAL_ON_EPOCH']
+            # With CHECKPOINT_MANAGER, the evaluated models are saved by the CheckpointCallback
+            self.save_each_evaluation = params['SAVE_EACH_EVALUATION'] and not params.get('CHECKPOINT_MANAGER', False)
+            self.patience = params.get('PATIENCE', 0) if params.get('EARLY_STOP', True) else 0
+            self.metric_check = params.get('STOP_METRIC', None)
+            self.check_split = 'val'
+            self.want_to_minimize = self.metric_check is not None and 'TER' in self.metric_check
+            self.verbose = params['VERBOSE']
+            self.epoch = params['RELOAD'] if self.eval_on_epochs else 0
+            self.cum_update = 0 if self.eval_on_epochs else params['RELOAD']
+            self.best_score = None
+            self.best_counter = -1
+            self.wait = 0
+
+        def on_epoch_end(self, epoch, logs=None):
+            epoch += 1  # start by index 1
+            self.epoch = epoch
+            self.consume(block=False)
+            if not self.eval_on_epochs or epoch < self.start_eval_on_epoch or \
+                    (epoch - self.start_eval_on_epoch) % self.each_n_epochs != 0:
+                return
+            self.submit(epoch, 'epoch')
+
+        def on_batch_end(self, n_update, logs=None):
+            self.cum_update += 1  # start by index 1
+            self.consume(block=False)
+            if self.eval_on_epochs or self.cum_update % self.each_n_epochs != 0 or \
+                    self.epoch < self.start_eval_on_epoch:
+                return
+            self.submit(self.cum_update, 'iteration')
+
+        def on_train_end(self, logs=None):
+            while self.evaluator.pending > 0:
+                self.consume(block=True)
+            self.evaluator.stop()
+
+        def submit(self, counter, counter_name):
+            while self.evaluator.pending >= self.evaluator.max_pending:
+                logger.info('Waiting for the asynchronous evaluation (%d pending)' % self.evaluator.pending)
+                self.consume(block=True)
+            self.evaluator.submit(self.model_to_eval.model, counter_name, counter)
+            if self.save_each_evaluation:
+                saveModel(self.model_to_eval, counter, store_iter=not self.eval_on_epochs)
+            if self.verbose > 0:
+                logger.info('Submitted the asynchronous evaluation of %s %d' % (counter_name, counter))
+
+        def consume(self, block=False):
+            for counter_name, counter, records in self.evaluator.poll(block=block):
+                current_score = None
+                for set_name, metric, value in records:
+                    self.model_to_eval.log(set_name, metric, value)
+                    if set_name == self.check_split and metric == self.metric_check:
+                        current_score = value
+                if self.verbose > 0:
+                    logger.info('Received the asynchronous evaluation of %s %d' % (counter_name, counter))
+                if current_score is not None:
+                    self.early_stop(current_score, counter_name, counter)
+
+        def early_stop(self, current_score, counter_name, counter):
+            if self.want_to_minimize:
+                current_score = -current_score
+            if self.best_score is None or current_score > self.best_score:
+                self.best_score = current_score
+                self.best_counter = counter
+                self.wait = 0
+                logger.info('---current best %s %s: %.3f' % (self.check_split, self.metric_check,
+                                                              current_score if not self.want_to_minimize
+                                                              else -current_score))
+            elif self.patience > 0:
+                self.wait += 1
+                logger.info('---bad counter: %d/%d' % (self.wait, self.patience))
+                if self.wait >= self.patience:
+                    logger.info('---%s %d: early stopping. Best %s found at %s %d: %f' %
+                                (counter_name, counter, self.metric_check, counter_name, self.best_counter,
+                                 self.best_score if not self.want_to_minimize else -self.best_score))
+                    self.evaluator.stop()
+                    self.model.stop_training = True
+                    exit(1)
+
+    return AsyncEvalPerformance()
@@ -0,0 +1,186 @@
+"""
+Checkpoint averaging.
+
+Averages the weights of the last AVERAGE_CHECKPOINTS checkpoints of STORE_PATH (epoch_<N> if SAMPLING_RELOAD_EPOCH,
+update_<N> otherwise), or of the listed reload points, and writes the result as a checkpoint named as the last of
+them in AVERAGE_CHECKPOINTS_PATH (STORE_PATH/average by default). The averaged checkpoint can be used as any other one:
+    python main.py MODE="'sampling'" STORE_PATH="'<AVERAGE_CHECKPOINTS_PATH>'" SAMPLING_RELOAD_POINT=<last point>
+
+The weight files (.h5 or _weights.h5, and those of model_init / model_next) are read weight by weight with h5py: for
+each weight, the values of the N checkpoints are accumulated in a running average, which is written before reading
+the next one, so only one weight array is held in memory at a time. The rest of the files (structures, optimizer
+state, _Model_Wrapper.pkl) are copied from the last checkpoint. With AVERAGE_CHECKPOINTS_EVALUATE, the averaged
+checkpoint is then decoded and scored on 'val' (as in 'sampling' mode).
+
+Usage (from the root folder of the repository):
+    python -m utils.average_checkpoints [AVERAGE_CHECKPOINTS=5] [AVERAGE_CHECKPOINTS_EVALUATE=True] [key=Value ...]
+"""
+import ast
+import copy
+import logging
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from utils.checkpoints import SUFFIXES
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_prefix(reload_epoch):
+    return 'epoch_' if reload_epoch else 'update_'
+
+
+def list_checkpoints(store_path, reload_epoch=False):
+    """
+    Reload points of the checkpoints stored in store_path, sorted.
+    """
+    prefix = checkpoint_prefix(reload_epoch)
+    points = []
+    for filename in os.listdir(store_path):
+        if filename.startswith(prefix) and filename.endswith('_Model_Wrapper.pkl'):
+            point = filename[len(prefix):-len('_Model_Wrapper.pkl')]
+            if point.isdigit():
+                points.append(int(point))
+    return sorted(points)
+
+
+def weight_files(checkpoint):
+    """
+    Weight files of a checkpoint (saved in one file or as structure + weights), as (suffix, h5 group of the layers).
+    """
+    files = []
+    for model_suffix in ['', '_init', '_next']:
+        if os.path.isfile(checkpoint + model_suffix + '.h5'):
+            files.append((model_suffix + '.h5', 'model_weights'))
+        elif os.path.isfile(checkpoint + '_weights' + model_suffix + '.h5'):
+            files.append(('_weights' + model_suffix + '.h5', None))
+    return files
+
+
+def _layer_weights(f, group):
+    root = f[group] if group is not None else f
+    for layer_name in root.attrs['layer_names']:
+        layer = root[layer_name]
+        for weight_name in layer.attrs['weight_names']:
+            yield layer_name, weight_name, layer[weight_name]
+
+
+def average_weight_file(paths, output_path, group=None):
+    """
+    Writes in output_path the average of the weights of the h5 files 'paths' (all of them of the same model), reading
+    and averaging them weight by weight. The non-float weights are taken from the last file.
+    :param group: h5 group of the layers (None for the root)
+    """
+    import h5py
+
+    shutil.copyfile(paths[-1], output_path)
+    sources = [h5py.File(path, 'r') for path in paths]
+    try:
+        with h5py.File(output_path, 'r+') as output:
+            for layer_name, weight_name, dataset in _layer_weights(output, group):
+                if not np.issubdtype(dataset.dtype, np.floating):
+                    continue
+                average = np.zeros(dataset.shape, dtype='float64')
+                for i, source in enumerate(sources):
+                    root = source[group] if group is not None else source
+                    value = root[layer_name][weight_name][()]
+                    if value.shape != average.shape:
+                        raise Exception('Weight %s of layer %s has shape %s in %s and %s in %s' %
+                                        (weight_name, layer_name, str(value.shape), paths[i], str(average.shape),
+                                         paths[-1]))
+                    average += (value - average) / (i + 1)
+                dataset[...] = average.astype(dataset.dtype)
+    finally:
+        for source in sources:
+            source.close()
+
+
+def _relocate_wrapper(source_path, output_path, model_path):
+    """
+    Copies a _Model_Wrapper.pkl, setting its model_path (where the sampling results are written).
+    """
+    import cPickle as pk
+    import cloudpickle as cloudpk
+
+    with open(source_path, 'rb') as f:
+        model_wrapper = pk.load(f)
+    model_wrapper.model_path = model_path
+    with open(output_path, 'wb') as f:
+        cloudpk.dump(model_wrapper, f)
+
+
+def average_checkpoints(store_path, points, output_path, reload_epoch=False):
+    """
+    Averages the checkpoints 'points' of store_path into output_path/<epoch|update>_<last point>.
+    :return: reload point of the averaged checkpoint
+    """
+    prefix = checkpoint_prefix(reload_epoch)
+    checkpoints = [os.path.join(store_path, prefix + str(point)) for point in points]
+    if os.path.abspath(output_path) == os.path.abspath(store_path):
+        raise Exception('The averaged checkpoint would replace the last one. Set another AVERAGE_CHECKPOINTS_PATH.')
+    for checkpoint in checkpoints:
+        if not os.path.isfile(checkpoint + '_Model_Wrapper.pkl'):
+            raise Exception('Checkpoint ' + checkpoint + ' not found.')
+    files = weight_files(checkpoints[-1])
+    for checkpoint in checkpoints[:-1]:
+        if weight_files(checkpoint) != files:
+            raise Exception('Checkpoints ' + checkpoint + ' and ' + checkpoints[-1] + ' have different files.')
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+
+    output = os.path.join(output_path, prefix + str(points[-1]))
+    logger.info('Averaging %d checkpoints of %s (%s) into %s' %
+                (len(points), store_path, ', '.join([str(p) for p in points]), output))
+    for suffix, group in files:
+        average_weight_file([checkpoint + suffix for checkpoint in checkpoints], output + suffix, group=group)
+    averaged_suffixes = [suffix for suffix, _ in files]
+    for suffix in SUFFIXES:
+        if suffix in averaged_suffixes or not os.path.isfile(checkpoints[-1] + suffix):
+            continue
+        if suffix == '_Model_Wrapper.pkl':
+            _relocate_wrapper(checkpoints[-1] + suffix, output + suffix, output_path)
+        else:
+            shutil.copyfile(checkpoints[-1] + suffix, output + suffix)
+    return points[-1]
+
+
+def average_and_evaluate(params):
+    """
+    Averages the checkpoints selected by params and, if AVERAGE_CHECKPOINTS_EVALUATE, evaluates the result on 'val'.
+    """
+    reload_epoch = params['SAMPLING_RELOAD_EPOCH']
+    points = params.get('AVERAGE_CHECKPOINTS', 5)
+    if not isinstance(points, (list, tuple)):
+        points = list_checkpoints(params['STORE_PATH'], reload_epoch=reload_epoch)[-points:]
+    if len(points) < 2:
+        raise Exception('At least two checkpoints are needed for averaging, found: ' + str(points))
+    output_path = params.get('AVERAGE_CHECKPOINTS_PATH', None) or os.path.join(params['STORE_PATH'], 'average')
+    point = average_checkpoints(params['STORE_PATH'], sorted(points), output_path, reload_epoch=reload_epoch)
+
+    if params.get('AVERAGE_CHECKPOINTS_EVALUATE', False):
+        from main import apply_Video_model
+
+        eval_params = copy.copy(params)
+        eval_params['STORE_PATH'] = output_path
+        eval_params['SAMPLING_RELOAD_POINT'] = point
+        eval_params['EVAL_ON_SETS'] = ['val']
+        eval_params['ENSEMBLE_MODELS'] = []
+        apply_Video_model(eval_params)
+
+
+if __name__ == "__main__":
+    from config import load_parameters
+
+    parameters = load_parameters()
+    try:
+        for arg in sys.argv[1:]:
+            k, v = arg.split('=')
+            parameters[k] = ast.literal_eval(v)
+    except ValueError:
+        print 'Overwritten arguments must have the form key=Value'
+        exit(1)
+    average_and_evaluate(parameters)
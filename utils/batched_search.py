@@ -0,0 +1,336 @@
+"""
+Batched beam search with early exit.
+
+The default search (Model_Wrapper.predictBeamSearchNet) decodes one sample at a time. Here, several samples are
+decoded at once with the optimized search models (model_init and model_next): at each step, the alive hypotheses of
+all the unfinished samples are stacked in a single model_next call. Each sample keeps its own beam, so the
+hypotheses and scores are the same as in the sample-by-sample search. As soon as a sample has finished (all its
+hypotheses emitted <eos>), its rows are dropped from the next model_next call, and the search stops when every
+sample of the batch has finished, instead of always running MAX_OUTPUT_TEXT_LEN_TEST steps.
+
+A greedy search is obtained with a beam size of 1. With a vocabulary Shortlist (see utils/shortlist.py), only the
+candidate words of each sample are scored. The search models are applied through a SearchStepper, which keeps the
+states of the alive hypotheses; an Ensemble (see utils/ensemble.py) can be used instead for decoding with several
+models in lockstep.
+"""
+import logging
+import math
+import sys
+import time
+
+import numpy as np
+
+from keras_wrapper.dataset import Data_Batch_Generator
+from utils import profiling
+from utils.decode_cache import inputs_hash
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def _predict_on_rows(model, in_data, max_batch_size):
+    """
+    Applies 'model' on 'in_data', splitting it in chunks of at most 'max_batch_size' rows.
+    """
+    n_rows = in_data.values()[0].shape[0]
+    if n_rows <= max_batch_size:
+        return list(model.predict_on_batch(in_data))
+    out_data = None
+    for i in range(0, n_rows, max_batch_size):
+        out_chunk = model.predict_on_batch(dict([(k, v[i:i + max_batch_size]) for k, v in in_data.iteritems()]))
+        if out_data is None:
+            out_data = [[o] for o in out_chunk]
+        else:
+            for idx, o in enumerate(out_chunk):
+                out_data[idx].append(o)
+    return [np.concatenate(o, axis=0) for o in out_data]
+
+
+class SearchStepper(object):
+    """
+    Applies the optimized search models of a model step by step, keeping the outputs of the previous step (the
+    states of the hypotheses) between calls.
+    """
+
+    def __init__(self, model, search_models=None, max_batch_size=50, log_probs=True):
+        """
+        :param model: Model_Wrapper with model_init and model_next
+        :param search_models: object with the model_init and model_next applied (e.g. a Shortlist). 'model' if None
+        :param max_batch_size: maximum number of rows of each prediction
+        :param log_probs: return the log-probabilities of the words (otherwise, the first output of the search models)
+        """
+        self.model = model
+        self.search_models = search_models if search_models is not None else model
+        self.max_batch_size = max_batch_size
+        self.log_probs = log_probs
+        self.prev_out = None
+        self.ii = 0
+
+    def _output(self):
+        if self.log_probs:
+            return np.log(self.prev_out[0][:, 0, :])
+        return self.prev_out[0]
+
+    def init(self, X, params, state_below):
+        """
+        First step of the search, on the inputs X of the samples.
+        """
+        in_data = dict([(model_input, X[model_input]) for model_input in params['model_inputs']])
+        in_data[params['model_inputs'][params['state_below_index']]] = state_below
+        with profiling.scope('model_init'):
+            self.prev_out = _predict_on_rows(self.search_models.model_init, in_data, self.max_batch_size)
+        self.ii = 1
+        return self._output()
+
+    def next(self, state_below, rows):
+        """
+        Next step of the search, continuing the hypotheses of the given rows of the previous step.
+        """
+        model = self.model
+        if self.ii == 1:
+            prev_ids, matchings = model.ids_outputs_init, model.matchings_init_to_next
+        else:
+            prev_ids, matchings = model.ids_outputs_next, model.matchings_next_to_next
+        in_data = {model.ids_inputs_next[0]: state_below}
+        for idx, prev_out_name in enumerate(prev_ids):
+            if idx > 0 and prev_out_name in matchings:
+                in_data[matchings[prev_out_name]] = self.prev_out[idx][rows]
+        with profiling.scope('model_next'):
+            self.prev_out = _predict_on_rows(self.search_models.model_next, in_data, self.max_batch_size)
+        self.ii += 1
+        return self._output()
+
+
+@profiling.profiled()
+def batched_beam_search(model, X, params, eos_sym=0, null_sym=2, shortlist=None, candidates=None, stepper=None):
+    """
+    Beam search applied at once on all the samples in X, with the optimized search models of 'model'.
+
+    :param model: Model_Wrapper with model_init and model_next
+    :param X: dictionary of model inputs, with the samples stacked on the first dimension
+    :param params: search parameters (as in predictBeamSearchNet)
+    :param eos_sym: <eos> symbol
+    :param null_sym: <null> symbol
+    :param shortlist: Shortlist bound to 'model' (None for scoring the whole vocabulary)
+    :param candidates: candidate words of each sample (only if 'shortlist' is set)
+    :param stepper: object applying the search models (SearchStepper interface), e.g. an Ensemble. If None, a
+                    SearchStepper of 'model' (or of the shortlist) is used
+    :return: list with the UNSORTED [samples, scores] of each sample (as returned by beam_search)
+    """
+    k = params['beam_size']
+    if stepper is None:
+        stepper = SearchStepper(model, search_models=shortlist, max_batch_size=params.get('max_batch_size', 50),
+                                log_probs=shortlist is None)
+    n_samples = X[params['model_inputs'][0]].shape[0]
+
+    samples = [[] for _ in range(n_samples)]
+    sample_scores = [[] for _ in range(n_samples)]
+    dead_k = [0] * n_samples
+    hyp_samples = [[[]] for _ in range(n_samples)]
+    hyp_scores = [np.zeros(1, dtype='float32') for _ in range(n_samples)]
+
+    # Unfinished samples and the rows of the previous outputs from which their hypotheses are continued
+    active = range(n_samples)
+    rows = range(n_samples)
+    state_below = np.zeros((n_samples, 1), dtype='int64') + null_sym
+
+    for ii in range(params['maxlen']):
+        if ii == 0:
+            out_data = stepper.init(X, params, state_below)
+        else:
+            out_data = stepper.next(state_below, rows)
+        if shortlist is None:
+            log_probs = out_data
+            voc_size = log_probs.shape[1]
+
+        # Beam step on the rows of each sample
+        new_active = []
+        new_rows = []
+        offset = 0
+        for j in active:
+            n_hyps = len(hyp_samples[j])
+            if shortlist is None:
+                cand_flat = (hyp_scores[j][:, None] - log_probs[offset:offset + n_hyps]).flatten()
+            else:
+                voc_size = len(candidates[j])
+                cand_flat = (hyp_scores[j][:, None] -
+                             shortlist.log_probs(out_data[offset:offset + n_hyps], candidates[j])).flatten()
+            ranks_flat = cand_flat.argsort()[:(k - dead_k[j])]
+            trans_indices = ranks_flat // voc_size
+            word_indices = ranks_flat % voc_size
+            if shortlist is not None:
+                word_indices = candidates[j][word_indices]
+            costs = cand_flat[ranks_flat]
+
+            alive_samples = []
+            alive_scores = []
+            alive_rows = []
+            for ti, wi, cost in zip(trans_indices, word_indices, costs):
+                if wi == eos_sym:  # finished hypothesis
+                    samples[j].append(hyp_samples[j][ti] + [wi])
+                    sample_scores[j].append(cost)
+                    dead_k[j] += 1
+                else:
+                    alive_samples.append(hyp_samples[j][ti] + [wi])
+                    alive_scores.append(cost)
+                    alive_rows.append(offset + ti)
+            hyp_samples[j] = alive_samples
+            hyp_scores[j] = np.asarray(alive_scores, dtype='float32')
+            offset += n_hyps
+
+            if len(alive_samples) > 0 and dead_k[j] < k:
+                new_active.append(j)
+                new_rows += alive_rows
+
+        # Drop the finished samples from the next step
+        active = new_active
+        rows = new_rows
+        if len(active) == 0:
+            break
+        state_below = np.asarray([[hyp[-1]] for j in active for hyp in hyp_samples[j]], dtype='int64')
+
+    # dump every remaining one
+    results = []
+    for j in range(n_samples):
+        results.append([samples[j] + hyp_samples[j], sample_scores[j] + list(hyp_scores[j])])
+    return results
+
+
+def _shapes_key(x):
+    return tuple([(input_id, x[input_id].shape[1:]) for input_id in sorted(x.keys())])
+
+
+def predict_batched_beam_search(model, ds, params, shortlist=None, ensemble=None):
+    """
+    Batched version of predictBeamSearchNet (see VideoDesc_Model.predictBeamSearchNet). Only available for
+    optimized search models and full splits (params['n_samples'] < 1).
+
+    Samples are grouped by the shapes of their inputs, so that the stacked inputs do not need any extra padding.
+    For temporally-linked models, a sample is decoded once the sample it is linked to has been decoded.
+
+    :param model: Model_Wrapper with model_init and model_next
+    :param ds: Dataset
+    :param params: search parameters (already checked against the default ones)
+    :param shortlist: Shortlist for restricting the vocabulary of each sample (None for using the whole vocabulary)
+    :param ensemble: Ensemble decoded instead of 'model' (see utils/ensemble.py). 'model' still provides the data
+                     mappings. Not compatible with the shortlist, and the decode cache is not applied
+    :return: dictionary with set splits as keys and the best predictions of each sample as values
+    """
+    batch_size = params['max_batch_size']
+    eos_sym = ds.extra_words['<pad>']
+    null_sym = ds.extra_words['<null>']
+    decode_cache = getattr(model, 'decode_cache', None) if ensemble is None else None
+    cache_extra = ('batched', eos_sym, null_sym)
+    if shortlist is not None:
+        shortlist.bind(model)
+        cache_extra += shortlist.settings()
+    link_index_id = params.get('link_index_id', 'link_index')
+    predictions = dict()
+
+    for s in params['predict_on_sets']:
+        logger.info('<<< Predicting outputs of ' + s + ' set (batched search%s) >>>' %
+                    ('' if ensemble is None else ', ensemble of %d models' % len(ensemble)))
+        if params['temporally_linked'] and s == 'train':
+            logger.info('Sampling is currently not implemented on the "train" set for temporally-linked models.')
+            continue
+        n_samples = eval('ds.len_' + s)
+        data_gen = Data_Batch_Generator(s, model, ds, int(math.ceil(float(n_samples) / batch_size)),
+                                        batch_size=batch_size,
+                                        normalization=params['normalize'],
+                                        data_augmentation=False,
+                                        mean_substraction=params['mean_substraction'],
+                                        predict=True).generator()
+
+        best_samples = [None] * n_samples
+        best_costs = [0.] * n_samples
+        previous_outputs = dict()
+        start_time = time.time()
+
+        def decode(indices, xs):
+            """
+            Decodes the samples 'indices', whose inputs are 'xs', grouping them by input shapes.
+            """
+            groups = dict()
+            for i, x in zip(indices, xs):
+                key = None
+                if decode_cache is not None:
+                    key = inputs_hash(x, params, extra=cache_extra)
+                    result = decode_cache.get(key)
+                    if result is not None:
+                        store(i, result)
+                        continue
+                groups.setdefault(_shapes_key(x), []).append((i, x, key))
+            for group in groups.values():
+                for start in range(0, len(group), batch_size):
+                    chunk = group[start:start + batch_size]
+                    X = dict([(input_id, np.concatenate([x[input_id] for _, x, _ in chunk]))
+                              for input_id in chunk[0][1]])
+                    candidates = None
+                    if shortlist is not None:
+                        candidates = [shortlist.candidates(x[params['model_inputs'][0]]) for _, x, _ in chunk]
+                    results = batched_beam_search(model, X, params, eos_sym=eos_sym, null_sym=null_sym,
+                                                  shortlist=shortlist, candidates=candidates, stepper=ensemble)
+                    for (i, _, key), result in zip(chunk, results):
+                        if decode_cache is not None:
+                            decode_cache.put(key, result)
+                        store(i, result)
+
+        def store(i, result):
+            samples, scores = result
+            if params['normalize_probs']:
+                counts = [len(sample) ** params['alpha_factor'] for sample in samples]
+                scores = [co / cn for co, cn in zip(scores, counts)]
+            best = np.argmin(scores)
+            best_samples[i] = samples[best]
+            best_costs[i] = scores[best]
+            # Get all words previous to the padding
+            previous_outputs[i] = samples[best][:sum([int(elem > 0) for elem in samples[best]])]
+            sys.stdout.write('Sampling %d/%d\r' % (len(previous_outputs), n_samples))
+            sys.stdout.flush()
+
+        if not params['temporally_linked']:
+            first_idx = 0
+            while first_idx < n_samples:
+                X = data_gen.next()
+                n_batch = len(X[params['model_inputs'][0]])
+                decode(range(first_idx, first_idx + n_batch),
+                       [dict([(input_id, X[input_id][i:i + 1]) for input_id in params['model_inputs']])
+                        for i in range(n_batch)])
+                first_idx += n_batch
+        else:
+            # Inputs of all the samples, decoded as soon as the sample they are linked to is available
+            xs = []
+            while len(xs) < n_samples:
+                X = data_gen.next()
+                xs += [dict([(input_id, X[input_id][i:i + 1]) for input_id in params['model_inputs']])
+                       for i in range(len(X[params['model_inputs'][0]]))]
+            links = []
+            for i, x in enumerate(xs):
+                link = int(x[link_index_id][0])
+                links.append(link if 0 <= link < i else -1)  # samples not processed yet are not available
+            pending = range(n_samples)
+            while len(pending) > 0:
+                ready = [i for i in pending if links[i] == -1 or links[i] in previous_outputs]
+                pending = [i for i in pending if not (links[i] == -1 or links[i] in previous_outputs)]
+                for i in ready:
+                    prev = previous_outputs[links[i]] if links[i] != -1 else [null_sym]
+                    for input_id in model.ids_temporally_linked_inputs:
+                        prev_x = [ds.vocabulary[input_id]['idx2words'][w] for w in prev]
+                        xs[i][input_id] = ds.loadText([' '.join(prev_x)], ds.vocabulary[input_id],
+                                                      ds.max_text_len[input_id][s],
+                                                      ds.text_offset[input_id],
+                                                      fill=ds.fill_text[input_id],
+                                                      pad_on_batch=ds.pad_on_batch[input_id],
+                                                      words_so_far=ds.words_so_far[input_id],
+                                                      loading_X=True)[0]
+                decode(ready, [xs[i] for i in ready])
+
+        predictions[s] = np.asarray(best_samples)
+        elapsed = time.time() - start_time
+        sys.stdout.write('\n Total cost of the translations: %f \t Average cost of the translations: %f\n' %
+                         (sum(best_costs), sum(best_costs) / n_samples))
+        sys.stdout.write('The sampling took: %f secs (Speed: %f sec/sample)\n' % (elapsed, elapsed / n_samples))
+        if shortlist is not None:
+            sys.stdout.write('Average shortlist size: %f words\n' % shortlist.mean_size())
+        sys.stdout.flush()
+    return predictions
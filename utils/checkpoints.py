@@ -0,0 +1,299 @@
+"""
+Asynchronous checkpointing, keeping only the best and the last models.
+
+With SAVE_EACH_EVALUATION (or EPOCHS_FOR_SAVE), saveModel writes a full model into STORE_PATH in the training loop,
+which waits for the write, and every checkpoint is kept. With CHECKPOINT_MANAGER, the CheckpointCallback replaces
+these saves:
+    * At each save point, the weights of the model (and of model_init / model_next) are copied to host memory and the
+      Model_Wrapper is pickled. Training goes on while a background thread writes them.
+    * The files are written in STORE_PATH/.checkpoint_tmp/ and then moved into STORE_PATH (the _Model_Wrapper.pkl the
+      last one), so an interrupted write never leaves a half-written file with a checkpoint name.
+    * Only the CHECKPOINT_TOP_K best checkpoints by STOP_METRIC on the 'val' split and the CHECKPOINT_LAST_N most
+      recent ones are kept. The kept checkpoints and their scores are listed in STORE_PATH/checkpoints.json.
+The checkpoints have the usual names (epoch_<N> / update_<N>) and the structure + weights layout of saveModel, so
+loadModel (RELOAD, SAMPLING_RELOAD_POINT) reads them as any other checkpoint.
+"""
+import atexit
+import json
+import logging
+import os
+import shutil
+import threading
+from Queue import Queue
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'checkpoints.json'
+TMP_DIR = '.checkpoint_tmp'
+# Files of a checkpoint written by saveModel, in writing order (loadModel needs the _Model_Wrapper.pkl)
+SUFFIXES = ['.h5', '_structure.json', '_weights.h5', '_init.h5', '_structure_init.json', '_weights_init.h5',
+            '_next.h5', '_structure_next.json', '_weights_next.h5', '_Model_Wrapper.pkl']
+
+
+def save_weights_h5(path, layers):
+    """
+    Writes weights in the format of Keras' save_weights.
+    :param path: .h5 file
+    :param layers: list of (layer name, [weight names], [weight values])
+    """
+    import h5py
+    from keras import __version__ as keras_version
+    from keras import backend as K
+
+    with h5py.File(path, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in layers]
+        f.attrs['backend'] = K.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras_version).encode('utf8')
+        for name, weight_names, values in layers:
+            g = f.create_group(name)
+            g.attrs['weight_names'] = [w.encode('utf8') for w in weight_names]
+            for weight_name, value in zip(weight_names, values):
+                dataset = g.create_dataset(weight_name, value.shape, dtype=value.dtype)
+                if not value.shape:
+                    dataset[()] = value
+                else:
+                    dataset[:] = value
+
+
+def snapshot_model(model):
+    """
+    In-memory copy of the weights of a Keras model: list of (layer name, [weight names], [weight values]).
+    """
+    from keras import backend as K
+
+    layers = []
+    for layer in model.layers:
+        weights = layer.weights
+        values = K.batch_get_value(weights)
+        names = [str(w.name) if getattr(w, 'name', None) else 'param_' + str(i) for i, w in enumerate(weights)]
+        layers.append((layer.name, names, values))
+    return layers
+
+
+class CheckpointManager(object):
+    """
+    Writes the checkpoints of a model in a background thread and keeps only the top-k and the last N of them.
+    """
+
+    def __init__(self, store_path, top_k=3, last_n=2, maximize=True, scored=True, verbose=1):
+        """
+        :param store_path: folder of the checkpoints (the STORE_PATH of the model)
+        :param top_k: number of best checkpoints kept
+        :param last_n: number of most recent checkpoints kept
+        :param maximize: whether the higher scores are the better ones
+        :param scored: whether the checkpoints are scored (set_score). Otherwise, only the last N are kept
+        :param verbose: verbosity level
+        """
+        self.store_path = store_path
+        self.tmp_path = os.path.join(store_path, TMP_DIR)
+        self.top_k = top_k
+        self.last_n = last_n
+        self.maximize = maximize
+        self.scored = scored
+        self.verbose = verbose
+        self.structures = dict()  # JSON structures of the models (they do not change during training)
+
+        # Unfinished writes of a previous run
+        if os.path.isdir(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        self.entries = []  # (name, counter, score), only accessed by the writer thread once started
+        manifest_path = os.path.join(store_path, MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                self.entries = [e for e in json.load(f)
+                                if os.path.isfile(os.path.join(store_path, e['name'] + '_Model_Wrapper.pkl'))]
+
+        # At most one snapshot waits for the writer, bounding the memory used by the snapshots
+        self.jobs = Queue(maxsize=1)
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.close)  # Early stopping exits the process
+
+    def save(self, model_wrapper, counter, store_iter=False):
+        """
+        Snapshots the model and queues it for writing, as saveModel(model_wrapper, counter, store_iter=store_iter).
+        """
+        import cloudpickle as cloudpk
+
+        name = ('update_' if store_iter else 'epoch_') + str(counter)
+        models = []
+        for suffix, model in [('', model_wrapper.model),
+                              ('_init', getattr(model_wrapper, 'model_init', None)),
+                              ('_next', getattr(model_wrapper, 'model_next', None))]:
+            if model is None:
+                continue
+            if suffix not in self.structures:
+                self.structures[suffix] = model.to_json()
+            models.append((suffix, self.structures[suffix], snapshot_model(model)))
+
+        backup_multi_gpu_model = getattr(model_wrapper, 'multi_gpu_model', None)
+        if hasattr(model_wrapper, 'multi_gpu_model'):
+            model_wrapper.multi_gpu_model = None
+        wrapper = cloudpk.dumps(model_wrapper)
+        if hasattr(model_wrapper, 'multi_gpu_model'):
+            model_wrapper.multi_gpu_model = backup_multi_gpu_model
+
+        self.jobs.put(('save', (name, counter, models, wrapper)))
+
+    def set_score(self, counter, score):
+        """
+        Sets the score (STOP_METRIC) of the checkpoint of 'counter'.
+        """
+        self.jobs.put(('score', (counter, score)))
+
+    def close(self):
+        """
+        Waits for the queued checkpoints to be written.
+        """
+        if self.writer is not None and self.writer.is_alive():
+            self.jobs.put(None)
+            self.writer.join()
+        self.writer = None
+
+    def _write_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            kind, content = job
+            try:
+                if kind == 'save':
+                    self._write(*content)
+                else:
+                    counter, score = content
+                    for entry in self.entries:
+                        if entry['counter'] == counter:
+                            entry['score'] = score
+                self._prune()
+            except Exception:
+                logger.exception('Error writing the checkpoints of ' + self.store_path)
+
+    def _write(self, name, counter, models, wrapper):
+        if not os.path.isdir(self.tmp_path):
+            os.makedirs(self.tmp_path)
+        files = []
+        for suffix, structure, layers in models:
+            files.append(name + '_structure' + suffix + '.json')
+            with open(os.path.join(self.tmp_path, files[-1]), 'w') as f:
+                f.write(structure)
+            files.append(name + '_weights' + suffix + '.h5')
+            save_weights_h5(os.path.join(self.tmp_path, files[-1]), layers)
+        files.append(name + '_Model_Wrapper.pkl')
+        with open(os.path.join(self.tmp_path, files[-1]), 'wb') as f:
+            f.write(wrapper)
+
+        # A previous checkpoint with the same name (e.g. saved by saveModel) would be read instead of this one
+        self._remove(name)
+        for filename in files:
+            os.rename(os.path.join(self.tmp_path, filename), os.path.join(self.store_path, filename))
+        self.entries = [e for e in self.entries if e['name'] != name] + \
+                       [{'name': name, 'counter': counter, 'score': None}]
+        if self.verbose > 0:
+            logger.info('<<< Checkpoint ' + os.path.join(self.store_path, name) + ' written >>>')
+
+    def _remove(self, name):
+        for suffix in reversed(SUFFIXES):
+            path = os.path.join(self.store_path, name + suffix)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _prune(self):
+        """
+        Removes the checkpoints that are neither in the top-k nor in the last N, and updates the manifest.
+        """
+        by_recency = sorted(self.entries, key=lambda e: e['counter'], reverse=True)
+        kept = set([e['name'] for e in by_recency[:self.last_n]])
+        scored = [e for e in self.entries if e['score'] is not None]
+        scored.sort(key=lambda e: e['score'], reverse=self.maximize)
+        kept.update([e['name'] for e in scored[:self.top_k]])
+        if self.scored and scored:
+            # Checkpoints whose evaluation has not arrived yet (ASYNC_EVALUATION)
+            last_scored = max([e['counter'] for e in scored])
+            kept.update([e['name'] for e in self.entries if e['score'] is None and e['counter'] > last_scored])
+
+        for entry in self.entries:
+            if entry['name'] not in kept:
+                self._remove(entry['name'])
+                if self.verbose > 0:
+                    logger.info('Removed checkpoint ' + os.path.join(self.store_path, entry['name']))
+        self.entries = [e for e in self.entries if e['name'] in kept]
+
+        manifest_path = os.path.join(self.store_path, MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(sorted(self.entries, key=lambda e: e['counter']), f, indent=1)
+        os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def build_checkpoint_callback(params, model_wrapper):
+    """
+    Builds the CheckpointCallback of the training of 'model_wrapper' (see buildCallbacks in main.py). It must be run
+    after the evaluation callback, so that the scores of the checkpoints are already logged.
+    """
+    from keras.callbacks import Callback as KerasCallback
+
+    class CheckpointCallback(KerasCallback):
+        """
+        Saves the model through a CheckpointManager at each evaluation (if SAVE_EACH_EVALUATION) and every
+        EPOCHS_FOR_SAVE epochs.
+        """
+
+        def __init__(self):
+            super(CheckpointCallback, self).__init__()
+            self.model_wrapper = model_wrapper
+            self.manager = CheckpointManager(params['STORE_PATH'],
+                                             top_k=params.get('CHECKPOINT_TOP_K', 3),
+                                             last_n=params.get('CHECKPOINT_LAST_N', 2),
+                                             maximize='TER' not in (params.get('STOP_METRIC') or ''),
+                                             scored=params.get('STOP_METRIC') is not None and
+                                             bool(params['METRICS']) and 'val' in params['EVAL_ON_SETS'],
+                                             verbose=params['VERBOSE'])
+            self.eval_on_epochs = params['EVAL_EACH_EPOCHS']
+            self.each_n_epochs = params['EVAL_EACH']
+            self.start_eval_on_epoch = params['START_EVAL_ON_EPOCH']
+            self.save_each_evaluation = params['SAVE_EACH_EVALUATION'] and bool(params['METRICS'])
+            self.epochs_for_save = params['EPOCHS_FOR_SAVE']
+            self.metric_check = params.get('STOP_METRIC', None)
+            self.counter_name = 'epoch' if self.eval_on_epochs else 'iteration'
+            self.epoch = params['RELOAD'] if self.eval_on_epochs else 0
+            self.cum_update = 0 if self.eval_on_epochs else params['RELOAD']
+            self.n_scores = 0
+
+        def on_epoch_end(self, epoch, logs=None):
+            epoch += 1  # start by index 1
+            self.epoch = epoch
+            evaluated = self.eval_on_epochs and epoch >= self.start_eval_on_epoch and \
+                (epoch - self.start_eval_on_epoch) % self.each_n_epochs == 0
+            if (self.save_each_evaluation and evaluated) or \
+                    (self.epochs_for_save is not None and self.epochs_for_save > 0 and
+                     epoch % self.epochs_for_save == 0):
+                self.manager.save(self.model_wrapper, epoch)
+            self.send_scores()
+
+        def on_batch_end(self, n_update, logs=None):
+            self.cum_update += 1  # start by index 1
+            if self.eval_on_epochs or self.cum_update % self.each_n_epochs != 0 or \
+                    self.epoch < self.start_eval_on_epoch:
+                return
+            if self.save_each_evaluation:
+                self.manager.save(self.model_wrapper, self.cum_update, store_iter=True)
+            self.send_scores()
+
+        def on_train_end(self, logs=None):
+            self.send_scores()
+            self.manager.close()
+
+        def send_scores(self):
+            """
+            Sends the STOP_METRIC values on the 'val' split logged since the last call to the manager.
+            """
+            if self.metric_check is None:
+                return
+            counters = [c for c in self.model_wrapper.getLog('val', self.counter_name) if c is not None]
+            scores = [s for s in self.model_wrapper.getLog('val', self.metric_check) if s is not None]
+            for counter, score in zip(counters, scores)[self.n_scores:]:
+                self.manager.set_score(counter, score)
+            self.n_scores = max(self.n_scores, min(len(counters), len(scores)))
+
+    return CheckpointCallback()
@@ -0,0 +1,294 @@
+"""
+Parallel COCO caption evaluation (Bleu_1-4, METEOR, ROUGE_L, CIDEr and, if available, TER).
+
+The 'coco' metric of keras_wrapper runs the pycocoevalcap scorers one after the other, starts a new Meteor (Java)
+process on every call and cooks the references (n-gram counts, CIDEr document frequencies) again on every evaluation,
+although they never change for a split. CocoEvaluator instead:
+    * runs each scorer in its own persistent worker process, so that all of them are computed concurrently. The Meteor
+      worker keeps a single Meteor process for all the evaluations.
+    * sends the reference index of a split (see utils/reference_index.py) to the workers only once. Each worker keeps
+      the part of the index it needs for every split it has seen, and only the new hypotheses are processed on each
+      evaluation.
+The scores are the same as those of the 'coco' metric.
+
+Usage: register_metrics() adds the 'coco_parallel' metric to keras_wrapper's selectMetric (METRICS = ['coco_parallel']).
+"""
+import logging
+import multiprocessing
+import traceback
+
+from utils.reference_index import bleu_score, build_reference_index, cider_score
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+BLEU_METRICS = ['Bleu_1', 'Bleu_2', 'Bleu_3', 'Bleu_4']
+
+
+class CachedBleu(object):
+    """
+    Corpus BLEU-1..4 ('closest' reference length), from the reference index of each split.
+    """
+    name = 'Bleu'
+    fields = ['n', 'ids', 'bleu']
+
+    def __init__(self):
+        self.references = dict()
+
+    def add_references(self, split, index):
+        self.references[split] = index
+
+    def score(self, split, hypo):
+        return dict(zip(BLEU_METRICS, bleu_score(self.references[split], hypo)))
+
+
+class CachedCider(object):
+    """
+    CIDEr, from the reference index (document frequencies and reference vectors) of each split.
+    """
+    name = 'CIDEr'
+    fields = ['n', 'ids', 'document_frequency', 'ref_len', 'cider']
+
+    def __init__(self):
+        self.references = dict()
+
+    def add_references(self, split, index):
+        self.references[split] = index
+
+    def score(self, split, hypo):
+        return {'CIDEr': cider_score(self.references[split], hypo)}
+
+
+class CachedRouge(object):
+    """
+    ROUGE_L (sentence level, averaged).
+    """
+    name = 'ROUGE_L'
+    fields = ['references']
+
+    def __init__(self):
+        from pycocoevalcap.rouge.rouge import Rouge
+        self.rouge = Rouge()
+        self.references = dict()
+
+    def add_references(self, split, index):
+        self.references[split] = index['references']
+
+    def score(self, split, hypo):
+        score, _ = self.rouge.compute_score(self.references[split], hypo)
+        return {'ROUGE_L': score}
+
+
+class PersistentMeteor(object):
+    """
+    METEOR, computed by a single Meteor process kept alive between evaluations.
+    """
+    name = 'METEOR'
+    fields = ['references']
+
+    def __init__(self, language='en'):
+        self.language = language
+        self.meteor = None
+        self.references = dict()
+
+    def add_references(self, split, index):
+        self.references[split] = index['references']
+
+    def score(self, split, hypo):
+        from pycocoevalcap.meteor.meteor import Meteor
+        if self.meteor is None:
+            self.meteor = Meteor(language=self.language)
+        score, _ = self.meteor.compute_score(self.references[split], hypo)
+        return {'METEOR': score}
+
+
+class CachedTer(object):
+    """
+    TER (computed by keras_wrapper's 'coco' metric when pycocoevalcap provides it).
+    """
+    name = 'TER'
+    fields = ['references']
+
+    def __init__(self):
+        from pycocoevalcap.ter.ter import Ter
+        self.ter = Ter()
+        self.references = dict()
+
+    def add_references(self, split, index):
+        self.references[split] = index['references']
+
+    def score(self, split, hypo):
+        score, _ = self.ter.compute_score(self.references[split], hypo)
+        return {'TER': score}
+
+
+def _scorer_worker(scorer, jobs, results):
+    """
+    Worker process: scores the hypotheses received through 'jobs' with 'scorer'.
+    Each job is (split, reference index or None if already sent, hypotheses).
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        split, index, hypo = job
+        try:
+            if index is not None:
+                scorer.add_references(split, index)
+            results.put((scorer.name, scorer.score(split, hypo), None))
+        except Exception:
+            results.put((scorer.name, None, traceback.format_exc()))
+
+
+class CocoEvaluator(object):
+    """
+    Computes the COCO metrics of several evaluations, keeping the scorers (and their reference caches) alive.
+    """
+
+    def __init__(self, language='en', ter=False, parallel=True):
+        """
+        :param language: METEOR language. METEOR is not computed if the language is not supported.
+        :param ter: also compute TER (if available in pycocoevalcap)
+        :param parallel: run every scorer in its own worker process. Otherwise, they are run sequentially here.
+        """
+        self.scorers = [CachedBleu(), CachedRouge(), CachedCider()]
+        try:
+            from pycocoevalcap.meteor import accepted_langs
+        except ImportError:
+            accepted_langs = ['en']
+        if language in accepted_langs:
+            self.scorers.append(PersistentMeteor(language))
+        if ter:
+            try:
+                self.scorers.append(CachedTer())
+            except ImportError:
+                pass
+        self.parallel = parallel
+        self.workers = None
+        self.splits_sent = set()
+
+    def _start_workers(self):
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        for scorer in self.scorers:
+            jobs = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_scorer_worker, args=(scorer, jobs, self.results))
+            process.daemon = True
+            process.start()
+            self.workers.append((process, jobs))
+
+    def evaluate(self, split, refs, hypo, index=None):
+        """
+        Scores the hypotheses of a split.
+        :param split: name of the split. Its references are assumed to be the same in all the calls.
+        :param refs: dictionary of references (id, [sentences])
+        :param hypo: dictionary of hypotheses (id, [sentence])
+        :param index: reference index of the split (see utils/reference_index.py). Built from refs if None.
+        :return: dictionary of scores
+        """
+        assert sorted(refs) == sorted(hypo), 'The references and hypotheses ids do not match'
+        parts = [None] * len(self.scorers)
+        if split not in self.splits_sent:
+            if index is None:
+                index = build_reference_index(refs)
+            parts = [dict([(field, index[field]) for field in scorer.fields]) for scorer in self.scorers]
+            self.splits_sent.add(split)
+        final_scores = dict()
+        if not self.parallel:
+            for scorer, part in zip(self.scorers, parts):
+                if part is not None:
+                    scorer.add_references(split, part)
+                final_scores.update(scorer.score(split, hypo))
+            return final_scores
+
+        if self.workers is None:
+            self._start_workers()
+        for (process, jobs), part in zip(self.workers, parts):
+            jobs.put((split, part, hypo))
+        errors = []
+        for _ in self.workers:
+            name, scores, error = self.results.get()
+            if error is not None:
+                errors.append(name + ':\n' + error)
+            else:
+                final_scores.update(scores)
+        if errors:
+            self.close()
+            self.splits_sent = set()
+            raise Exception('Error computing the coco scores:\n' + '\n'.join(errors))
+        return final_scores
+
+    def close(self):
+        """
+        Stops the workers (and the Meteor process).
+        """
+        if self.workers is not None:
+            for process, jobs in self.workers:
+                jobs.put(None)
+            for process, jobs in self.workers:
+                process.join()
+            self.workers = None
+
+
+_evaluators = dict()
+
+
+def get_coco_score(pred_list, verbose, extra_vars, split):
+    """
+    Same as keras_wrapper's 'coco' metric, computed by a CocoEvaluator kept alive between evaluations.
+    :param pred_list: list of hypothesis sentences
+    :param verbose: if greater than 0 the metric measures are printed out
+    :param extra_vars: extra variables, here are:
+            extra_vars['language'] - METEOR language
+            extra_vars[split]['references'] - dict mapping sample indices to list with all valid captions
+            extra_vars['tokenize_f'] - tokenization function used during model training
+            extra_vars['tokenize_hypotheses'] - whether to tokenize or not the hypotheses
+            extra_vars['tokenize_references'], extra_vars['apply_detokenization'] and extra_vars['detokenize_f'] -
+                preprocessing of the references (applied once per split)
+            extra_vars[split]['reference_index'] - reference index of the split (optional, see
+                utils/reference_index.py). Only used if the references are not preprocessed.
+    :param split: split on which we are evaluating
+    :return: Dictionary with the coco scores
+    """
+    language = extra_vars.get('language', 'en')
+    if language not in _evaluators:
+        _evaluators[language] = CocoEvaluator(language=language, ter=True)
+    evaluator = _evaluators[language]
+
+    if extra_vars.get('tokenize_hypotheses', False):
+        hypo = dict([(idx, [extra_vars['tokenize_f'](lines.strip())]) for (idx, lines) in enumerate(pred_list)])
+    else:
+        hypo = dict([(idx, [lines.strip()]) for (idx, lines) in enumerate(pred_list)])
+
+    refs = extra_vars[split]['references']
+    index = extra_vars[split].get('reference_index')
+    if split not in evaluator.splits_sent:
+        if extra_vars.get('tokenize_references', False):
+            refs = dict([(idx, map(extra_vars['tokenize_f'], refs[idx])) for idx in refs])
+            index = None
+        if extra_vars.get('apply_detokenization', False):
+            refs = dict([(idx, map(extra_vars['detokenize_f'], refs[idx])) for idx in refs])
+            index = None
+
+    final_scores = evaluator.evaluate(split, refs, hypo, index=index)
+
+    if verbose > 0:
+        logger.info('Computing coco scores on the %s split...' % split)
+    for metric in sorted(final_scores):
+        logger.info(metric + ': ' + str(final_scores[metric]))
+    return final_scores
+
+
+def register_metrics():
+    """
+    Adds the metrics of this module ('coco_parallel') and of utils/id_metrics.py ('bleu_ids') to keras_wrapper's
+    selectMetric (used by EvalPerformance and apply_Video_model).
+    """
+    from keras_wrapper.extra import evaluation
+    from utils.id_metrics import get_id_bleu_score
+
+    metrics = {'coco_parallel': get_coco_score,
+               'bleu_ids': get_id_bleu_score}
+    evaluation.selectMetric.update(metrics)
+    if getattr(evaluation, 'select', evaluation.selectMetric) is not evaluation.selectMetric:
+        evaluation.select.update(metrics)
@@ -0,0 +1,171 @@
+"""
+On-disk cache of beam search results.
+
+Entries are keyed on (model weights, sample inputs, search settings), so decoding the same sample with the same
+checkpoint and settings (e.g. re-running apply_Video_model, re-scoring with other metrics or re-sampling a reloaded
+model) returns the stored hypotheses and scores instead of running the search again.
+
+The cache is split in one shard per weights hash (<cache_path>/<weights_hash>.pkl). Changing the weights changes the
+hash, so the entries of previous weights are never returned again and their shards are the first to be evicted when
+the cache exceeds its maximum size.
+"""
+import cPickle as pk
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+# Search parameters that change the result of the beam search
+SEARCH_KEYS = ['beam_size', 'maxlen', 'optimized_search', 'state_below_index', 'pad_on_batch', 'temporally_linked']
+
+
+def weights_hash(keras_model):
+    """
+    Hash of all the weights of a Keras model.
+    """
+    h = hashlib.sha1()
+    for w in keras_model.get_weights():
+        w = np.ascontiguousarray(w)
+        h.update(str(w.dtype) + str(w.shape))
+        h.update(w.tostring())
+    return h.hexdigest()
+
+
+def inputs_hash(X, search_params, extra=None):
+    """
+    Hash of the inputs of a sample and the search parameters used for decoding it.
+
+    :param X: dictionary of input arrays
+    :param search_params: dictionary of search parameters (only SEARCH_KEYS are considered)
+    :param extra: additional hashable information (e.g. null/eos symbols)
+    """
+    h = hashlib.sha1()
+    for input_id in sorted(X.keys()):
+        x = np.ascontiguousarray(X[input_id])
+        h.update(input_id + str(x.dtype) + str(x.shape))
+        h.update(x.tostring())
+    h.update(str([(key, search_params.get(key)) for key in SEARCH_KEYS]))
+    h.update(str(extra))
+    return h.hexdigest()
+
+
+class DecodeCache(object):
+    """
+    Cache of decoded hypotheses and scores stored in 'cache_path', with a maximum size of 'max_size' MB.
+    """
+
+    def __init__(self, cache_path, max_size=512, verbose=1):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+        self._weights_hash = None
+        self._entries = dict()
+        self._modified = False
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+
+    def __getstate__(self):
+        """
+        Only the configuration of the cache is pickled along with the Model_Wrapper.
+        """
+        obj_dict = self.__dict__.copy()
+        obj_dict['_weights_hash'] = None
+        obj_dict['_entries'] = dict()
+        obj_dict['_modified'] = False
+        return obj_dict
+
+    def _shard_path(self, w_hash):
+        return os.path.join(self.cache_path, w_hash + '.pkl')
+
+    def set_weights(self, keras_model):
+        """
+        Selects the shard corresponding to the current weights of 'keras_model'. Must be called each time the weights
+        may have changed (e.g. before each prediction pass).
+        """
+        w_hash = weights_hash(keras_model)
+        if w_hash == self._weights_hash:
+            return
+        self.flush()
+        self._weights_hash = w_hash
+        self._entries = dict()
+        shard = self._shard_path(w_hash)
+        if os.path.isfile(shard):
+            try:
+                with open(shard, 'rb') as f:
+                    self._entries = pk.load(f)
+                os.utime(shard, None)  # mark as recently used
+            except Exception as e:
+                logger.warning('Could not load decode cache shard ' + shard + ': ' + str(e))
+        if self.verbose > 0:
+            logger.info('Decode cache: ' + str(len(self._entries)) + ' entries for weights ' + w_hash)
+
+    def get(self, key):
+        if self._weights_hash is None:
+            return None
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key, result):
+        if self._weights_hash is None:
+            return
+        self._entries[key] = result
+        self._modified = True
+
+    def flush(self):
+        """
+        Writes the current shard to disk (atomically) and applies the size-based eviction.
+        """
+        if not self._modified or self._weights_hash is None:
+            return
+        shard = self._shard_path(self._weights_hash)
+        tmp_shard = shard + '.tmp'
+        with open(tmp_shard, 'wb') as f:
+            pk.dump(self._entries, f, protocol=pk.HIGHEST_PROTOCOL)
+        os.rename(tmp_shard, shard)
+        self._modified = False
+        if self.verbose > 0:
+            logger.info('Decode cache: stored ' + str(len(self._entries)) + ' entries (' + str(self.hits) +
+                        ' hits, ' + str(self.misses) + ' misses)')
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used shards until the cache fits in 'max_size' MB. The shard of the current
+        weights is never removed.
+        """
+        shards = []
+        for filename in os.listdir(self.cache_path):
+            if filename.endswith('.pkl'):
+                path = os.path.join(self.cache_path, filename)
+                shards.append((os.path.getmtime(path), os.path.getsize(path), path))
+        total_size = sum([s[1] for s in shards])
+        current = self._shard_path(self._weights_hash) if self._weights_hash is not None else None
+        for _, size, path in sorted(shards):
+            if total_size <= self.max_size * 1024 * 1024:
+                break
+            if path == current:
+                continue
+            os.remove(path)
+            total_size -= size
+            if self.verbose > 0:
+                logger.info('Decode cache: evicted ' + path)
+
+    def invalidate(self):
+        """
+        Removes all the stored entries.
+        """
+        self._entries = dict()
+        self._modified = False
+        for filename in os.listdir(self.cache_path):
+            if filename.endswith('.pkl'):
+                os.remove(os.path.join(self.cache_path, filename))
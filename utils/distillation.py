@@ -0,0 +1,179 @@
+"""
+Knowledge distillation to a smaller and faster student captioner.
+
+With DISTILLATION, train_model trains the configured model (the student) on the captions decoded by a trained teacher
+(DISTILLATION_TEACHER_PATH, DISTILLATION_TEACHER_RELOAD) instead of the references (sequence-level distillation):
+    * The teacher decodes every training sample with beam search (DISTILLATION_BEAM_SIZE), from the same inputs the
+      student is trained on (video and reference previous description). The decoding runs in a worker process, so
+      the trainer does not load the teacher (nor its backend) and its memory is released before training.
+    * The decoded captions are cached in the teacher folder
+      (distillation_<DATASET_NAME>_<epoch|update>_<N>_beam<K>_train.txt) and reused by later student trainings.
+    * The training descriptions and state_below inputs of the dataset are replaced by the teacher captions. The
+      vocabulary and the val/test references are kept.
+The teacher and the student must be trained on the same dataset (DATASET_NAME). A typical student keeps the model
+type with fewer units: ENCODER_HIDDEN_SIZE = 0 (no LSTM encoder), BIDIRECTIONAL_ENCODER = False, smaller
+DECODER_HIDDEN_SIZE, PREV_SENT_ENCODER_HIDDEN_SIZE and TARGET_TEXT_EMBEDDING_SIZE.
+
+The speed/metric trade-off of the trained student (STORE_PATH, SAMPLING_RELOAD_POINT) against the teacher is reported
+by:
+    python -m utils.distillation [key=Value ...]
+which decodes EVAL_ON_SETS with both models (batched search, BEAM_SIZE) and writes <STORE_PATH>/<split>_distillation.csv.
+"""
+import ast
+import logging
+import multiprocessing
+import os
+import sys
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def teacher_outputs_path(params):
+    return os.path.join(params['DISTILLATION_TEACHER_PATH'], 'distillation_%s_%s%s_beam%d_train.txt' %
+                        (params['DATASET_NAME'], 'epoch_' if params.get('DISTILLATION_TEACHER_RELOAD_EPOCH', False)
+                         else 'update_', str(params['DISTILLATION_TEACHER_RELOAD']),
+                         params.get('DISTILLATION_BEAM_SIZE', 5)))
+
+
+def load_teacher(params):
+    """
+    Loads the teacher model, without the decoding extensions it may have been pickled with.
+    """
+    from keras_wrapper.cnn_model import loadModel
+
+    teacher = loadModel(params['DISTILLATION_TEACHER_PATH'], params['DISTILLATION_TEACHER_RELOAD'],
+                        reload_epoch=params.get('DISTILLATION_TEACHER_RELOAD_EPOCH', False))
+    teacher.setDecodeCache(None)
+    teacher.setShortlist(None)
+    teacher.setEnsemble(None)
+    return teacher
+
+
+def _decode_teacher(params, dataset, path):
+    """
+    Worker process: decodes the training split with the teacher and writes the captions (one per line) into path.
+    """
+    from keras_wrapper.utils import decode_predictions_beam_search
+
+    teacher = load_teacher(params)
+    vocabulary_size = dataset.vocabulary_len[params['OUTPUTS_IDS_DATASET'][0]]
+    if teacher.params.get('OUTPUT_VOCABULARY_SIZE', vocabulary_size) != vocabulary_size:
+        raise Exception('The teacher was trained with another vocabulary (%d words, the dataset has %d).' %
+                        (teacher.params['OUTPUT_VOCABULARY_SIZE'], vocabulary_size))
+    params_prediction = {'max_batch_size': params['BATCH_SIZE'],
+                         'n_parallel_loaders': params['PARALLEL_LOADERS'],
+                         'predict_on_sets': ['train'],
+                         'batched_search': True,
+                         'beam_size': params.get('DISTILLATION_BEAM_SIZE', 5),
+                         'maxlen': params['MAX_OUTPUT_TEXT_LEN'],
+                         'state_below_index': params.get('BEAM_SEARCH_COND_INPUT', -1),
+                         'optimized_search': True,
+                         'model_inputs': params['INPUTS_IDS_MODEL'],
+                         'model_outputs': params['OUTPUTS_IDS_MODEL'],
+                         'dataset_inputs': params['INPUTS_IDS_DATASET'],
+                         'dataset_outputs': params['OUTPUTS_IDS_DATASET'],
+                         'normalize_probs': params['NORMALIZE_SAMPLING'],
+                         'alpha_factor': params['ALPHA_FACTOR'],
+                         # The training samples are decoded from their reference previous descriptions
+                         'temporally_linked': False}
+    predictions = teacher.predictBeamSearchNet(dataset, params_prediction)['train']
+    vocab = dataset.vocabulary[params['OUTPUTS_IDS_DATASET'][0]]['idx2words']
+    captions = decode_predictions_beam_search(predictions, vocab, verbose=0)
+    with open(path + '.tmp', 'w') as f:
+        for caption in captions:
+            f.write(caption.encode('utf-8') if isinstance(caption, unicode) else caption)
+            f.write('\n')
+    os.rename(path + '.tmp', path)
+
+
+def distill_dataset(dataset, params):
+    """
+    Replaces the training descriptions (and state_below inputs) of the dataset by the teacher captions, decoding them
+    first if they are not cached.
+    """
+    if '-vidtext-embed' in params['DATASET_NAME']:
+        raise NotImplementedError('Distillation is only implemented for captioning models.')
+    path = teacher_outputs_path(params)
+    if not os.path.isfile(path):
+        logger.info('Decoding the training set with the teacher ' + params['DISTILLATION_TEACHER_PATH'])
+        worker = multiprocessing.Process(target=_decode_teacher, args=(params, dataset, path))
+        worker.start()
+        worker.join()
+        if worker.exitcode != 0:
+            raise Exception('The teacher decoding failed (exit code %s).' % str(worker.exitcode))
+    with open(path) as f:
+        captions = [line.rstrip('\n') for line in f]
+    if len(captions) != dataset.len_train:
+        raise Exception('The teacher captions in %s are for %d training samples, the dataset has %d. Remove the file '
+                        'for decoding them again.' % (path, len(captions), dataset.len_train))
+
+    output_id = params['OUTPUTS_IDS_DATASET'][0]
+    state_below_id = params['INPUTS_IDS_DATASET'][1]
+    references = dataset.Y_train[output_id]
+    n_changed = sum([1 for caption, reference in zip(captions, references) if caption != reference])
+    logger.info('Training on the teacher captions of %s: %d/%d differ from the references, mean length %.2f words '
+                '(references %.2f)' % (path, n_changed, len(captions),
+                                       sum([len(c.split()) for c in captions]) / float(max(len(captions), 1)),
+                                       sum([len(r.split()) for r in references]) / float(max(len(references), 1))))
+    dataset.Y_train[output_id] = captions
+    if state_below_id in dataset.X_train:
+        dataset.X_train[state_below_id] = captions
+
+
+def distillation_report(params):
+    """
+    Compares the student (STORE_PATH, SAMPLING_RELOAD_POINT) with the teacher: size, decoding speed and metrics on
+    EVAL_ON_SETS.
+    """
+    from data_engine.prepare_data import build_dataset
+    from keras_wrapper.cnn_model import loadModel
+    from utils.evaluate_shortlist import decode_and_score
+
+    dataset = build_dataset(params)
+    params['OUTPUT_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['OUTPUTS_IDS_DATASET'][0]]
+    student = loadModel(params['STORE_PATH'], params['SAMPLING_RELOAD_POINT'],
+                        reload_epoch=params['SAMPLING_RELOAD_EPOCH'])
+    student.setDecodeCache(None)
+    student.setShortlist(None)
+    student.setEnsemble(None)
+    teacher = load_teacher(params)
+
+    extra_vars = {'tokenize_f': eval('dataset.' + params['TOKENIZATION_METHOD']),
+                  'language': params.get('TRG_LAN', 'en')}
+    for s in params['EVAL_ON_SETS']:
+        extra_vars[s] = {'references': dataset.extra_variables[s][params['OUTPUTS_IDS_DATASET'][0]]}
+        rows = []
+        for name, video_model in [('teacher', teacher), ('student', student)]:
+            metrics, elapsed, _ = decode_and_score(video_model, dataset, params, s, extra_vars)
+            rows.append([name, video_model.model.count_params(), elapsed, metrics])
+        metric_names = sorted(rows[0][3])
+
+        header = ['model', 'parameters', 'sec/sample', 'speedup'] + metric_names
+        filepath = student.model_path + '/' + s + '_distillation.csv'
+        with open(filepath, 'w') as f:
+            f.write(','.join(header) + '\n')
+            for name, n_params, elapsed, metrics in rows:
+                f.write(','.join([name, str(n_params), str(elapsed), str(rows[0][2] / elapsed)] +
+                                 [str(metrics[m]) for m in metric_names]) + '\n')
+
+        print '\nDistillation trade-off on ' + s + ':'
+        print '\t'.join(header)
+        for name, n_params, elapsed, metrics in rows:
+            deltas = ['%.4f (%+.4f)' % (metrics[m], metrics[m] - rows[0][3][m]) for m in metric_names]
+            print '\t'.join([name, str(n_params), '%.4f' % elapsed, '%.2fx' % (rows[0][2] / elapsed)] + deltas)
+        logger.info('Results stored in ' + filepath)
+
+
+if __name__ == "__main__":
+    from config import load_parameters
+
+    parameters = load_parameters()
+    try:
+        for arg in sys.argv[1:]:
+            k, v = arg.split('=')
+            parameters[k] = ast.literal_eval(v)
+    except ValueError:
+        print 'Overwritten arguments must have the form key=Value'
+        exit(1)
+    distillation_report(parameters)
@@ -0,0 +1,164 @@
+"""
+Ensemble decoding.
+
+With ENSEMBLE_MODELS, 'sampling' mode decodes with the SAMPLING_RELOAD_POINT model of STORE_PATH and the listed
+checkpoints at once, instead of K separate decodes and an offline fusion. The Ensemble is used by the batched search
+(utils/batched_search.py) in place of the SearchStepper of a single model: the data are loaded once, the beams are
+shared, and at each step every model scores the alive hypotheses with its own model_init/model_next (keeping its own
+states); the beams are updated with the average of their log-probabilities. All the models must share the dataset
+vocabularies and have optimized search models.
+
+With ENSEMBLE_WORKERS, each checkpoint of ENSEMBLE_MODELS is loaded and applied in its own worker process, forked before
+any model is loaded, so the models are applied in parallel (the SAMPLING_RELOAD_POINT model runs in the main process
+meanwhile). The workers only send back the log-probabilities; the states never leave them.
+"""
+import logging
+import multiprocessing
+import traceback
+
+from utils.batched_search import SearchStepper
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def ensemble_members(params):
+    """
+    Checkpoints of ENSEMBLE_MODELS, as (model_path, reload_point). The entries can be (model_path, reload_point) pairs or
+    reload points of STORE_PATH.
+    """
+    members = []
+    for member in params.get('ENSEMBLE_MODELS', []):
+        if isinstance(member, (list, tuple)):
+            members.append((member[0], member[1]))
+        else:
+            members.append((params['STORE_PATH'], member))
+    return members
+
+
+def _search_params(params):
+    return {'model_inputs': params['model_inputs'], 'state_below_index': params['state_below_index']}
+
+
+def _ensemble_worker(model_path, reload_point, reload_epoch, max_batch_size, connection):
+    """
+    Worker process: loads a checkpoint and applies its search models on the steps received through 'connection'.
+    """
+    try:
+        from keras_wrapper.cnn_model import loadModel
+
+        model = loadModel(model_path, reload_point, reload_epoch=reload_epoch)
+        stepper = SearchStepper(model, max_batch_size=max_batch_size)
+        connection.send(('ready', None))
+        while True:
+            job = connection.recv()
+            if job is None:
+                break
+            method, args = job
+            connection.send(('result', getattr(stepper, method)(*args)))
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+class EnsembleWorker(object):
+    """
+    SearchStepper of a checkpoint running in a worker process. The steps are requested and collected separately, so
+    that several workers can run at once.
+    """
+
+    def __init__(self, model_path, reload_point, max_batch_size=50, reload_epoch=False):
+        self.name = '%s (%s)' % (model_path, reload_point)
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_ensemble_worker,
+                                               args=(model_path, reload_point, reload_epoch, max_batch_size,
+                                                     worker_connection))
+        self.process.daemon = True
+        self.process.start()
+        worker_connection.close()
+
+    def request(self, method, args):
+        self.connection.send((method, args))
+
+    def result(self):
+        while True:
+            try:
+                message, value = self.connection.recv()
+            except EOFError:
+                raise Exception('The ensemble worker of ' + self.name + ' died.')
+            if message == 'error':
+                raise Exception('Error in the ensemble worker of ' + self.name + ':\n' + value)
+            if message == 'ready':
+                continue
+            return value
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.connection.send(None)
+            except IOError:
+                pass
+            self.process.join(10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+
+class Ensemble(object):
+    """
+    Models decoded in lockstep, with the SearchStepper interface (init/next). Returns the average of the
+    log-probabilities of the models.
+    """
+
+    def __init__(self, members=None, max_batch_size=50, workers=False, reload_epoch=False):
+        """
+        :param members: checkpoints (model_path, reload_point) loaded into the ensemble
+        :param max_batch_size: maximum number of rows of each prediction
+        :param workers: load and apply each checkpoint in its own worker process
+        :param reload_epoch: the reload points are epochs (otherwise, updates)
+        """
+        self.max_batch_size = max_batch_size
+        self.steppers = []
+        self.workers = []
+        members = members or []
+        if workers:
+            for model_path, reload_point in members:
+                self.workers.append(EnsembleWorker(model_path, reload_point, max_batch_size=max_batch_size,
+                                                   reload_epoch=reload_epoch))
+        elif members:
+            from keras_wrapper.cnn_model import loadModel
+
+            for model_path, reload_point in members:
+                self.add_model(loadModel(model_path, reload_point, reload_epoch=reload_epoch))
+
+    def __len__(self):
+        return len(self.steppers) + len(self.workers)
+
+    def add_model(self, model):
+        """
+        Adds a model applied in the current process.
+        """
+        if getattr(model, 'model_init', None) is None or getattr(model, 'model_next', None) is None:
+            raise Exception('Ensemble decoding requires models with optimized search models (model_init and '
+                            'model_next).')
+        self.steppers.append(SearchStepper(model, max_batch_size=self.max_batch_size))
+
+    def init(self, X, params, state_below):
+        return self._apply('init', X, _search_params(params), state_below)
+
+    def next(self, state_below, rows):
+        return self._apply('next', state_below, rows)
+
+    def _apply(self, method, *args):
+        # The workers run while the local models are applied
+        for worker in self.workers:
+            worker.request(method, args)
+        log_probs = [getattr(stepper, method)(*args) for stepper in self.steppers]
+        log_probs += [worker.result() for worker in self.workers]
+        return sum(log_probs) / len(log_probs)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
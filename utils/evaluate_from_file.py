@@ -2,17 +2,11 @@
 Scores a file of hypothesis.
 Usage:
     1. Set the references in this file (questions and annotations).
-    2. python evaluate_vqa.py hypothesis.json
+    2. python -m utils.evaluate_from_file [-vqa] -hyp hypothesis_file [-r reference_files]
 """
 
 import argparse
 
-from pycocoevalcap.bleu.bleu import Bleu
-from pycocoevalcap.cider.cider import Cider
-from pycocoevalcap.meteor.meteor import Meteor
-from pycocoevalcap.rouge.rouge import Rouge
-from pycocoevalcap.vqa import vqaEval, visual_qa
-
 # ROOT_PATH = '/home/lvapeab/smt/tasks/image_desc/'
 ROOT_PATH = '/media/HDD_2TB/DATASETS/'
 
@@ -35,6 +29,8 @@ parser.add_argument('-r', type=argparse.FileType('r'), nargs="+",
 
 
 def score_vqa(resFile, quesFile, annFile):
+    from pycocoevalcap.vqa import vqaEval, visual_qa
+
     # create vqa object and vqaRes object
     vqa_ = visual_qa.VQA(annFile, quesFile)
     vqaRes = vqa_.loadRes(resFile, quesFile)
@@ -64,22 +60,15 @@ def CocoScore(ref, hypo, language='en'):
     ref, dictionary of reference sentences (id, sentence)
     hypo, dictionary of hypothesis sentences (id, sentence)
     score, dictionary of scores
+    The scorers are run concurrently (see utils/coco_evaluation.py).
     """
-    scorers = [
-        (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-        (Meteor(language), "METEOR"),
-        (Rouge(), "ROUGE_L"),
-        (Cider(), "CIDEr")
-    ]
-    final_scores = {}
-    for scorer, method in scorers:
-        score, scores = scorer.compute_score(ref, hypo)
-        if type(score) == list:
-            for m, s in zip(method, score):
-                final_scores[m] = s
-        else:
-            final_scores[method] = score
-    return final_scores
+    from utils.coco_evaluation import CocoEvaluator
+
+    evaluator = CocoEvaluator(language=language)
+    try:
+        return evaluator.evaluate('refs', ref, hypo)
+    finally:
+        evaluator.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+"""
+Evaluates the vocabulary shortlists (see utils/shortlist.py): metric loss vs. decoding speedup.
+
+The model defined in config.py (STORE_PATH, SAMPLING_RELOAD_POINT) is decoded with the batched search on the
+EVAL_ON_SETS splits, first with the whole vocabulary and then with each combination of SHORTLIST_FREQUENT and
+SHORTLIST_NEIGHBOURS values. The results are printed and stored in <model_path>/<split>_shortlist.csv.
+
+Usage (from the root folder of the repository):
+    python -m utils.evaluate_shortlist [SHORTLIST_FREQUENT=[100,500]] [SHORTLIST_NEIGHBOURS=[0,10]] [key=Value ...]
+"""
+import ast
+import logging
+import sys
+import time
+
+from config import load_parameters
+from data_engine.prepare_data import build_dataset
+from keras_wrapper.cnn_model import loadModel
+from keras_wrapper.extra.evaluation import selectMetric
+from keras_wrapper.utils import decode_predictions_beam_search
+from utils.coco_evaluation import register_metrics
+from utils.shortlist import Shortlist, load_shortlist_index
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def decode_and_score(video_model, dataset, params, s, extra_vars):
+    """
+    Decodes the split 's' and evaluates it on params['METRICS'].
+    :return: [metrics, seconds per sample, decoded captions]
+    """
+    params_prediction = {'max_batch_size': params['BATCH_SIZE'],
+                         'n_parallel_loaders': params['PARALLEL_LOADERS'],
+                         'predict_on_sets': [s],
+                         'batched_search': True,
+                         'beam_size': params['BEAM_SIZE'],
+                         'maxlen': params['MAX_OUTPUT_TEXT_LEN_TEST'],
+                         'state_below_index': params.get('BEAM_SEARCH_COND_INPUT', -1),
+                         'optimized_search': True,
+                         'model_inputs': params['INPUTS_IDS_MODEL'],
+                         'model_outputs': params['OUTPUTS_IDS_MODEL'],
+                         'dataset_inputs': params['INPUTS_IDS_DATASET'],
+                         'dataset_outputs': params['OUTPUTS_IDS_DATASET'],
+                         'normalize_probs': params['NORMALIZE_SAMPLING'],
+                         'alpha_factor': params['ALPHA_FACTOR'],
+                         'temporally_linked': '-linked' in params['DATASET_NAME'] and
+                                              '-upperbound' not in params['DATASET_NAME'] and
+                                              '-video' not in params['DATASET_NAME']}
+    start_time = time.time()
+    predictions = video_model.predictBeamSearchNet(dataset, params_prediction)[s]
+    elapsed = (time.time() - start_time) / len(predictions)
+    vocab = dataset.vocabulary[params['OUTPUTS_IDS_DATASET'][0]]['idx2words']
+    predictions = decode_predictions_beam_search(predictions, vocab, verbose=0)
+
+    # The metrics of this repository (METRICS = ['coco_parallel'], ['bleu_ids'])
+    register_metrics()
+    metrics = dict()
+    for metric in params['METRICS']:
+        metrics.update(selectMetric[metric](pred_list=predictions, verbose=0, extra_vars=extra_vars, split=s))
+    return metrics, elapsed, predictions
+
+
+def evaluate_shortlist(params):
+    """
+    Compares the decoding with the whole vocabulary and with the shortlist settings in params.
+    """
+    dataset = build_dataset(params)
+    params['OUTPUT_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['OUTPUTS_IDS_DATASET'][0]]
+    video_model = loadModel(params['STORE_PATH'], params['SAMPLING_RELOAD_POINT'],
+                            reload_epoch=params['SAMPLING_RELOAD_EPOCH'])
+    video_model.setOptimizer()
+    video_model.setDecodeCache(None)
+    index = load_shortlist_index(dataset, params)
+
+    frequent_values = params['SHORTLIST_FREQUENT']
+    if not isinstance(frequent_values, list):
+        frequent_values = [frequent_values]
+    neighbours_values = params['SHORTLIST_NEIGHBOURS']
+    if not isinstance(neighbours_values, list):
+        neighbours_values = [neighbours_values]
+
+    extra_vars = {'tokenize_f': eval('dataset.' + params['TOKENIZATION_METHOD']),
+                  'language': params.get('TRG_LAN', 'en')}
+    for s in params['EVAL_ON_SETS']:
+        extra_vars[s] = {'references': dataset.extra_variables[s][params['OUTPUTS_IDS_DATASET'][0]]}
+
+        video_model.setShortlist(None)
+        full_metrics, full_time, _ = decode_and_score(video_model, dataset, params, s, extra_vars)
+        metric_names = sorted(full_metrics)
+        rows = [['full', dataset.vocabulary_len[params['OUTPUTS_IDS_DATASET'][0]], full_time, 1.] +
+                [full_metrics[m] for m in metric_names]]
+
+        for n_frequent in frequent_values:
+            for n_neighbours in neighbours_values:
+                shortlist = Shortlist(index, n_frequent=n_frequent, n_neighbours=n_neighbours,
+                                      special_words=sorted(dataset.extra_words.values()))
+                video_model.setShortlist(shortlist)
+                metrics, elapsed, _ = decode_and_score(video_model, dataset, params, s, extra_vars)
+                rows.append(['frequent=%d neighbours=%d' % (n_frequent, n_neighbours), shortlist.mean_size(), elapsed,
+                             full_time / elapsed] + [metrics[m] for m in metric_names])
+        video_model.setShortlist(None)
+
+        header = ['setting', 'mean_size', 'sec/sample', 'speedup'] + metric_names
+        filepath = video_model.model_path + '/' + s + '_shortlist.csv'
+        with open(filepath, 'w') as f:
+            f.write(','.join(header) + '\n')
+            for row in rows:
+                f.write(','.join([str(v) for v in row]) + '\n')
+
+        print '\nShortlist evaluation on ' + s + ':'
+        print '\t'.join(header)
+        for row in rows:
+            deltas = ['%.4f (%+.4f)' % (v, v - full) for v, full in zip(row[4:], rows[0][4:])]
+            print '\t'.join([str(row[0]), '%.1f' % row[1], '%.4f' % row[2], '%.2fx' % row[3]] + deltas)
+        logger.info('Results stored in ' + filepath)
+
+
+if __name__ == "__main__":
+
+    parameters = load_parameters()
+    try:
+        for arg in sys.argv[1:]:
+            k, v = arg.split('=')
+            parameters[k] = ast.literal_eval(v)
+    except ValueError:
+        print 'Overwritten arguments must have the form key=Value'
+        exit(1)
+    evaluate_shortlist(parameters)
@@ -0,0 +1,251 @@
+"""
+On-disk cache of compiled Theano functions.
+
+Building the Keras graph is fast, but compiling (optimizing) the training, model_init and model_next functions takes
+minutes for the largest models, and it is repeated on every run. Here, the compiled functions are pickled the first
+time they are built and, on later runs, the stored (already optimized) function is reloaded and bound to the shared
+variables (weights, optimizer state) of the new model, instead of compiling it again.
+
+Entries are keyed on:
+    * MODEL_TYPE and the parameters that define the graph (GRAPH_PARAMS)
+    * the name and shape of every shared variable used by the function
+    * the Keras and Theano versions and the Theano flags that change the compiled code (floatX, device, optimizer)
+Any change in them gives a new key (<cache_path>/<key>/<function>.pkl), so stale functions are never reused.
+Entries that cannot be loaded or bound are removed and compiled again. clear_function_cache removes them all.
+"""
+import cPickle as pk
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+
+import keras
+import keras.backend as K
+
+from utils import profiling
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+# Parameters that change the structure of the graphs built in viddesc_model.py or of the training function
+GRAPH_PARAMS = ['RNN_TYPE', 'IMG_FEAT_SIZE', 'NUM_FRAMES', 'OUTPUT_VOCABULARY_SIZE', 'TARGET_TEXT_EMBEDDING_SIZE',
+                'TRG_PRETRAINED_VECTORS_TRAINABLE', 'ENCODER_HIDDEN_SIZE', 'BIDIRECTIONAL_ENCODER', 'N_LAYERS_ENCODER',
+                'BIDIRECTIONAL_DEEP_ENCODER', 'PREV_SENT_ENCODER_HIDDEN_SIZE', 'BIDIRECTIONAL_PREV_SENT_ENCODER',
+                'N_LAYERS_PREV_SENT_ENCODER', 'BIDIRECTIONAL_DEEP_PREV_SENT_ENCODER', 'DECODER_HIDDEN_SIZE',
+                'IMG_EMBEDDING_LAYERS', 'INIT_LAYERS', 'SKIP_VECTORS_HIDDEN_SIZE', 'AFFINE_LAYERS_DIM',
+                'ADDITIONAL_OUTPUT_MERGE_MODE', 'WEIGHTED_MERGE', 'DEEP_OUTPUT_LAYERS', 'CLASSIFIER_ACTIVATION',
+                'WEIGHT_DECAY', 'RECURRENT_WEIGHT_DECAY', 'USE_DROPOUT', 'DROPOUT_P', 'USE_RECURRENT_DROPOUT',
+                'RECURRENT_DROPOUT_P', 'USE_NOISE', 'NOISE_AMOUNT', 'USE_BATCH_NORMALIZATION',
+                'BATCH_NORMALIZATION_MODE', 'USE_PRELU', 'USE_L1', 'USE_L2', 'BEAM_SEARCH', 'OPTIMIZED_SEARCH',
+                'INPUTS_IDS_MODEL', 'OUTPUTS_IDS_MODEL', 'OPTIMIZER', 'LOSS', 'CLIP_C', 'CLIP_V', 'SAMPLE_WEIGHTS']
+
+
+def _backend_description():
+    import theano
+    return {'keras': keras.__version__,
+            'theano': theano.__version__,
+            'floatX': theano.config.floatX,
+            'device': theano.config.device,
+            'optimizer': theano.config.optimizer}
+
+
+def _shared_variables(outputs, updates, name_prefix):
+    """
+    Shared variables used by a function, in graph order. Unnamed ones (optimizer state, random streams) are given
+    names from their position, which is the same every time the same graph is built.
+    """
+    from theano.compile import SharedVariable
+    from theano.gof.graph import inputs as graph_inputs
+
+    variables = []
+    for v in graph_inputs(list(outputs) + [nv for _, nv in updates] + [v for v, _ in updates]):
+        if isinstance(v, SharedVariable) and v not in variables:
+            variables.append(v)
+    for i, v in enumerate(variables):
+        if v.name is None:
+            v.name = name_prefix + '_shared_' + str(i)
+    return variables
+
+
+class _CachedFunction(object):
+    """
+    Same interface as the Keras (Theano backend) Function.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, inputs):
+        assert isinstance(inputs, (list, tuple))
+        return self.function(*inputs)
+
+
+class FunctionCache(object):
+    """
+    Stores and reloads the compiled functions of the Keras models of a Model_Wrapper (see install).
+    """
+
+    def __init__(self, cache_path, params, verbose=1):
+        """
+        :param cache_path: folder of the cache
+        :param params: model parameters (see config.py)
+        :param verbose: verbosity level
+        """
+        self.cache_path = cache_path
+        self.model_type = params['MODEL_TYPE']
+        self.graph_params = dict([(key, params.get(key)) for key in GRAPH_PARAMS])
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+
+    def key(self, shared_variables):
+        """
+        Key of a function using the given shared variables.
+        """
+        description = {'model_type': self.model_type,
+                       'params': self.graph_params,
+                       'backend': _backend_description(),
+                       'variables': [[v.name, list(v.get_value(borrow=True).shape)] for v in shared_variables]}
+        return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest(), description
+
+    def install(self, model_wrapper):
+        """
+        Makes the training/test/prediction functions of model_wrapper.model and the prediction functions of
+        model_init and model_next go through the cache. They are still built lazily by Keras, when first needed.
+        """
+        wrap_function_builders(model_wrapper)
+        for model_name in ['model', 'model_init', 'model_next']:
+            keras_model = getattr(model_wrapper, model_name, None)
+            if keras_model is not None:
+                keras_model._function_cache = self
+
+    def function_builder(self, function_name, builder):
+        """
+        Replacement of K.function that reloads the function from the cache, or builds it with 'builder' and stores it.
+        """
+
+        def function(inputs, outputs, updates=[], **kwargs):
+            shared_variables = _shared_variables(outputs, updates, function_name)
+            names = [v.name for v in shared_variables]
+            if len(set(names)) < len(names):
+                logger.warning('Function ' + function_name + ' has shared variables with repeated names. '
+                                                             'It will not be cached.')
+                return builder(inputs, outputs, updates=updates, **kwargs)
+
+            key, description = self.key(shared_variables)
+            entry_path = os.path.join(self.cache_path, key)
+            filepath = os.path.join(entry_path, function_name + '.pkl')
+            if os.path.isfile(filepath):
+                try:
+                    f = self._load(filepath, shared_variables)
+                    self.hits += 1
+                    if self.verbose > 0:
+                        logger.info('Loaded compiled function ' + function_name + ' from ' + filepath)
+                    return f
+                except Exception as e:
+                    logger.warning('Removing unusable cached function ' + filepath + ': ' + str(e))
+                    os.remove(filepath)
+
+            f = builder(inputs, outputs, updates=updates, **kwargs)
+            self.misses += 1
+            try:
+                self._store(entry_path, filepath, f.function, description)
+                if self.verbose > 0:
+                    logger.info('Stored compiled function ' + function_name + ' in ' + filepath)
+            except Exception as e:
+                logger.warning('Could not store the compiled function ' + function_name + ': ' + str(e))
+            return f
+
+        return function
+
+    @staticmethod
+    def _load(filepath, shared_variables):
+        """
+        Loads a pickled function and binds it to the given shared variables (matched by name).
+        """
+        from theano.compile import SharedVariable
+
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, 100000))
+        try:
+            with open(filepath, 'rb') as f:
+                function = pk.load(f)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+        by_name = dict([(v.name, v) for v in shared_variables])
+        swap = dict()
+        for function_input in function.maker.inputs:
+            v = function_input.variable
+            if isinstance(v, SharedVariable):
+                if v.name not in by_name:
+                    raise Exception('shared variable ' + str(v.name) + ' is not used by the new graph')
+                swap[v] = by_name[v.name]
+        return _CachedFunction(function.copy(swap=swap))
+
+    @staticmethod
+    def _store(entry_path, filepath, function, description):
+        if not os.path.isdir(entry_path):
+            os.makedirs(entry_path)
+        with open(os.path.join(entry_path, 'key.json'), 'w') as f:
+            json.dump(description, f, indent=1, sort_keys=True)
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, 100000))
+        try:
+            with open(filepath + '.tmp', 'wb') as f:
+                pk.dump(function, f, protocol=pk.HIGHEST_PROTOCOL)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+        os.rename(filepath + '.tmp', filepath)
+
+
+def wrap_function_builders(model_wrapper):
+    """
+    Makes the lazy building of the functions of model_wrapper.model, model_init and model_next (compiled by Theano on
+    the first fit/predict) go through the FunctionCache of each Keras model, if set, and times it as the profiling
+    scope 'compile[<model>_<role>]'.
+    """
+    for model_name in ['model', 'model_init', 'model_next']:
+        keras_model = getattr(model_wrapper, model_name, None)
+        if keras_model is None:
+            continue
+        roles = ['train', 'test', 'predict'] if model_name == 'model' else ['predict']
+        for role in roles:
+            _wrap(keras_model, role, model_name + '_' + role)
+
+
+def _wrap(keras_model, role, function_name):
+    method_name = '_make_' + role + '_function'
+    if getattr(keras_model, '_uncached' + method_name, None) is not None:
+        return
+    original = getattr(keras_model, method_name)
+
+    def make_function():
+        if getattr(keras_model, role + '_function', None) is not None:
+            return original()
+        with profiling.scope('compile[' + function_name + ']'):
+            cache = getattr(keras_model, '_function_cache', None)
+            if cache is None:
+                return original()
+            builder = K.function
+            K.function = cache.function_builder(function_name, builder)
+            try:
+                return original()
+            finally:
+                K.function = builder
+
+    setattr(keras_model, '_uncached' + method_name, original)
+    setattr(keras_model, method_name, make_function)
+
+
+def clear_function_cache(cache_path):
+    """
+    Removes all the stored functions.
+    """
+    if os.path.isdir(cache_path):
+        shutil.rmtree(cache_path)
+        logger.info('Removed the compiled function cache ' + cache_path)
@@ -0,0 +1,249 @@
+"""
+Vectorized corpus BLEU-1..4 and ROUGE_L on token ids.
+
+The coco metrics count n-grams of strings in pure Python, which makes frequent evaluations (EVAL_EACH updates) and
+early stopping on Bleu_4 expensive. Here, every token of the references of a split is given an integer id once, and:
+    * BLEU: the n-grams of id arrays are encoded as int64 keys (base len(vocabulary) + 1 digits, so that different
+      n-grams always get different keys) and counted, clipped and summed with sorting based NumPy operations. The
+      reference side (clipped counts per sample, reference lengths) is computed once per split.
+    * ROUGE_L: the longest common subsequences of all the (hypothesis, reference) pairs are computed at once by a
+      dynamic programming over padded id matrices.
+Hypothesis tokens that do not appear in the references never match, so all of them share the same id. The scores are
+the same as those of pycocoevalcap (Bleu with 'closest' reference length and Rouge).
+
+Usage: register_metrics() (utils/coco_evaluation.py) adds the 'bleu_ids' metric to keras_wrapper's selectMetric,
+e.g. METRICS = ['bleu_ids'] and STOP_METRIC = 'Bleu_4'.
+"""
+import logging
+import math
+
+import numpy as np
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+UNKNOWN = 0  # Id of the hypothesis tokens that are not in the references
+LENGTH_PAD = 10 ** 9
+
+
+def flatten(sentences):
+    """
+    Concatenates a list of id arrays.
+    :return: (concatenated ids, index of the sentence of each id)
+    """
+    lengths = np.asarray([len(s) for s in sentences], dtype='int64')
+    if lengths.sum() == 0:
+        return np.zeros((0,), dtype='int64'), np.zeros((0,), dtype='int64')
+    tokens = np.concatenate([np.asarray(s, dtype='int64') for s in sentences])
+    owners = np.repeat(np.arange(len(sentences), dtype='int64'), lengths)
+    return tokens, owners
+
+
+def ngram_keys(tokens, owners, k, base):
+    """
+    int64 keys of all the k-grams of the concatenated sentences (the k-grams do not cross sentence boundaries).
+    :return: (keys, index of the sentence of each k-gram)
+    """
+    n_starts = len(tokens) - k + 1
+    if n_starts <= 0:
+        return np.zeros((0,), dtype='int64'), np.zeros((0,), dtype='int64')
+    valid = owners[:n_starts] == owners[k - 1:]
+    keys = np.zeros((n_starts,), dtype='int64')
+    for j in range(k):
+        keys = keys * base + tokens[j:j + n_starts]
+    return keys[valid], owners[:n_starts][valid]
+
+
+def pad(sentences, value):
+    """
+    (n_sentences, max_length) matrix of id arrays, padded with value.
+    """
+    matrix = np.full((len(sentences), max([len(s) for s in sentences] + [1])), value, dtype='int64')
+    for i, s in enumerate(sentences):
+        matrix[i, :len(s)] = s
+    return matrix
+
+
+def lcs_lengths(a, b):
+    """
+    Lengths of the longest common subsequences of the rows of two padded id matrices (with different pad values).
+    """
+    previous = np.zeros((a.shape[0], b.shape[1] + 1), dtype='int64')
+    for i in range(a.shape[1]):
+        current = np.zeros_like(previous)
+        for j in range(b.shape[1]):
+            current[:, j + 1] = np.where(a[:, i] == b[:, j], previous[:, j] + 1,
+                                         np.maximum(previous[:, j + 1], current[:, j]))
+        previous = current
+    return previous[:, -1]
+
+
+class IdScorer(object):
+    """
+    BLEU-1..4 and ROUGE_L of the hypotheses of a split, with the reference side computed once.
+    """
+
+    def __init__(self, refs, n=4, beta=1.2):
+        """
+        :param refs: dictionary of references (id, [sentences])
+        :param n: maximum n-gram order of BLEU
+        :param beta: ROUGE_L recall weight
+        """
+        self.references = refs
+        self.n = n
+        self.beta = beta
+        self.ids = sorted(refs)
+        self.token_ids = dict()
+
+        # BLEU: whitespace tokens. ROUGE_L: tokens separated by single spaces (as pycocoevalcap)
+        bleu_refs = [[self.encode(r.split(), add=True) for r in refs[idx]] for idx in self.ids]
+        rouge_refs = [[self.encode(r.split(' '), add=True) for r in refs[idx]] for idx in self.ids]
+        self.base = len(self.token_ids) + 1
+        if float(self.base) ** n >= 2. ** 63:
+            raise ValueError('Too many distinct tokens (%d) for int64 %d-gram keys' % (self.base - 1, n))
+
+        # Reference lengths, padded so that they are never the closest one
+        self.ref_lengths = pad([[len(r) for r in sample_refs] for sample_refs in bleu_refs], LENGTH_PAD)
+
+        # Maximum count of every reference n-gram in each sample: sorted (sample, n-gram rank) codes
+        all_refs = [r for sample_refs in bleu_refs for r in sample_refs]
+        ref_sample = np.repeat(np.arange(len(bleu_refs), dtype='int64'), [len(r) for r in bleu_refs])
+        tokens, owners = flatten(all_refs)
+        self.ref_keys = []
+        self.ref_codes = []
+        self.ref_max_counts = []
+        for k in range(1, n + 1):
+            keys, ref_index = ngram_keys(tokens, owners, k, self.base)
+            unique_keys, ranks = np.unique(keys, return_inverse=True)
+            codes, counts = np.unique(ref_index * len(unique_keys) + ranks, return_counts=True)
+            sample_codes = ref_sample[codes // len(unique_keys)] * len(unique_keys) + codes % len(unique_keys)
+            order = np.argsort(sample_codes, kind='mergesort')
+            sample_codes = sample_codes[order]
+            counts = counts[order]
+            starts = np.flatnonzero(np.concatenate([[True], sample_codes[1:] != sample_codes[:-1]])) \
+                if len(sample_codes) > 0 else np.zeros((0,), dtype='int64')
+            self.ref_keys.append(unique_keys)
+            self.ref_codes.append(sample_codes[starts])
+            self.ref_max_counts.append(np.maximum.reduceat(counts, starts) if len(starts) > 0 else counts)
+
+        # ROUGE_L: one row per (sample, reference) pair
+        self.pair_sample = np.repeat(np.arange(len(rouge_refs), dtype='int64'), [len(r) for r in rouge_refs])
+        self.pair_starts = np.concatenate([[0], np.cumsum([len(r) for r in rouge_refs])[:-1]]).astype('int64')
+        pair_refs = [r for sample_refs in rouge_refs for r in sample_refs]
+        self.pair_refs = pad(pair_refs, -2)
+        self.pair_ref_lengths = np.asarray([len(r) for r in pair_refs], dtype='float64')
+
+    def encode(self, words, add=False):
+        """
+        Ids of a list of tokens. Unknown tokens get a new id if add, else UNKNOWN.
+        """
+        if add:
+            for w in words:
+                if w not in self.token_ids:
+                    self.token_ids[w] = len(self.token_ids) + 1
+        return np.asarray([self.token_ids.get(w, UNKNOWN) for w in words], dtype='int64')
+
+    def bleu(self, hypotheses):
+        """
+        Corpus BLEU-1..4 of the hypotheses (list of id arrays, in the order of sorted reference ids).
+        """
+        n = self.n
+        lengths = np.asarray([len(h) for h in hypotheses], dtype='int64')
+        distances = np.abs(self.ref_lengths - lengths[:, None])
+        closest = distances.min(axis=1)
+        reflen = np.where(distances == closest[:, None], self.ref_lengths, LENGTH_PAD).min(axis=1)
+
+        tokens, owners = flatten(hypotheses)
+        guess = []
+        correct = []
+        for k in range(1, n + 1):
+            guess.append(int(np.maximum(0, lengths - k + 1).sum()))
+            keys, sample = ngram_keys(tokens, owners, k, self.base)
+            unique_keys = self.ref_keys[k - 1]
+            ref_codes = self.ref_codes[k - 1]
+            if len(unique_keys) == 0 or len(keys) == 0:
+                correct.append(0)
+                continue
+            ranks = np.minimum(np.searchsorted(unique_keys, keys), len(unique_keys) - 1)
+            found = unique_keys[ranks] == keys
+            codes, counts = np.unique(sample[found] * len(unique_keys) + ranks[found], return_counts=True)
+            positions = np.minimum(np.searchsorted(ref_codes, codes), len(ref_codes) - 1)
+            matched = ref_codes[positions] == codes
+            correct.append(int(np.minimum(counts[matched], self.ref_max_counts[k - 1][positions[matched]]).sum()))
+
+        # Same operations as pycocoevalcap's BleuScorer.compute_score
+        small = 1e-9
+        tiny = 1e-15
+        testlen = int(lengths.sum())
+        total_reflen = int(reflen.sum())
+        bleus = []
+        bleu = 1.
+        for k in range(n):
+            bleu *= float(correct[k] + tiny) / (guess[k] + small)
+            bleus.append(bleu ** (1. / (k + 1)))
+        ratio = (testlen + tiny) / (total_reflen + small)
+        if ratio < 1:
+            for k in range(n):
+                bleus[k] *= math.exp(1 - 1 / ratio)
+        return [float(b) for b in bleus]
+
+    def rouge(self, hypotheses):
+        """
+        Mean ROUGE_L of the hypotheses (list of id arrays, in the order of sorted reference ids).
+        """
+        candidates = pad(hypotheses, -3)[self.pair_sample]
+        lcs = lcs_lengths(self.pair_refs, candidates).astype('float64')
+        prec = lcs / np.asarray([len(h) for h in hypotheses], dtype='float64')[self.pair_sample]
+        rec = lcs / self.pair_ref_lengths
+        prec_max = np.maximum.reduceat(prec, self.pair_starts)
+        rec_max = np.maximum.reduceat(rec, self.pair_starts)
+        valid = (prec_max != 0) & (rec_max != 0)
+        scores = np.zeros_like(prec_max)
+        scores[valid] = ((1 + self.beta ** 2) * prec_max[valid] * rec_max[valid]) / \
+                        (rec_max[valid] + self.beta ** 2 * prec_max[valid])
+        return float(np.mean(scores))
+
+    def score(self, hypo):
+        """
+        :param hypo: dictionary of hypotheses (id, sentence)
+        :return: dictionary with the Bleu_1..4 and ROUGE_L scores
+        """
+        bleu = self.bleu([self.encode(hypo[idx].split()) for idx in self.ids])
+        rouge = self.rouge([self.encode(hypo[idx].split(' ')) for idx in self.ids])
+        scores = dict([('Bleu_' + str(k + 1), bleu[k]) for k in range(self.n)])
+        scores['ROUGE_L'] = rouge
+        return scores
+
+
+_scorers = dict()
+
+
+def get_id_bleu_score(pred_list, verbose, extra_vars, split):
+    """
+    BLEU-1..4 and ROUGE_L, computed on token ids (same scores as the 'coco' metric).
+    :param pred_list: list of hypothesis sentences
+    :param verbose: if greater than 0 the metric measures are printed out
+    :param extra_vars: extra variables, here are:
+            extra_vars[split]['references'] - dict mapping sample indices to list with all valid captions
+            extra_vars['tokenize_f'] - tokenization function used during model training
+            extra_vars['tokenize_hypotheses'] - whether to tokenize or not the hypotheses
+    :param split: split on which we are evaluating
+    :return: Dictionary with the scores
+    """
+    refs = extra_vars[split]['references']
+    scorer = _scorers.get(split)
+    if scorer is None or scorer.references is not refs:
+        scorer = IdScorer(refs)
+        _scorers[split] = scorer
+
+    if extra_vars.get('tokenize_hypotheses', False):
+        hypo = dict([(idx, extra_vars['tokenize_f'](lines.strip())) for (idx, lines) in enumerate(pred_list)])
+    else:
+        hypo = dict([(idx, lines.strip()) for (idx, lines) in enumerate(pred_list)])
+    final_scores = scorer.score(hypo)
+
+    if verbose > 0:
+        logger.info('Computing BLEU and ROUGE_L scores on the %s split...' % split)
+    for metric in sorted(final_scores):
+        logger.info(metric + ': ' + str(final_scores[metric]))
+    return final_scores
@@ -0,0 +1,64 @@
+"""
+Import-time profiler for the entry points (main.py --profile-startup).
+
+Wraps the builtin __import__ and records, for every module imported for the first time, the time spent importing it
+(including its own imports) and the module that imported it. The report is printed as a tree:
+    cumulative ms  self ms  module
+"""
+import __builtin__
+import sys
+from timeit import default_timer as timer
+
+
+class ImportProfiler(object):
+
+    def __init__(self):
+        self.original_import = None
+        self.records = []  # [name, depth, cumulative seconds, self seconds]
+        self.stack = []
+        self.start_time = None
+
+    def install(self):
+        self.original_import = __builtin__.__import__
+        self.start_time = timer()
+        __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        if self.original_import is not None:
+            __builtin__.__import__ = self.original_import
+            self.original_import = None
+
+    def _import(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self.original_import(name, *args, **kwargs)
+        record = [name, len(self.stack), 0., 0.]
+        self.records.append(record)
+        self.stack.append(0.)
+        start_time = timer()
+        try:
+            return self.original_import(name, *args, **kwargs)
+        finally:
+            elapsed = timer() - start_time
+            children = self.stack.pop()
+            record[2] = elapsed
+            record[3] = elapsed - children
+            if len(self.stack) > 0:
+                self.stack[-1] += elapsed
+
+    def report(self, min_ms=1., stream=sys.stdout):
+        """
+        Prints the import tree, hiding the modules (and their imports) that took less than min_ms milliseconds.
+        """
+        total = sum([r[2] for r in self.records if r[1] == 0])
+        stream.write('Import times (%.1f ms in imports, %.1f ms since start):\n' %
+                     (1000 * total, 1000 * (timer() - self.start_time)))
+        stream.write('%10s %10s  %s\n' % ('cumul. ms', 'self ms', 'module'))
+        hidden_depth = None
+        for name, depth, cumulative, own in self.records:
+            if hidden_depth is not None and depth > hidden_depth:
+                continue
+            hidden_depth = None
+            if 1000 * cumulative < min_ms:
+                hidden_depth = depth
+                continue
+            stream.write('%10.1f %10.1f  %s%s\n' % (1000 * cumulative, 1000 * own, '  ' * depth, name))
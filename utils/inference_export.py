@@ -0,0 +1,228 @@
+"""
+Compact inference-only export of a trained VideoDesc_Model.
+
+The exported model only contains what is needed for decoding with the optimized search: the structures of model_init
+and model_next, the identifiers and matchings of their inputs/outputs, the model parameters and the weights of their
+layers. Weight matrices can be stored as float32, float16 or int8 (symmetric quantization with one scale per weight
+tensor); vectors (biases, normalization statistics) are always kept as float32. The export is a folder with:
+    * model.json: structures, identifiers, parameters and the description (key, dtype, scale, name) of each weight
+    * weights.npz: the stored weights
+
+load_inference_model only needs NumPy. The loaded weights can be set back into a VideoDesc_Model (set_inference_weights)
+for comparing the quantized model against the float one, or run without Keras with the NumPy engine of
+utils/numpy_inference.py.
+
+Export and accuracy report (from the root folder of the repository):
+    python -m utils.inference_export [EXPORT_QUANTIZATION='int8'] [EXPORT_PATH='...'] [key=Value ...]
+"""
+import ast
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_TYPES = ['float32', 'float16', 'int8']
+
+# Attributes of the model required by the optimized search
+SEARCH_ATTRIBUTES = ['ids_inputs', 'ids_outputs', 'ids_inputs_init', 'ids_outputs_init', 'ids_inputs_next',
+                     'ids_outputs_next', 'matchings_init_to_next', 'matchings_next_to_next',
+                     'ids_temporally_linked_inputs', 'matchings_sample_to_next_sample']
+
+
+def quantize(w, quantization='int8'):
+    """
+    Quantizes a weight tensor. Only tensors with 2 or more dimensions are quantized.
+
+    :param w: weight tensor
+    :param quantization: one of QUANTIZATION_TYPES
+    :return: [stored tensor, scale] (scale is None if the tensor is not scaled)
+    """
+    if quantization not in QUANTIZATION_TYPES:
+        raise ValueError('Unknown quantization "' + str(quantization) + '". Valid types: ' + str(QUANTIZATION_TYPES))
+    w = np.asarray(w, dtype='float32')
+    if w.ndim < 2 or quantization == 'float32':
+        return w, None
+    if quantization == 'float16':
+        return w.astype('float16'), None
+    if quantization == 'int8':
+        scale = float(np.abs(w).max()) / 127.
+        if scale == 0.:
+            return np.zeros(w.shape, dtype='int8'), 1.
+        return np.clip(np.round(w / scale), -127, 127).astype('int8'), scale
+
+
+def dequantize(q, scale=None):
+    """
+    Recovers a float32 weight tensor from its stored version.
+    """
+    if scale is None:
+        return np.asarray(q, dtype='float32')
+    return q.astype('float32') * np.float32(scale)
+
+
+def _jsonable(params):
+    jsonable = dict()
+    for key, value in params.iteritems():
+        try:
+            json.dumps(value)
+            jsonable[key] = value
+        except (TypeError, ValueError):
+            pass
+    return jsonable
+
+
+def export_inference_model(video_model, path, quantization='int8'):
+    """
+    Exports the model_init and model_next graphs of a trained model.
+
+    :param video_model: VideoDesc_Model built with OPTIMIZED_SEARCH
+    :param path: destination folder
+    :param quantization: one of QUANTIZATION_TYPES
+    :return: size of the stored weights (in bytes)
+    """
+    if getattr(video_model, 'model_init', None) is None or getattr(video_model, 'model_next', None) is None:
+        raise Exception('Only models built with BEAM_SEARCH and OPTIMIZED_SEARCH can be exported.')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    layers = []
+    for layer in video_model.model_init.layers + video_model.model_next.layers:
+        if layer.name not in [l.name for l in layers]:
+            layers.append(layer)
+
+    arrays = dict()
+    layers_meta = []
+    for layer in layers:
+        weights_meta = []
+        names = [getattr(w, 'name', None) for w in layer.weights]
+        for i, w in enumerate(layer.get_weights()):
+            key = layer.name + '/' + str(i)
+            arrays[key], scale = quantize(w, quantization)
+            weights_meta.append({'key': key, 'dtype': str(arrays[key].dtype), 'scale': scale,
+                                 'name': names[i] if i < len(names) else None})
+        layers_meta.append({'name': layer.name, 'class_name': layer.__class__.__name__, 'weights': weights_meta})
+
+    meta = {'model_type': video_model._model_type,
+            'quantization': quantization,
+            'params': _jsonable(video_model.params),
+            'model_init': json.loads(video_model.model_init.to_json()),
+            'model_next': json.loads(video_model.model_next.to_json()),
+            'layers': layers_meta}
+    for attribute in SEARCH_ATTRIBUTES:
+        if hasattr(video_model, attribute):
+            meta[attribute] = getattr(video_model, attribute)
+
+    with open(os.path.join(path, 'model.json'), 'w') as f:
+        json.dump(meta, f)
+    np.savez(os.path.join(path, 'weights.npz'), **arrays)
+    size = os.path.getsize(os.path.join(path, 'weights.npz'))
+    logger.info('Exported ' + quantization + ' inference model to ' + path + ' (' + str(size) + ' bytes of weights)')
+    return size
+
+
+def load_inference_model(path):
+    """
+    Loads an exported model.
+
+    :param path: folder of the exported model
+    :return: [meta, weights], where weights is an (ordered) list of [layer_name, list of float32 weights]
+    """
+    with open(os.path.join(path, 'model.json'), 'r') as f:
+        meta = json.load(f)
+    arrays = np.load(os.path.join(path, 'weights.npz'))
+    weights = []
+    for layer_meta in meta['layers']:
+        weights.append([layer_meta['name'],
+                        [dequantize(arrays[w['key']], w['scale']) for w in layer_meta['weights']]])
+    return meta, weights
+
+
+def set_inference_weights(video_model, weights):
+    """
+    Sets the weights of a loaded export into the (shared) layers of model_init and model_next.
+    """
+    for layer_name, layer_weights in weights:
+        try:
+            layer = video_model.model_next.get_layer(layer_name)
+        except Exception:
+            layer = video_model.model_init.get_layer(layer_name)
+        layer.set_weights(layer_weights)
+
+
+def checkpoint_size(params):
+    """
+    Size (in bytes) of the stored files of the checkpoint given by SAMPLING_RELOAD_POINT.
+    """
+    prefix = ('epoch_' if params['SAMPLING_RELOAD_EPOCH'] else 'update_') + str(params['SAMPLING_RELOAD_POINT'])
+    return sum([os.path.getsize(os.path.join(params['STORE_PATH'], f)) for f in os.listdir(params['STORE_PATH'])
+                if f.startswith(prefix + '_')])
+
+
+def export_and_report(params):
+    """
+    Exports the model given by STORE_PATH/SAMPLING_RELOAD_POINT and reports its accuracy against the float model
+    on the EVAL_ON_SETS splits.
+    """
+    from data_engine.prepare_data import build_dataset
+    from keras_wrapper.cnn_model import loadModel
+    from utils.evaluate_shortlist import decode_and_score
+
+    quantization = params.get('EXPORT_QUANTIZATION', 'int8')
+    export_path = params.get('EXPORT_PATH') or os.path.join(params['STORE_PATH'], 'inference_' + quantization)
+
+    dataset = build_dataset(params)
+    params['OUTPUT_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['OUTPUTS_IDS_DATASET'][0]]
+    video_model = loadModel(params['STORE_PATH'], params['SAMPLING_RELOAD_POINT'],
+                            reload_epoch=params['SAMPLING_RELOAD_EPOCH'])
+    video_model.setOptimizer()
+    video_model.setDecodeCache(None)
+    export_size = export_inference_model(video_model, export_path, quantization=quantization)
+
+    float_weights = [[layer.name, layer.get_weights()] for layer in video_model.model_next.layers +
+                     video_model.model_init.layers]
+    _, exported_weights = load_inference_model(export_path)
+    extra_vars = {'tokenize_f': eval('dataset.' + params['TOKENIZATION_METHOD']),
+                  'language': params.get('TRG_LAN', 'en')}
+
+    report = [['checkpoint size (MB)', checkpoint_size(params) / 1024. ** 2, export_size / 1024. ** 2]]
+    for s in params['EVAL_ON_SETS']:
+        extra_vars[s] = {'references': dataset.extra_variables[s][params['OUTPUTS_IDS_DATASET'][0]]}
+        set_inference_weights(video_model, float_weights)
+        float_metrics, float_time, float_preds = decode_and_score(video_model, dataset, params, s, extra_vars)
+        set_inference_weights(video_model, exported_weights)
+        metrics, elapsed, preds = decode_and_score(video_model, dataset, params, s, extra_vars)
+        for metric in sorted(float_metrics):
+            report.append([s + ' ' + metric, float_metrics[metric], metrics[metric]])
+        report.append([s + ' identical captions (%)', 100.,
+                       100. * np.mean([p == q for p, q in zip(float_preds, preds)])])
+    set_inference_weights(video_model, float_weights)
+
+    filepath = os.path.join(export_path, 'report.csv')
+    with open(filepath, 'w') as f:
+        f.write('measure,float32,' + quantization + '\n')
+        for row in report:
+            f.write(','.join([str(v) for v in row]) + '\n')
+    print '\nExported model: ' + export_path
+    print 'measure\tfloat32\t' + quantization
+    for row in report:
+        print '%s\t%.4f\t%.4f' % tuple(row)
+    logger.info('Report stored in ' + filepath)
+
+
+if __name__ == "__main__":
+    from config import load_parameters
+
+    parameters = load_parameters()
+    try:
+        for arg in sys.argv[1:]:
+            k, v = arg.split('=')
+            parameters[k] = ast.literal_eval(v)
+    except ValueError:
+        print 'Overwritten arguments must have the form key=Value'
+        exit(1)
+    export_and_report(parameters)
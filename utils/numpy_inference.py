@@ -0,0 +1,564 @@
+"""
+Pure-NumPy inference engine for the models exported with utils/inference_export.py.
+
+The exported structures of model_init and model_next (Keras 1 functional JSON) are interpreted node by node, with the
+exported weights, so decoding needs neither Theano/Keras nor any graph compilation. The engine exposes model_init,
+model_next (with predict_on_batch) and the identifiers/matchings of the search, so it can be directly used by the
+batched search:
+    engine = NumpyInferenceModel('trained_models/.../inference_float32')
+    batched_beam_search(engine, X, params)
+
+Supported layers: InputLayer, Embedding (mask_zero), Dense, MaxoutDense, TimeDistributed, Activation, Merge, Lambda
+(the ones built in viddesc_model.py: lambda_mean, lambda_broadcast, L1/L2 normalizations), Dropout, GaussianNoise,
+BatchNormalization, PReLU, PermuteGeneral, LSTM, GRU, Bidirectional, AttLSTMCond and AttLSTMCond2Inputs/3Inputs
+(attending on all the contexts). Any other layer raises a NotImplementedError when the engine is built.
+
+The weights of each layer are identified by the suffix of their names (e.g. 'decoder_AttLSTMCond_Wa'), which are
+stored by the export. Exports without weight names can only be used for the layers with a known weights order.
+
+Check against the Keras models of a trained checkpoint (from the root folder of the repository):
+    python -m utils.numpy_inference [EXPORT_QUANTIZATION='float32'] [key=Value ...]
+"""
+import ast
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+from utils.inference_export import load_inference_model
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def _softmax(x, axis=-1):
+    e = np.exp(x - x.max(axis=axis, keepdims=True))
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+ACTIVATIONS = {'linear': lambda x: x,
+               'tanh': np.tanh,
+               'sigmoid': _sigmoid,
+               'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0., 1.),
+               'relu': lambda x: np.maximum(x, 0.),
+               'softmax': _softmax,
+               'softplus': lambda x: np.log1p(np.exp(x)),
+               'softsign': lambda x: x / (1. + np.abs(x)),
+               'elu': lambda x: np.where(x > 0, x, np.exp(x) - 1.)}
+
+# Order of the weights of the layers that can be used without weight names
+WEIGHTS_ORDER = {'Dense': ['W', 'b'],
+                 'MaxoutDense': ['W', 'b'],
+                 'Embedding': ['W'],
+                 'BatchNormalization': ['gamma', 'beta', 'running_mean', 'running_std'],
+                 'PReLU': ['alphas'],
+                 'ChannelWisePReLU': ['alphas'],
+                 'LSTM': ['W', 'U', 'b'],
+                 'GRU': ['W', 'U', 'b']}
+
+
+def _activation(name):
+    if name not in ACTIVATIONS:
+        raise NotImplementedError('Activation "' + str(name) + '" is not implemented in the NumPy engine.')
+    return ACTIVATIONS[name]
+
+
+class _Weights(object):
+    """
+    Weights of a layer, accessed by the suffix of their names.
+    """
+
+    def __init__(self, layer_name, class_name, arrays, names):
+        self.layer_name = layer_name
+        self.class_name = class_name
+        self.arrays = arrays
+        self.names = names
+
+    def get(self, suffix, default=KeyError):
+        if all([name is not None for name in self.names]):
+            for name, array in zip(self.names, self.arrays):
+                if name == suffix or name.endswith('_' + suffix):
+                    return array
+        elif suffix in WEIGHTS_ORDER.get(self.class_name, []):
+            position = WEIGHTS_ORDER[self.class_name].index(suffix)
+            if position < len(self.arrays):
+                return self.arrays[position]
+        if default is KeyError:
+            raise KeyError('Weight "' + suffix + '" not found in layer ' + self.layer_name + ' (' +
+                           str(self.names) + '). Re-export the model for storing the weight names.')
+        return default
+
+    def has(self, suffix):
+        return self.get(suffix, None) is not None
+
+    def split(self):
+        """
+        Splits the weights of a Bidirectional layer into its forward and backward layers.
+        """
+        half = len(self.arrays) // 2
+        return [_Weights(self.layer_name, self.class_name, self.arrays[:half], self.names[:half]),
+                _Weights(self.layer_name, self.class_name, self.arrays[half:], self.names[half:])]
+
+
+def _gates_weights(weights, gates):
+    """
+    [W, U, b] of a recurrent layer, concatenating the weights of each gate if they are stored separately
+    (consume_less='cpu').
+    """
+    if weights.has('W'):
+        return weights.get('W'), weights.get('U'), weights.get('b')
+    return [np.concatenate([weights.get(w + '_' + g) for g in gates], axis=-1) for w in ['W', 'U', 'b']]
+
+
+def _run_lstm(x, mask, weights, config, h=None, c=None):
+    """
+    Keras 1 LSTM (gates order: i, f, c, o). Masked timesteps keep the previous output and states.
+    :return: [outputs (n, t, units) in processing order, last output, last memory]
+    """
+    W, U, b = _gates_weights(weights, ['i', 'f', 'c', 'o'])
+    activation = _activation(config.get('activation', 'tanh'))
+    inner_activation = _activation(config.get('inner_activation', 'hard_sigmoid'))
+    units = U.shape[0]
+    n_samples, n_steps = x.shape[:2]
+    h = np.zeros((n_samples, units), dtype='float32') if h is None else h
+    c = np.zeros((n_samples, units), dtype='float32') if c is None else c
+    x_w = x.dot(W) + b
+    outputs = []
+    steps = range(n_steps)[::-1] if config.get('go_backwards', False) else range(n_steps)
+    for step in steps:
+        z = x_w[:, step] + h.dot(U)
+        i = inner_activation(z[:, :units])
+        f = inner_activation(z[:, units:2 * units])
+        new_c = f * c + i * activation(z[:, 2 * units:3 * units])
+        new_h = inner_activation(z[:, 3 * units:]) * activation(new_c)
+        if mask is not None:
+            m = mask[:, step, None]
+            new_h = np.where(m, new_h, h)
+            new_c = np.where(m, new_c, c)
+        h, c = new_h, new_c
+        outputs.append(h)
+    return np.stack(outputs, axis=1), h, c
+
+
+def _run_gru(x, mask, weights, config, h=None):
+    """
+    Keras 1 GRU (gates order: z, r, h). Masked timesteps keep the previous output.
+    :return: [outputs (n, t, units) in processing order, last output]
+    """
+    W, U, b = _gates_weights(weights, ['z', 'r', 'h'])
+    activation = _activation(config.get('activation', 'tanh'))
+    inner_activation = _activation(config.get('inner_activation', 'hard_sigmoid'))
+    units = U.shape[0]
+    n_samples, n_steps = x.shape[:2]
+    h = np.zeros((n_samples, units), dtype='float32') if h is None else h
+    x_w = x.dot(W) + b
+    outputs = []
+    steps = range(n_steps)[::-1] if config.get('go_backwards', False) else range(n_steps)
+    for step in steps:
+        inner = h.dot(U[:, :2 * units])
+        z = inner_activation(x_w[:, step, :units] + inner[:, :units])
+        r = inner_activation(x_w[:, step, units:2 * units] + inner[:, units:])
+        hh = activation(x_w[:, step, 2 * units:] + (r * h).dot(U[:, 2 * units:]))
+        new_h = z * h + (1. - z) * hh
+        if mask is not None:
+            new_h = np.where(mask[:, step, None], new_h, h)
+        h = new_h
+        outputs.append(h)
+    return np.stack(outputs, axis=1), h
+
+
+def _recurrent(class_name, x, mask, weights, config):
+    """
+    Applies a recurrent layer. Returns [output, output mask].
+    """
+    if class_name == 'LSTM':
+        outputs, last = _run_lstm(x, mask, weights, config)[:2]
+    elif class_name == 'GRU':
+        outputs, last = _run_gru(x, mask, weights, config)
+    else:
+        raise NotImplementedError('Recurrent layer ' + class_name + ' is not implemented in the NumPy engine.')
+    if config.get('return_sequences', False):
+        return outputs, mask
+    return last, None
+
+
+def _attention(h, context, pctx, mask_context, wa, Wa, ca):
+    """
+    Attention over the context given the previous state: returns [attended context, alphas].
+    """
+    e = np.tanh(pctx + h.dot(Wa)[:, None, :]).dot(wa.reshape(-1)) + ca.reshape(-1)
+    if mask_context is not None:
+        e = e * mask_context
+    alphas = _softmax(e, axis=1)
+    return (context * alphas[:, :, None]).sum(axis=1), alphas
+
+
+def _att_lstm_cond(inputs, masks, weights, config, n_contexts):
+    """
+    Conditional LSTM with attention over 'n_contexts' contexts (AttLSTMCond, AttLSTMCond2Inputs, AttLSTMCond3Inputs).
+
+    :param inputs: [state_below, context (, context2, context3) (, initial state, initial memory)]
+    :return: [h, x_att, alphas, (x_att2, alphas2), (x_att3, alphas3), last h, last memory]. As in the Keras layers,
+             the extra variables (x_att, alphas) are time-major (time, n, dim).
+    """
+    if n_contexts > 1 and not config.get('attend_on_both', True):
+        raise NotImplementedError('AttLSTMCond' + str(n_contexts) + 'Inputs with attend_on_both=False is not '
+                                  'implemented in the NumPy engine.')
+    x = inputs[0]
+    contexts = inputs[1:1 + n_contexts]
+    mask = masks[0]
+    masks_context = [None if m is None else m.astype('float32') for m in masks[1:1 + n_contexts]]
+    n_samples, n_steps = x.shape[:2]
+
+    activation = _activation(config.get('activation', 'tanh'))
+    inner_activation = _activation(config.get('inner_activation', 'sigmoid'))
+    U, b, V = weights.get('U'), weights.get('b'), weights.get('V')
+    units = U.shape[0]
+    suffixes = [''] + [str(i + 2) for i in range(n_contexts - 1)]
+    attention = []
+    for context, mask_context, s in zip(contexts, masks_context, suffixes):
+        pctx = context.dot(weights.get('Ua' + s)) + weights.get('ba' + s)
+        attention.append([context, pctx, mask_context, weights.get('wa' + s), weights.get('Wa' + s),
+                          weights.get('ca' + s), weights.get('W' + s)])
+
+    init_states = inputs[1 + n_contexts:]
+    h = init_states[0] if len(init_states) > 0 else np.zeros((n_samples, units), dtype='float32')
+    c = init_states[1] if len(init_states) > 1 else np.zeros((n_samples, units), dtype='float32')
+
+    x_v = x.dot(V) + b
+    outputs = []
+    extra = [[] for _ in range(2 * n_contexts)]
+    for step in range(n_steps):
+        z = x_v[:, step] + h.dot(U)
+        for i, (context, pctx, mask_context, wa, Wa, ca, W) in enumerate(attention):
+            ctx_, alphas = _attention(h, context, pctx, mask_context, wa, Wa, ca)
+            z += ctx_.dot(W)
+            extra[2 * i].append(ctx_)
+            extra[2 * i + 1].append(alphas)
+        i = inner_activation(z[:, :units])
+        f = inner_activation(z[:, units:2 * units])
+        new_c = f * c + i * activation(z[:, 2 * units:3 * units])
+        new_h = inner_activation(z[:, 3 * units:]) * activation(new_c)
+        if mask is not None:
+            m = mask[:, step, None]
+            new_h = np.where(m, new_h, h)
+            new_c = np.where(m, new_c, c)
+        h, c = new_h, new_c
+        outputs.append(h)
+
+    ret = [np.stack(outputs, axis=1) if config.get('return_sequences', True) else h]
+    if config.get('return_extra_variables', False):
+        ret += [np.stack(e, axis=0) for e in extra]
+    if config.get('return_states', False):
+        ret += [h, c]
+    return ret, [mask] + [None] * (len(ret) - 1)
+
+
+def _lambda(name, config, x, mask):
+    function = str(config.get('function', ''))
+    if name == 'lambda_mean':
+        return x.mean(axis=1), None
+    if name == 'lambda_broadcast':
+        return np.expand_dims(x, 1), None
+    if name.endswith('_L2_norm') or function == 'L2_norm':
+        return x / np.sqrt(np.maximum((x ** 2).sum(axis=-1, keepdims=True), 1e-12)), mask
+    if name.endswith('_L1_norm') or function == 'L1_norm':
+        return x / np.maximum(np.abs(x).sum(axis=-1, keepdims=True), 1e-12), mask
+    raise NotImplementedError('Lambda layer ' + name + ' is not implemented in the NumPy engine.')
+
+
+def _merge(config, inputs, masks):
+    mode = config.get('mode', 'sum')
+    if mode == 'sum':
+        output = reduce(np.add, inputs)
+    elif mode == 'mul':
+        output = reduce(np.multiply, inputs)
+    elif mode == 'ave':
+        output = reduce(np.add, inputs) / len(inputs)
+    elif mode == 'max':
+        output = reduce(np.maximum, inputs)
+    elif mode == 'concat':
+        output = np.concatenate(inputs, axis=config.get('concat_axis', -1))
+    else:
+        raise NotImplementedError('Merge mode "' + str(mode) + '" is not implemented in the NumPy engine.')
+    masks = [m for m in masks if m is not None]
+    return output, reduce(np.logical_and, masks) if len(masks) > 0 else None
+
+
+def _dense(class_name, config, weights, x):
+    if class_name == 'Dense':
+        return _activation(config.get('activation', 'linear'))(x.dot(weights.get('W')) + weights.get('b', 0.))
+    if class_name == 'MaxoutDense':
+        W, b = weights.get('W'), weights.get('b', 0.)
+        return np.max(np.einsum('...i,kij->...kj', x, W) + b, axis=-2)
+    raise NotImplementedError('Layer ' + class_name + ' is not implemented in the NumPy engine.')
+
+
+def _batch_normalization(config, weights, x):
+    mode = config.get('mode', 0)
+    epsilon = config.get('epsilon', 1e-3)
+    gamma, beta = weights.get('gamma'), weights.get('beta')
+    if mode == 0:
+        return gamma * (x - weights.get('running_mean')) / np.sqrt(weights.get('running_std') + epsilon) + beta
+    if mode == 1:
+        std = np.sqrt(x.var(axis=-1, keepdims=True) + epsilon)
+        return gamma * (x - x.mean(axis=-1, keepdims=True)) / (std + epsilon) + beta
+    axes = tuple(range(x.ndim - 1))
+    return gamma * (x - x.mean(axis=axes)) / np.sqrt(x.var(axis=axes) + epsilon) + beta
+
+
+def apply_layer(class_name, name, config, weights, inputs, masks):
+    """
+    Applies a (non-input) layer on NumPy arrays.
+
+    :param class_name: Keras class name of the layer
+    :param name: name of the layer
+    :param config: Keras config of the layer
+    :param weights: _Weights of the layer
+    :param inputs: list of input arrays
+    :param masks: list of input masks (None for unmasked inputs)
+    :return: [list of outputs, list of output masks]
+    """
+    x, mask = inputs[0], masks[0]
+    if class_name in ['Dropout', 'GaussianNoise', 'GaussianDropout']:
+        return [x], [mask]
+    if class_name == 'Embedding':
+        x = x.astype('int64')
+        return [weights.get('W')[x]], [x != 0 if config.get('mask_zero', False) else None]
+    if class_name in ['Dense', 'MaxoutDense']:
+        return [_dense(class_name, config, weights, x)], [mask]
+    if class_name == 'TimeDistributed':
+        inner = config['layer']
+        if inner['class_name'] in ['Dense', 'MaxoutDense']:
+            return [_dense(inner['class_name'], inner['config'], weights, x)], [mask]
+        if inner['class_name'] == 'Activation':
+            return [_activation(inner['config']['activation'])(x)], [mask]
+        raise NotImplementedError('TimeDistributed(' + inner['class_name'] + ') is not implemented in the NumPy '
+                                  'engine.')
+    if class_name == 'Activation':
+        return [_activation(config['activation'])(x)], [mask]
+    if class_name == 'Merge':
+        output, mask = _merge(config, inputs, masks)
+        return [output], [mask]
+    if class_name == 'Lambda':
+        output, mask = _lambda(name, config, x, mask)
+        return [output], [mask]
+    if class_name == 'BatchNormalization':
+        return [_batch_normalization(config, weights, x)], [mask]
+    if class_name in ['PReLU', 'ChannelWisePReLU']:
+        return [np.maximum(x, 0.) + weights.get('alphas') * np.minimum(x, 0.)], [mask]
+    if class_name == 'PermuteGeneral':
+        return [np.transpose(x, config['dims'])], [None]
+    if class_name in ['LSTM', 'GRU']:
+        output, mask = _recurrent(class_name, x, mask, weights, config)
+        return [output], [mask]
+    if class_name == 'Bidirectional':
+        inner = config['layer']
+        forward_weights, backward_weights = weights.split()
+        backward_config = dict(inner['config'])
+        backward_config['go_backwards'] = not backward_config.get('go_backwards', False)
+        forward, out_mask = _recurrent(inner['class_name'], x, mask, forward_weights, inner['config'])
+        backward = _recurrent(inner['class_name'], x, mask, backward_weights, backward_config)[0]
+        if backward.ndim == 3:
+            backward = backward[:, ::-1]
+        merge_mode = config.get('merge_mode', 'concat')
+        if merge_mode == 'concat':
+            return [np.concatenate([forward, backward], axis=-1)], [out_mask]
+        if merge_mode == 'sum':
+            return [forward + backward], [out_mask]
+        if merge_mode == 'ave':
+            return [(forward + backward) / 2.], [out_mask]
+        if merge_mode == 'mul':
+            return [forward * backward], [out_mask]
+        return [forward, backward], [out_mask, out_mask]
+    if class_name == 'AttLSTMCond':
+        return _att_lstm_cond(inputs, masks, weights, config, 1)
+    if class_name == 'AttLSTMCond2Inputs':
+        return _att_lstm_cond(inputs, masks, weights, config, 2)
+    if class_name == 'AttLSTMCond3Inputs':
+        return _att_lstm_cond(inputs, masks, weights, config, 3)
+    raise NotImplementedError('Layer ' + class_name + ' (' + name + ') is not implemented in the NumPy engine.')
+
+
+class NumpyModel(object):
+    """
+    Interpreter of an exported Keras 1 functional model.
+    """
+
+    def __init__(self, structure, weights):
+        """
+        :param structure: Keras JSON structure of the model (as a dictionary)
+        :param weights: dictionary layer name -> _Weights
+        """
+        config = structure['config']
+        self.layers = dict([(layer['name'], layer) for layer in config['layers']])
+        self.input_names = [l[0] for l in config['input_layers']]
+        self.outputs = [tuple(l[:3]) for l in config['output_layers']]
+        self.weights = weights
+        for layer in config['layers']:
+            if layer['class_name'] != 'InputLayer':
+                # Fails now, instead of at the first prediction, on unsupported layers
+                self._check(layer)
+
+    def _check(self, layer):
+        class_name = layer['class_name']
+        supported = ['Dropout', 'GaussianNoise', 'GaussianDropout', 'Embedding', 'Dense', 'MaxoutDense',
+                     'TimeDistributed', 'Activation', 'Merge', 'Lambda', 'BatchNormalization', 'PReLU',
+                     'ChannelWisePReLU', 'PermuteGeneral', 'LSTM', 'GRU', 'Bidirectional', 'AttLSTMCond',
+                     'AttLSTMCond2Inputs', 'AttLSTMCond3Inputs']
+        if class_name not in supported:
+            raise NotImplementedError('Layer ' + class_name + ' (' + layer['name'] + ') is not implemented in the '
+                                      'NumPy engine.')
+        if class_name == 'Lambda':
+            _lambda(layer['name'], layer['config'], np.zeros((1, 1, 1), dtype='float32'), None)
+
+    def predict_on_batch(self, in_data):
+        """
+        :param in_data: dictionary input name -> array
+        :return: list of outputs, in the order of the model outputs
+        """
+        # (layer name, node index) -> [outputs, masks]
+        computed = dict()
+        for name in self.input_names:
+            computed[(name, 0)] = [[np.asarray(in_data[name])], [None]]
+
+        pending = [(layer['name'], node_index, node) for layer in self.layers.values()
+                   if layer['class_name'] != 'InputLayer' for node_index, node in enumerate(layer['inbound_nodes'])]
+        while len(pending) > 0:
+            remaining = []
+            for name, node_index, node in pending:
+                if not all([(inbound[0], inbound[1]) in computed for inbound in node]):
+                    remaining.append((name, node_index, node))
+                    continue
+                inputs = [computed[(inbound[0], inbound[1])][0][inbound[2]] for inbound in node]
+                masks = [computed[(inbound[0], inbound[1])][1][inbound[2]] for inbound in node]
+                layer = self.layers[name]
+                computed[(name, node_index)] = apply_layer(layer['class_name'], name, layer['config'],
+                                                           self.weights.get(name), inputs, masks)
+            if len(remaining) == len(pending):
+                raise Exception('The model structure has nodes with unavailable inputs: ' +
+                                str([p[0] for p in remaining]))
+            pending = remaining
+        return [computed[(name, node_index)][0][tensor_index].astype('float32')
+                for name, node_index, tensor_index in self.outputs]
+
+
+class NumpyInferenceModel(object):
+    """
+    Exported model_init and model_next, with the attributes required by the optimized (and batched) search.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: folder of a model exported with export_inference_model
+        """
+        meta, weights = load_inference_model(path)
+        layers_meta = dict([(layer['name'], layer) for layer in meta['layers']])
+        layers_weights = dict()
+        for layer_name, arrays in weights:
+            names = [w.get('name') for w in layers_meta[layer_name]['weights']]
+            layers_weights[layer_name] = _Weights(layer_name, layers_meta[layer_name]['class_name'], arrays, names)
+        self.model_type = meta['model_type']
+        self.params = meta['params']
+        self.quantization = meta['quantization']
+        self.model_init = NumpyModel(meta['model_init'], layers_weights)
+        self.model_next = NumpyModel(meta['model_next'], layers_weights)
+        for attribute in meta:
+            if attribute.startswith('ids_') or attribute.startswith('matchings_'):
+                setattr(self, attribute, meta[attribute])
+
+
+def max_output_differences(video_model, engine, X, params, null_sym=2):
+    """
+    Maximum absolute differences between the outputs of the Keras and NumPy models, on model_init and on a
+    model_next step fed with the (Keras) model_init outputs.
+
+    :param video_model: VideoDesc_Model
+    :param engine: NumpyInferenceModel
+    :param X: dictionary of model inputs
+    :param params: search parameters (model_inputs, state_below_index)
+    :return: [list of differences on model_init outputs, list of differences on model_next outputs]
+    """
+    in_data = dict([(model_input, X[model_input]) for model_input in params['model_inputs']])
+    n_samples = in_data.values()[0].shape[0]
+    in_data[params['model_inputs'][params['state_below_index']]] = np.zeros((n_samples, 1), dtype='int64') + null_sym
+    keras_init = video_model.model_init.predict_on_batch(in_data)
+    numpy_init = engine.model_init.predict_on_batch(in_data)
+    init_differences = [float(np.abs(k - n).max()) for k, n in zip(keras_init, numpy_init)]
+
+    in_data = {video_model.ids_inputs_next[0]: keras_init[0][:, 0].argmax(axis=-1)[:, None].astype('int64')}
+    for idx, prev_out_name in enumerate(video_model.ids_outputs_init):
+        if idx > 0 and prev_out_name in video_model.matchings_init_to_next:
+            in_data[video_model.matchings_init_to_next[prev_out_name]] = keras_init[idx]
+    keras_next = video_model.model_next.predict_on_batch(in_data)
+    numpy_next = engine.model_next.predict_on_batch(in_data)
+    next_differences = [float(np.abs(k - n).max()) for k, n in zip(keras_next, numpy_next)]
+    return init_differences, next_differences
+
+
+def check_numpy_inference(params, n_samples=10):
+    """
+    Exports the model given by STORE_PATH/SAMPLING_RELOAD_POINT, loads it in the NumPy engine and compares its
+    outputs and decoding times against the Keras models on the first samples of the EVAL_ON_SETS splits.
+    """
+    from data_engine.prepare_data import build_dataset
+    from keras_wrapper.cnn_model import loadModel
+    from utils.batched_search import batched_beam_search
+    from utils.inference_export import export_inference_model
+
+    quantization = params.get('EXPORT_QUANTIZATION', 'float32')
+    export_path = params.get('EXPORT_PATH') or os.path.join(params['STORE_PATH'], 'inference_' + quantization)
+
+    dataset = build_dataset(params)
+    params['OUTPUT_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['OUTPUTS_IDS_DATASET'][0]]
+    video_model = loadModel(params['STORE_PATH'], params['SAMPLING_RELOAD_POINT'],
+                            reload_epoch=params['SAMPLING_RELOAD_EPOCH'])
+    export_inference_model(video_model, export_path, quantization=quantization)
+
+    start_time = time.time()
+    engine = NumpyInferenceModel(export_path)
+    logger.info('NumPy engine loaded in %.3f seconds' % (time.time() - start_time))
+
+    search_params = {'beam_size': params['BEAM_SIZE'],
+                     'maxlen': params['MAX_OUTPUT_TEXT_LEN_TEST'],
+                     'max_batch_size': params['BATCH_SIZE'],
+                     'model_inputs': params['INPUTS_IDS_MODEL'],
+                     'state_below_index': params.get('BEAM_SEARCH_COND_INPUT', -1)}
+    for s in params['EVAL_ON_SETS']:
+        indices = range(min(n_samples, eval('dataset.len_' + s)))
+        X = dataset.getX_FromIndices(s, indices, dataAugmentation=False)
+        X = dict([(input_id, X[dataset.ids_inputs.index(dataset_id)]) for input_id, dataset_id in
+                  zip(params['INPUTS_IDS_MODEL'], params['INPUTS_IDS_DATASET'])])
+        init_differences, next_differences = max_output_differences(video_model, engine, X, search_params)
+        logger.info(s + ': max. abs. differences on model_init outputs ' + str(init_differences) +
+                    ', on model_next outputs ' + str(next_differences))
+
+        results = []
+        for model in [video_model, engine]:
+            start_time = time.time()
+            results.append(batched_beam_search(model, X, search_params))
+            logger.info(s + ': %s search of %d samples in %.3f seconds' %
+                        (model.__class__.__name__, len(indices), time.time() - start_time))
+        best = [[list(samples[np.argmin(scores)]) for samples, scores in result] for result in results]
+        identical = [k == n for k, n in zip(best[0], best[1])]
+        logger.info(s + ': identical best captions in %d of %d samples' % (sum(identical), len(identical)))
+
+
+if __name__ == "__main__":
+    from config import load_parameters
+
+    parameters = load_parameters()
+    try:
+        for arg in sys.argv[1:]:
+            k, v = arg.split('=')
+            parameters[k] = ast.literal_eval(v)
+    except ValueError:
+        print 'Overwritten arguments must have the form key=Value'
+        exit(1)
+    check_numpy_inference(parameters)
@@ -0,0 +1,284 @@
+"""
+Online (incremental) captioning for temporally-linked models.
+
+The temporally-linked models (TemporallyLinkedVideoDescriptionAtt and
+TemporallyLinkedVideoDescriptionAttDoublePrev) need the caption of the previous event of the same day and,
+in '-vidtext' mode, its video. Offline, this context comes from the LINK_SAMPLE_FILES. Here it is kept in a
+bounded in-memory store keyed by (user, day), so that events can be captioned as soon as they are recorded.
+For each day we keep the last generated caption together with its encoded representation (and the encoded
+previous video), so that captioning the next event only needs to encode the new video.
+"""
+import copy
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from keras import backend as K
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+class TemporalContextStore(object):
+    """
+    Bounded LRU store with the temporally-linked context of each (user, day).
+
+    Each entry is a dictionary with the following keys:
+        * 'caption': list of word indices of the last generated caption (without padding)
+        * 'prev_desc_enc': encoded 'caption', as the 'preprocessed_input2' of the decoder (1, len, dim)
+        * 'prev_video_enc': encoded video of the last event, as the 'preprocessed_input3' of the decoder
+                            (only for '-vidtext' models)
+        * 'n_events': number of events of the day captioned so far
+    """
+
+    def __init__(self, max_entries=100):
+        """
+        :param max_entries: maximum number of (user, day) contexts kept in memory. The least recently used ones
+                            are discarded first.
+        """
+        if max_entries < 1:
+            raise ValueError('max_entries must be a positive number, got ' + str(max_entries))
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, user, day):
+        """
+        Returns the context of the given (user, day) or None if it is the first event of the day (or the context was
+        already evicted).
+        """
+        key = (user, day)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry  # mark as most recently used
+        self.hits += 1
+        return entry
+
+    def update(self, user, day, caption, prev_desc_enc, prev_video_enc=None):
+        """
+        Stores the context produced by the last captioned event of the given (user, day).
+
+        :param caption: list of word indices of the generated caption
+        :param prev_desc_enc: encoding of 'caption'
+        :param prev_video_enc: encoding of the video of the captioned event (only for '-vidtext' models)
+        :return: the stored entry
+        """
+        key = (user, day)
+        old_entry = self._entries.pop(key, None)
+        entry = {'caption': list(caption),
+                 'prev_desc_enc': prev_desc_enc,
+                 'prev_video_enc': prev_video_enc,
+                 'n_events': old_entry['n_events'] + 1 if old_entry is not None else 1}
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            evicted_key, _ = self._entries.popitem(last=False)
+            logger.debug('Evicting temporal context of ' + str(evicted_key))
+        return entry
+
+    def reset(self, user, day=None):
+        """
+        Removes the context of a (user, day), or all the days of a user if day is None.
+        """
+        if day is not None:
+            self._entries.pop((user, day), None)
+        else:
+            for key in [k for k in self._entries if k[0] == user]:
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+class OnlineLinkedCaptioner(object):
+    """
+    Captions the events of a day one at a time with a trained temporally-linked VideoDesc_Model, reusing the encoded
+    context of the previous event stored in a TemporalContextStore.
+
+    The encoders are taken from the model_init graph (video -> annotations + initial states, prev_description ->
+    encoding, prev_video -> encoding), and every decoding step (including the first one) is applied with model_next.
+    Hence, the previous caption is encoded only once, right after it is generated.
+    """
+
+    def __init__(self, video_model, params, null_sym=2, eos_sym=0, context_store=None):
+        """
+        :param video_model: trained VideoDesc_Model with an optimized search model (model_init and model_next)
+        :param params: configuration parameters (see config.py)
+        :param null_sym: index of the <null> symbol
+        :param eos_sym: index of the <eos>/<pad> symbol
+        :param context_store: TemporalContextStore to use (a new one is created if None)
+        """
+        if getattr(video_model, 'model_init', None) is None or getattr(video_model, 'model_next', None) is None:
+            raise Exception('Online captioning requires a model built with BEAM_SEARCH and OPTIMIZED_SEARCH.')
+        if not hasattr(video_model, 'ids_temporally_linked_inputs'):
+            raise Exception('Online captioning is only available for temporally-linked models.')
+
+        self.video_model = video_model
+        self.params = params
+        self.null_sym = null_sym
+        self.eos_sym = eos_sym
+        self.beam_size = params.get('BEAM_SIZE', 10)
+        self.maxlen = params.get('MAX_OUTPUT_TEXT_LEN_TEST', 50)
+        self.normalize_probs = params.get('NORMALIZE_SAMPLING', False)
+        self.alpha_factor = params.get('ALPHA_FACTOR', 1.)
+        self.use_prev_video = 'preprocessed_input3' in video_model.ids_inputs_next
+        if context_store is None:
+            context_store = TemporalContextStore(max_entries=params.get('ONLINE_CONTEXT_MAX_ENTRIES', 100))
+        self.context_store = context_store
+        self._build_encoders()
+
+    def _build_encoders(self):
+        """
+        Builds backend functions for the encoders from the model_init graph. The initial states are the inputs of
+        the decoder layer (after the INIT_LAYERS perceptrons and their regularizers), following the embedding, the
+        video and the previous description (and video) encodings. Without INIT_LAYERS, the decoder starts from zeros.
+        """
+        model_init = self.video_model.model_init
+        ids_outputs_init = self.video_model.ids_outputs_init
+        decoder = [layer for layer in model_init.layers if layer.name.startswith('decoder_')][0]
+        decoder_inputs = decoder.inbound_nodes[0].input_tensors
+        n_states = 2 if self.params['RNN_TYPE'] == 'LSTM' else 1
+        n_inputs = 4 if self.use_prev_video else 3
+        if len(decoder_inputs) == n_inputs:
+            self.init_states = False
+        elif len(decoder_inputs) == n_inputs + n_states:
+            self.init_states = True
+        else:
+            raise Exception('Unexpected inputs of the decoder layer %s: %d, expected %d (without initial states) or %d.'
+                            % (decoder.name, len(decoder_inputs), n_inputs, n_inputs + n_states))
+
+        video_outputs = [model_init.outputs[ids_outputs_init.index('preprocessed_input')]]
+        if self.init_states:
+            video_outputs += list(decoder_inputs[-n_states:])
+        self._encode_video = K.function([model_init.inputs[0], K.learning_phase()], video_outputs)
+        self._encode_prev_desc = K.function([model_init.inputs[2], K.learning_phase()],
+                                            [model_init.outputs[ids_outputs_init.index('preprocessed_input2')]])
+        if self.use_prev_video:
+            self._encode_prev_video = K.function([model_init.inputs[3], K.learning_phase()],
+                                                 [model_init.outputs[ids_outputs_init.index('preprocessed_input3')]])
+
+    def encode_caption(self, caption):
+        """
+        Encodes a caption (list of word indices) as the 'prev_description' input of the next event.
+        """
+        if len(caption) == 0:
+            caption = [self.null_sym]
+        caption = np.asarray([list(caption) + [self.eos_sym]], dtype='int64')
+        return self._encode_prev_desc([caption, 0])[0]
+
+    def encode_prev_video(self, video):
+        """
+        Encodes the features of a video (n_frames, IMG_FEAT_SIZE) as the 'prev_video' input of the next event.
+        """
+        return self._encode_prev_video([np.asarray([video], dtype='float32'), 0])[0]
+
+    def _empty_context(self):
+        context = {'caption': [], 'prev_desc_enc': self.encode_caption([]), 'prev_video_enc': None, 'n_events': 0}
+        if self.use_prev_video:
+            context['prev_video_enc'] = self.encode_prev_video(np.zeros((1, self.params['IMG_FEAT_SIZE'])))
+        return context
+
+    def caption(self, user, day, video):
+        """
+        Captions the next event of the given (user, day) and updates its context.
+
+        :param user: user identifier (any hashable object)
+        :param day: day identifier (any hashable object)
+        :param video: features of the frames of the event (n_frames, IMG_FEAT_SIZE)
+        :return: [caption, score], where caption is a list of word indices (without <eos>)
+        """
+        context = self.context_store.get(user, day)
+        if context is None:
+            context = self._empty_context()
+
+        video = np.asarray([video], dtype='float32')
+        encoded = self._encode_video([video, 0])
+        if not self.init_states:
+            zeros = np.zeros((1, self.params['DECODER_HIDDEN_SIZE']), dtype='float32')
+            encoded += [zeros] * (2 if self.params['RNN_TYPE'] == 'LSTM' else 1)
+        in_data = {'preprocessed_input': encoded[0],
+                   'preprocessed_input2': context['prev_desc_enc'],
+                   'prev_state': encoded[1]}
+        if len(encoded) > 2:
+            in_data['prev_memory'] = encoded[2]
+        if self.use_prev_video:
+            in_data['preprocessed_input3'] = context['prev_video_enc']
+
+        caption, score = self.beam_search(in_data)
+
+        prev_video_enc = self.encode_prev_video(video[0]) if self.use_prev_video else None
+        self.context_store.update(user, day, caption, self.encode_caption(caption), prev_video_enc=prev_video_enc)
+        return caption, score
+
+    def beam_search(self, in_data):
+        """
+        Beam search applied only with model_next from the encoded inputs and the initial states.
+
+        :param in_data: dictionary with all the inputs to model_next except the previous word
+        :return: [best_caption, best_score]
+        """
+        model = self.video_model
+        ids_inputs_next = model.ids_inputs_next
+        ids_outputs_next = model.ids_outputs_next
+        k = self.beam_size
+
+        samples = []
+        sample_scores = []
+        dead_k = 0
+        hyp_samples = [[]]
+        hyp_scores = np.zeros(1, dtype='float32')
+        state_below = np.asarray([[self.null_sym]], dtype='int64')
+        in_data = copy.copy(in_data)
+
+        for ii in range(self.maxlen):
+            in_data[ids_inputs_next[0]] = state_below
+            out_data = model.model_next.predict_on_batch(in_data)
+            log_probs = np.log(out_data[0][:, 0, :])
+            cand_flat = (hyp_scores[:, None] - log_probs).flatten()
+            ranks_flat = cand_flat.argsort()[:(k - dead_k)]
+            voc_size = log_probs.shape[1]
+            trans_indices = ranks_flat // voc_size
+            word_indices = ranks_flat % voc_size
+            costs = cand_flat[ranks_flat]
+
+            new_hyp_samples = []
+            new_hyp_scores = []
+            indices_alive = []
+            for ti, wi, cost in zip(trans_indices, word_indices, costs):
+                if wi == self.eos_sym:
+                    samples.append(hyp_samples[ti])
+                    sample_scores.append(cost)
+                    dead_k += 1
+                else:
+                    new_hyp_samples.append(hyp_samples[ti] + [wi])
+                    new_hyp_scores.append(cost)
+                    indices_alive.append(ti)
+            hyp_samples = new_hyp_samples
+            hyp_scores = np.asarray(new_hyp_scores, dtype='float32')
+            if len(hyp_samples) == 0 or dead_k >= k:
+                break
+            state_below = np.asarray([[h[-1]] for h in hyp_samples], dtype='int64')
+
+            # Keep only the states of the alive hypotheses
+            for idx, next_out_name in enumerate(ids_outputs_next):
+                if idx > 0 and next_out_name in model.matchings_next_to_next:
+                    in_data[model.matchings_next_to_next[next_out_name]] = out_data[idx][indices_alive]
+
+        # dump every remaining one
+        samples += hyp_samples
+        sample_scores += list(hyp_scores)
+
+        if self.normalize_probs:
+            sample_scores = [co / max(len(sample), 1) ** self.alpha_factor
+                             for co, sample in zip(sample_scores, samples)]
+        best = int(np.argmin(sample_scores))
+        return samples[best], sample_scores[best]
@@ -0,0 +1,288 @@
+"""
+Hot-path profiling hooks.
+
+With PROFILING, main.py starts a process-wide profiler and the instrumented stages are timed:
+    * build_dataset: setInput/setOutput (per split), insertTemporallyLinkedCaptions, keep_n_captions, saveDataset, ...
+    * model building (build_model, loadModel, setOptimizer) and the lazy compilation of each Theano function on its
+      first fit/predict (compile[model_train], compile[model_init_predict], ..., see utils/function_cache.py)
+    * beam search: every model_init/model_next prediction, under the search of each sample (beam_search) or batch
+      (batched_beam_search), so the time of the beam updates is the difference between both
+The scopes are nested, so each timing is reported under the stages that contain it, e.g.
+    build_dataset/insertTemporallyLinkedCaptions/setInput[train]
+Additionally, with PROFILING_MODE:
+    * 'cprofile': the whole run is profiled with cProfile (STORE_PATH/profile.prof, loadable with pstats)
+    * 'sampling': the call stack is sampled every PROFILING_SAMPLE_INTERVAL seconds of CPU time (SIGPROF), counting the
+      samples of each function (self and cumulative) and of each scope
+The summary table is logged and written to STORE_PATH/profile_summary.txt when the profiler is stopped.
+
+When PROFILING is disabled, scope() returns a shared no-op context manager and the instrumented functions only check a
+module global.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import signal
+from StringIO import StringIO
+from functools import wraps
+from timeit import default_timer as timer
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+PROFILING_MODES = [None, 'cprofile', 'sampling']
+
+# Active profiler (None when disabled)
+_profiler = None
+
+
+class _NullScope(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SCOPE = _NullScope()
+
+
+class _Scope(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.profiler.stack.append(self.name)
+        self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = timer() - self.start
+        key = '/'.join(self.profiler.stack)
+        self.profiler.stack.pop()
+        timing = self.profiler.timings.get(key)
+        if timing is None:
+            self.profiler.timings[key] = [1, elapsed, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+        return False
+
+
+class _Sampler(object):
+    """
+    Statistical profiler: samples the stack of the main thread every 'interval' seconds of CPU time.
+    """
+
+    def __init__(self, profiler, interval):
+        self.profiler = profiler
+        self.interval = interval
+        self.n_samples = 0
+        self.own = dict()
+        self.cumulative = dict()
+        self.scopes = dict()
+        self.previous_handler = None
+
+    def start(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        self.n_samples += 1
+        scope_key = '/'.join(self.profiler.stack) or '<no scope>'
+        self.scopes[scope_key] = self.scopes.get(scope_key, 0) + 1
+        seen = set()
+        leaf = True
+        while frame is not None:
+            code = frame.f_code
+            key = '%s:%d(%s)' % (code.co_filename, code.co_firstlineno, code.co_name)
+            if leaf:
+                self.own[key] = self.own.get(key, 0) + 1
+                leaf = False
+            if key not in seen:
+                seen.add(key)
+                self.cumulative[key] = self.cumulative.get(key, 0) + 1
+            frame = frame.f_back
+
+    def report(self, stream, top=40):
+        stream.write('\nSampled %d stacks every %.1f ms of CPU time\n' % (self.n_samples, 1000 * self.interval))
+        if self.n_samples == 0:
+            return
+        stream.write('\n%8s %8s  %s\n' % ('samples', '%', 'scope'))
+        for key, count in sorted(self.scopes.iteritems(), key=lambda x: -x[1]):
+            stream.write('%8d %8.1f  %s\n' % (count, 100. * count / self.n_samples, key))
+        stream.write('\n%8s %8s %8s  %s\n' % ('self', 'cumul.', 'self %', 'function'))
+        for key, count in sorted(self.own.iteritems(), key=lambda x: -x[1])[:top]:
+            stream.write('%8d %8d %8.1f  %s\n' % (count, self.cumulative[key], 100. * count / self.n_samples, key))
+
+
+class Profiler(object):
+
+    def __init__(self, store_path, mode=None, sample_interval=0.005):
+        if mode not in PROFILING_MODES:
+            raise ValueError('Unknown profiling mode "%s". Valid modes: %s' % (str(mode), str(PROFILING_MODES)))
+        self.store_path = store_path
+        self.mode = mode
+        self.timings = dict()  # scope path -> [count, total seconds, max seconds]
+        self.stack = []
+        self.start_time = None
+        self.cprofile = cProfile.Profile() if mode == 'cprofile' else None
+        self.sampler = _Sampler(self, sample_interval) if mode == 'sampling' else None
+
+    def start(self):
+        self.start_time = timer()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def scope(self, name):
+        return _Scope(self, name)
+
+    def report(self, stream, top=40):
+        """
+        Writes the summary table of the timed scopes (and of the cProfile or sampling capture).
+        """
+        stream.write('Profiled scopes (%.1f s since start):\n' % (timer() - self.start_time))
+        stream.write('%8s %12s %12s %12s  %s\n' % ('count', 'total ms', 'mean ms', 'max ms', 'scope'))
+        for key in sorted(self.timings.keys(), key=lambda k: k.split('/')):
+            count, total, longest = self.timings[key]
+            stream.write('%8d %12.1f %12.1f %12.1f  %s%s\n' % (count, 1000 * total, 1000 * total / count,
+                                                               1000 * longest, '  ' * key.count('/'),
+                                                               key.rsplit('/', 1)[-1]))
+        if self.cprofile is not None:
+            stream.write('\ncProfile (top %d by cumulative time, full stats in %s):\n' %
+                         (top, os.path.join(self.store_path, 'profile.prof')))
+            pstats.Stats(self.cprofile, stream=stream).sort_stats('cumulative').print_stats(top)
+        if self.sampler is not None:
+            self.sampler.report(stream, top=top)
+
+    def save(self):
+        if not os.path.isdir(self.store_path):
+            os.makedirs(self.store_path)
+        summary = StringIO()
+        self.report(summary)
+        with open(os.path.join(self.store_path, 'profile_summary.txt'), 'w') as f:
+            f.write(summary.getvalue())
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(os.path.join(self.store_path, 'profile.prof'))
+        logger.info('Profile summary (stored in %s):\n%s' %
+                    (os.path.join(self.store_path, 'profile_summary.txt'), summary.getvalue()))
+
+
+def start(params):
+    """
+    Starts the process-wide profiler if PROFILING is enabled.
+    :return: the Profiler instance or None
+    """
+    global _profiler
+    if not params.get('PROFILING', False):
+        return None
+    if _profiler is not None:
+        stop()
+    _profiler = Profiler(params['STORE_PATH'], mode=params.get('PROFILING_MODE', None),
+                         sample_interval=params.get('PROFILING_SAMPLE_INTERVAL', 0.005))
+    _profiler.start()
+    return _profiler
+
+
+def stop():
+    """
+    Stops the profiler (if running) and stores its summary.
+    """
+    global _profiler
+    if _profiler is None:
+        return
+    profiler = _profiler
+    _profiler = None
+    profiler.stop()
+    profiler.save()
+
+
+def scope(name):
+    """
+    Context manager timing its block as 'name' (nested in the enclosing scopes).
+    """
+    if _profiler is None:
+        return _NULL_SCOPE
+    return _profiler.scope(name)
+
+
+def profiled(name=None):
+    """
+    Decorator timing every call of the function as a scope (named as the function by default).
+    """
+
+    def decorator(f):
+        scope_name = name or f.__name__
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return f(*args, **kwargs)
+            with _profiler.scope(scope_name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class profile_methods(object):
+    """
+    Context manager timing the given methods of a class while it is active, e.g. Dataset.setInput. The scope of each
+    call is named 'method[<split>]', taking the split from the 'set_name' argument (positional argument split_arg).
+    The class is restored on exit, so the instances can be pickled afterwards. No-op if the profiler is disabled.
+    """
+
+    def __init__(self, cls, method_names, split_arg=1):
+        self.cls = cls
+        self.method_names = method_names
+        self.split_arg = split_arg
+        self.originals = dict()
+
+    def __enter__(self):
+        if _profiler is None:
+            return self
+        for method_name in self.method_names:
+            original = self.cls.__dict__.get(method_name)
+            if original is None:
+                continue
+            self.originals[method_name] = original
+            setattr(self.cls, method_name, self._timed(method_name, original))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for method_name, original in self.originals.iteritems():
+            setattr(self.cls, method_name, original)
+        self.originals = dict()
+        return False
+
+    def _timed(self, method_name, original):
+        split_arg = self.split_arg
+
+        @wraps(original)
+        def timed(instance, *args, **kwargs):
+            if _profiler is None:
+                return original(instance, *args, **kwargs)
+            split = kwargs.get('set_name', args[split_arg] if len(args) > split_arg else None)
+            with _profiler.scope('%s[%s]' % (method_name, split) if split is not None else method_name):
+                return original(instance, *args, **kwargs)
+
+        return timed
+
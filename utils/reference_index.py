@@ -0,0 +1,198 @@
+"""
+Reference index of an evaluation split.
+
+The references of a split never change, but every coco evaluation tokenizes them and counts their n-grams again, and
+CIDEr recomputes the document frequencies and the tf-idf vectors of all of them. The reference index holds all the
+reference side statistics, computed once per split:
+    * 'tokens': tokenized references
+    * 'bleu': cooked BLEU references (reference lengths and clipped n-gram counts, as pycocoevalcap's cook_refs)
+    * 'document_frequency' and 'ref_len': CIDEr document frequencies (idf) over the references of the split
+    * 'cider': tf-idf vectors, norms and lengths of the references
+The index is stored in DATASET_STORE_PATH/References_<DATASET_NAME>_<split>.pkl, together with a checksum of the
+references (it is rebuilt if they change). With it, an evaluation only processes the new hypotheses. The scores are
+the same as those of pycocoevalcap.
+"""
+import cPickle as pk
+import hashlib
+import logging
+import math
+import os
+from collections import defaultdict
+
+import numpy as np
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def references_checksum(refs):
+    """
+    sha1 of the references (id, [sentences]) of a split.
+    """
+    h = hashlib.sha1()
+    for idx in sorted(refs):
+        h.update(str(idx) + '\t' + '\t'.join([r.encode('utf-8') if isinstance(r, unicode) else r
+                                               for r in refs[idx]]) + '\n')
+    return h.hexdigest()
+
+
+def count_ngrams(words, n=4):
+    """
+    Counts of the 1..n-grams of a tokenized sentence.
+    """
+    counts = defaultdict(int)
+    for k in range(1, n + 1):
+        for i in range(len(words) - k + 1):
+            counts[tuple(words[i:i + k])] += 1
+    return counts
+
+
+def cider_vector(counts, document_frequency, ref_len, n=4):
+    """
+    tf-idf vectors (one per n-gram order), norms and length of a sentence (as CiderScorer.compute_cider).
+    """
+    vec = [dict() for _ in range(n)]
+    length = 0
+    norm = [0.0 for _ in range(n)]
+    for (ngram, term_freq) in counts.iteritems():
+        df = np.log(max(1.0, document_frequency.get(ngram, 0.0)))
+        order = len(ngram) - 1
+        vec[order][ngram] = float(term_freq) * (ref_len - df)
+        norm[order] += pow(vec[order][ngram], 2)
+        if order == 1:
+            length += term_freq
+    norm = [np.sqrt(x) for x in norm]
+    return vec, norm, length
+
+
+def build_reference_index(refs, n=4):
+    """
+    Builds the reference index of a split.
+    :param refs: dictionary of references (id, [sentences])
+    :param n: maximum n-gram order
+    :return: reference index (dictionary, see the module docstring)
+    """
+    ids = sorted(refs)
+    tokens = [[r.split() for r in refs[idx]] for idx in ids]
+
+    bleu = []
+    cider_counts = []
+    for sample_tokens in tokens:
+        reflen = []
+        maxcounts = {}
+        sample_counts = []
+        for words in sample_tokens:
+            counts = count_ngrams(words, n)
+            sample_counts.append(counts)
+            reflen.append(len(words))
+            for (ngram, count) in counts.iteritems():
+                maxcounts[ngram] = max(maxcounts.get(ngram, 0), count)
+        bleu.append((reflen, maxcounts))
+        cider_counts.append(sample_counts)
+
+    document_frequency = defaultdict(float)
+    for sample_counts in cider_counts:
+        for ngram in set([ngram for counts in sample_counts for ngram in counts]):
+            document_frequency[ngram] += 1
+    document_frequency = dict(document_frequency)
+    ref_len = np.log(float(len(ids)))
+    cider = [[cider_vector(counts, document_frequency, ref_len, n) for counts in sample_counts]
+             for sample_counts in cider_counts]
+
+    return {'n': n,
+            'ids': ids,
+            'checksum': references_checksum(refs),
+            'references': refs,
+            'tokens': tokens,
+            'bleu': bleu,
+            'document_frequency': document_frequency,
+            'ref_len': ref_len,
+            'cider': cider}
+
+
+def reference_index_path(params, split):
+    return params['DATASET_STORE_PATH'] + '/References_' + params['DATASET_NAME'] + '_' + split + '.pkl'
+
+
+def load_reference_index(ds, params, split):
+    """
+    Loads the reference index of a split of the dataset, building and storing it if it does not exist or if the
+    references changed.
+    """
+    refs = ds.extra_variables[split][params['OUTPUTS_IDS_DATASET'][0]]
+    checksum = references_checksum(refs)
+    index_path = reference_index_path(params, split)
+    if os.path.isfile(index_path):
+        with open(index_path, 'rb') as f:
+            index = pk.load(f)
+        if index['checksum'] == checksum:
+            return index
+        logger.info('The references of the ' + split + ' split changed. Rebuilding ' + index_path)
+    logger.info('Building the reference index of the ' + split + ' split of ' + params['DATASET_NAME'])
+    index = build_reference_index(refs)
+    with open(index_path, 'wb') as f:
+        pk.dump(index, f, protocol=pk.HIGHEST_PROTOCOL)
+    logger.info('Stored reference index in ' + index_path)
+    return index
+
+
+def bleu_score(index, hypo):
+    """
+    Corpus BLEU-1..4 ('closest' reference length) of the hypotheses (id, [sentence]), as pycocoevalcap's Bleu.
+    """
+    n = index['n']
+    small = 1e-9
+    tiny = 1e-15
+    total_testlen = 0
+    total_reflen = 0
+    guess = [0] * n
+    correct = [0] * n
+    for idx, (reflen, maxcounts) in zip(index['ids'], index['bleu']):
+        words = hypo[idx][0].split()
+        testlen = len(words)
+        total_testlen += testlen
+        total_reflen += min((abs(l - testlen), l) for l in reflen)[1]
+        for k in range(n):
+            guess[k] += max(0, testlen - k)
+        for (ngram, count) in count_ngrams(words, n).iteritems():
+            correct[len(ngram) - 1] += min(maxcounts.get(ngram, 0), count)
+
+    bleus = []
+    bleu = 1.
+    for k in range(n):
+        bleu *= float(correct[k] + tiny) / (guess[k] + small)
+        bleus.append(bleu ** (1. / (k + 1)))
+    ratio = (total_testlen + tiny) / (total_reflen + small)
+    if ratio < 1:
+        for k in range(n):
+            bleus[k] *= math.exp(1 - 1 / ratio)
+    return bleus
+
+
+def cider_score(index, hypo, sigma=6.0):
+    """
+    CIDEr of the hypotheses (id, [sentence]), as pycocoevalcap's Cider. Only the hypothesis vectors are computed.
+    """
+    n = index['n']
+    document_frequency = index['document_frequency']
+    ref_len = index['ref_len']
+    scores = []
+    for idx, refs in zip(index['ids'], index['cider']):
+        vec, norm, length = cider_vector(count_ngrams(hypo[idx][0].split(), n), document_frequency, ref_len, n)
+        score = np.array([0.0 for _ in range(n)])
+        for vec_ref, norm_ref, length_ref in refs:
+            delta = float(length - length_ref)
+            val = np.array([0.0 for _ in range(n)])
+            for order in range(n):
+                for (ngram, weight) in vec[order].iteritems():
+                    weight_ref = vec_ref[order].get(ngram, 0.0)
+                    val[order] += min(weight, weight_ref) * weight_ref
+                if (norm[order] != 0) and (norm_ref[order] != 0):
+                    val[order] /= (norm[order] * norm_ref[order])
+                val[order] *= np.e ** (-(delta ** 2) / (2 * sigma ** 2))
+            score += val
+        score_avg = np.mean(score)
+        score_avg /= len(refs)
+        score_avg *= 10.0
+        scores.append(score_avg)
+    return np.mean(np.array(scores))
@@ -0,0 +1,218 @@
+"""
+Vocabulary shortlists for decoding.
+
+At each decoding step, the output layer ('description', a TimeDistributed Dense + softmax) is computed over the whole
+vocabulary, although most of the words are never plausible for a given video. With a shortlist, the candidate words
+of each sample are the most frequent training words plus the words of the captions of the nearest training videos
+(cosine similarity of the mean-pooled video features). Only the columns of the output layer weights corresponding to
+the candidates are computed and the softmax is normalized over them.
+
+The shortlist index (word frequencies, pooled training features and words of each training caption) is built once
+per dataset and stored in DATASET_STORE_PATH/Shortlist_<DATASET_NAME>.pkl.
+"""
+import cPickle as pk
+import logging
+import os
+from collections import Counter
+
+import numpy as np
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def pool_video_features(features):
+    """
+    L2-normalized mean of the (non-padding) frames of each video.
+
+    :param features: video features (n_videos, n_frames, feat_size)
+    :return: pooled features (n_videos, feat_size)
+    """
+    features = np.asarray(features, dtype='float32')
+    n_frames = np.maximum((np.abs(features).sum(axis=2) > 0).sum(axis=1), 1).astype('float32')
+    pooled = features.sum(axis=1) / n_frames[:, None]
+    return pooled / np.maximum(np.linalg.norm(pooled, axis=1), 1e-8)[:, None]
+
+
+def build_shortlist_index(ds, params, batch_size=100):
+    """
+    Builds the shortlist index from the training split of the dataset.
+
+    :param ds: Dataset instance
+    :param params: configuration parameters (see config.py)
+    :param batch_size: number of training videos loaded at once
+    :return: dictionary with the keys 'frequent' (word indices sorted by frequency), 'features' (pooled training
+             features) and 'words' (word indices of each training caption)
+    """
+    output_id = params['OUTPUTS_IDS_DATASET'][0]
+    video_id = params['INPUTS_IDS_DATASET'][0]
+    words2idx = ds.vocabulary[output_id]['words2idx']
+    unk = words2idx.get('<unk>', 1)
+    tokenize_f = eval('ds.' + params['TOKENIZATION_METHOD'])
+
+    logger.info('Building the shortlist index of ' + params['DATASET_NAME'])
+    words = []
+    counts = Counter()
+    for caption in ds.Y_train[output_id]:
+        caption_words = np.unique([words2idx.get(w, unk) for w in tokenize_f(caption).split()]).astype('int64')
+        words.append(caption_words)
+        counts.update(caption_words.tolist())
+    frequent = np.asarray([w for w, _ in counts.most_common()], dtype='int64')
+
+    video_pos = ds.ids_inputs.index(video_id)
+    features = []
+    for i in range(0, ds.len_train, batch_size):
+        X = ds.getX_FromIndices('train', range(i, min(i + batch_size, ds.len_train)), dataAugmentation=False)
+        features.append(pool_video_features(X[video_pos]))
+
+    return {'frequent': frequent, 'features': np.concatenate(features), 'words': words}
+
+
+def shortlist_index_path(params):
+    return params['DATASET_STORE_PATH'] + '/Shortlist_' + params['DATASET_NAME'] + '.pkl'
+
+
+def load_shortlist_index(ds, params):
+    """
+    Loads the shortlist index of the dataset, building and storing it if it does not exist.
+    """
+    index_path = shortlist_index_path(params)
+    if os.path.isfile(index_path):
+        with open(index_path, 'rb') as f:
+            return pk.load(f)
+    index = build_shortlist_index(ds, params)
+    with open(index_path, 'wb') as f:
+        pk.dump(index, f, protocol=pk.HIGHEST_PROTOCOL)
+    logger.info('Stored shortlist index in ' + index_path)
+    return index
+
+
+class Shortlist(object):
+    """
+    Per-sample vocabulary shortlists and the restricted output layer used by the batched search
+    (see utils/batched_search.py).
+    """
+
+    def __init__(self, index, n_frequent=500, n_neighbours=10, special_words=(0, 1, 2), index_path=None):
+        """
+        :param index: shortlist index (see build_shortlist_index)
+        :param n_frequent: number of most frequent training words always included
+        :param n_neighbours: number of nearest training videos whose caption words are included
+        :param special_words: word indices always included (<pad>/<eos>, <unk> and <null>)
+        :param index_path: file of the stored index (see load_shortlist_index), from which it is reloaded when the
+                           shortlist is unpickled
+        """
+        self.index = index
+        self.index_path = index_path
+        self.n_frequent = n_frequent
+        self.n_neighbours = n_neighbours
+        self.special_words = np.asarray(special_words, dtype='int64')
+        self._base = np.union1d(self.special_words, index['frequent'][:n_frequent])
+        self._functions = dict()
+        self._output_weights = None
+        self.n_samples = 0
+        self.total_size = 0
+
+    def __getstate__(self):
+        """
+        The backend functions and weights are not pickled (see bind), nor the index (with the features of every
+        training video) if it can be reloaded from index_path.
+        """
+        obj_dict = self.__dict__.copy()
+        obj_dict['_functions'] = dict()
+        obj_dict['_output_weights'] = None
+        if self.index_path is not None:
+            obj_dict['index'] = None
+        return obj_dict
+
+    def _get_index(self):
+        if self.index is None:
+            with open(self.index_path, 'rb') as f:
+                self.index = pk.load(f)
+        return self.index
+
+    def settings(self):
+        """
+        Settings that change the decoded outputs.
+        """
+        return 'shortlist', self.n_frequent, self.n_neighbours, tuple(self.special_words)
+
+    def candidates(self, video):
+        """
+        Candidate words of a sample.
+
+        :param video: video features of the sample (1, n_frames, feat_size)
+        :return: sorted array of word indices
+        """
+        if self.n_neighbours < 1:
+            candidates = self._base
+        else:
+            index = self._get_index()
+            similarities = index['features'].dot(pool_video_features(video)[0])
+            n_neighbours = min(self.n_neighbours, len(similarities))
+            nearest = np.argpartition(-similarities, n_neighbours - 1)[:n_neighbours]
+            candidates = reduce(np.union1d, [index['words'][i] for i in nearest], self._base)
+        self.n_samples += 1
+        self.total_size += len(candidates)
+        return candidates
+
+    def mean_size(self):
+        """
+        Average number of candidate words of the samples processed so far.
+        """
+        return float(self.total_size) / max(self.n_samples, 1)
+
+    def bind(self, video_model):
+        """
+        Builds the functions from the model_init/model_next inputs to the input of the output layer and recovers
+        the current output layer weights. Must be called each time the weights may have changed.
+        """
+        from keras import backend as K
+
+        if video_model.params.get('CLASSIFIER_ACTIVATION', 'softmax') != 'softmax':
+            raise Exception('Vocabulary shortlists are only available for softmax output layers.')
+        output_name = video_model.ids_outputs[0]
+        self._output_weights = video_model.model_next.get_layer(output_name).get_weights()
+        for model_name in ['model_init', 'model_next']:
+            keras_model = getattr(video_model, model_name)
+            if model_name in self._functions and self._functions[model_name][0] is keras_model:
+                continue
+            layer = keras_model.get_layer(output_name)
+            node = [n for n in layer.inbound_nodes if n.output_tensors[0] is keras_model.outputs[0]][0]
+            function = K.function(keras_model.inputs + [K.learning_phase()],
+                                  [node.input_tensors[0]] + keras_model.outputs[1:])
+            self._functions[model_name] = (keras_model, _HiddenModel(keras_model.input_names, function))
+
+    @property
+    def model_init(self):
+        return self._functions['model_init'][1]
+
+    @property
+    def model_next(self):
+        return self._functions['model_next'][1]
+
+    def log_probs(self, hidden, candidates):
+        """
+        Log-probabilities of the candidate words.
+
+        :param hidden: inputs of the output layer (n_hyps, 1, hidden_size)
+        :param candidates: candidate word indices
+        :return: log-probabilities (n_hyps, len(candidates))
+        """
+        W, b = self._output_weights
+        logits = hidden[:, 0, :].dot(W[:, candidates]) + b[candidates]
+        logits -= logits.max(axis=1, keepdims=True)
+        return logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+
+
+class _HiddenModel(object):
+    """
+    Wraps a backend function so that it can be applied as model.predict_on_batch(in_data).
+    """
+
+    def __init__(self, input_names, function):
+        self.input_names = input_names
+        self.function = function
+
+    def predict_on_batch(self, in_data):
+        return self.function([in_data[name] for name in self.input_names] + [0])
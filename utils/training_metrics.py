@@ -0,0 +1,236 @@
+"""
+Training throughput instrumentation.
+
+With TRAINING_METRICS, train_model records where the time of each update goes and writes one record per update to
+STORE_PATH/training_metrics.<jsonl|csv> (TRAINING_METRICS_FORMAT), with a summary log line every
+TRAINING_METRICS_LOG_EACH updates. The Keras loop of an update is: get the batch from the loaders, on_batch_begin,
+forward/backward pass, on_batch_end of every callback (and on_epoch_end at the end of the epoch). The TrainingMetrics
+callback is the first one of the list and times all the others, so each record has:
+    * data_wait: time spent waiting for the batch (the gap between the previous update and this one, minus the time
+      of the timed callbacks). The callbacks added by trainNet itself (model saving, early stopping, learning rate
+      decay) are not timed, so their time is included here.
+    * step: forward/backward (and update) time of the batch
+    * callbacks: time of the timed callbacks since the previous update (e.g. EvalPerformance, Sample), in total and
+      per callback class
+    * samples and samples_per_sec (over data_wait + callbacks + step)
+    * padding: fraction of padded caption positions of the batch (the loaders read consecutive BATCH_SIZE chunks of
+      the training split in its current order)
+    * max_rss_mb: memory high-water mark of the trainer process
+The setup phases of train_model (dataset, model) are recorded as records with 'event' set to the phase name.
+"""
+import json
+import logging
+import os
+import resource
+from timeit import default_timer as timer
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+FIELDS = ['event', 'time', 'epoch', 'update', 'samples', 'data_wait', 'step', 'callbacks', 'samples_per_sec', 'padding',
+          'max_rss_mb', 'callback_times']
+
+
+def max_rss_mb():
+    """
+    Memory high-water mark of the current process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class MetricsWriter(object):
+    """
+    Appends the metric records to a JSON lines or CSV file.
+    """
+
+    def __init__(self, path, file_format='jsonl'):
+        self.path = path
+        self.file_format = file_format
+        write_header = file_format == 'csv' and not os.path.isfile(path)
+        self.f = open(path, 'a')
+        if write_header:
+            self.f.write(','.join(FIELDS) + '\n')
+
+    def write(self, record):
+        if self.file_format == 'csv':
+            values = []
+            for field in FIELDS:
+                value = record.get(field)
+                if isinstance(value, dict):
+                    value = ';'.join(['%s=%.6f' % (k, v) for k, v in sorted(value.iteritems())])
+                values.append('' if value is None else str(value))
+            self.f.write(','.join(values) + '\n')
+        else:
+            self.f.write(json.dumps(record) + '\n')
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class TrainingMetrics(object):
+    """
+    Collects the setup and per-update metrics of a training.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.file_format = params.get('TRAINING_METRICS_FORMAT', 'jsonl')
+        self.path = os.path.join(params['STORE_PATH'], 'training_metrics.' + self.file_format)
+        # The file is opened with the callback, since building the model may clear STORE_PATH
+        self.writer = None
+        self.phases = []
+        self.log_each = params.get('TRAINING_METRICS_LOG_EACH', 100)
+        self.phase_start = timer()
+
+    def phase(self, name):
+        """
+        Records the time elapsed since the previous phase (or the creation of the metrics) as the 'name' phase.
+        """
+        now = timer()
+        record = {'event': name, 'time': now - self.phase_start, 'max_rss_mb': max_rss_mb()}
+        if self.writer is None:
+            self.phases.append(record)
+        else:
+            self.writer.write(record)
+            self.writer.flush()
+        logger.info('Training metrics: %s took %.2fs' % (name, now - self.phase_start))
+        self.phase_start = now
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def callback(self, callbacks, dataset):
+        """
+        Builds the TrainingMetrics callback, timing the given callbacks. It must be the first one of the list.
+        """
+        from keras.callbacks import Callback as KerasCallback
+
+        if not os.path.isdir(self.params['STORE_PATH']):
+            os.makedirs(self.params['STORE_PATH'])
+        self.writer = MetricsWriter(self.path, self.file_format)
+        for record in self.phases:
+            self.writer.write(record)
+        self.phases = []
+        metrics = self
+        params = self.params
+        if '-vidtext-embed' in params['DATASET_NAME']:
+            caption_id = params['INPUTS_IDS_DATASET'][1]
+        else:
+            caption_id = params['OUTPUTS_IDS_DATASET'][0]
+
+        class TrainingMetricsCallback(KerasCallback):
+
+            def __init__(self):
+                super(TrainingMetricsCallback, self).__init__()
+                self.callback_times = dict()
+                self.epoch = params['RELOAD']
+                self.update = 0
+                self.batch_start = None
+                self.callbacks_before_step = 0.
+                self.last_end = None
+                self.window = []
+                self.totals = {'samples': 0, 'data_wait': 0., 'step': 0., 'callbacks': 0.}
+                for c in callbacks:
+                    self.timed(c)
+
+            def timed(self, c):
+                name = c.__class__.__name__
+                for method in ['on_epoch_begin', 'on_epoch_end', 'on_batch_begin', 'on_batch_end', 'on_train_end']:
+                    setattr(c, method, self.timed_method(name, getattr(c, method)))
+
+            def timed_method(self, name, original):
+                def timed_method(*args, **kwargs):
+                    start = timer()
+                    try:
+                        return original(*args, **kwargs)
+                    finally:
+                        self.callback_times[name] = self.callback_times.get(name, 0.) + timer() - start
+
+                return timed_method
+
+            def on_epoch_begin(self, epoch, logs=None):
+                self.epoch = epoch + 1
+
+            def on_batch_begin(self, batch, logs=None):
+                self.batch_start = timer()
+                self.callbacks_before_step = sum(self.callback_times.values())
+
+            def on_batch_end(self, batch, logs=None):
+                end = timer()
+                self.update += 1
+                samples = int((logs or dict()).get('size', params['BATCH_SIZE']))
+                callback_times = self.callback_times
+                self.callback_times = dict()
+                callbacks_time = sum(callback_times.values())
+                # on_batch_begin of the callbacks run after this one
+                callbacks_in_step = callbacks_time - self.callbacks_before_step
+                gap = self.batch_start - self.last_end if self.last_end is not None else 0.
+                record = {'event': 'update',
+                          'epoch': self.epoch,
+                          'update': self.update,
+                          'samples': samples,
+                          'data_wait': max(gap - self.callbacks_before_step, 0.),
+                          'step': end - self.batch_start - callbacks_in_step,
+                          'callbacks': callbacks_time,
+                          'padding': self.padding(batch, samples),
+                          'max_rss_mb': max_rss_mb(),
+                          'callback_times': callback_times}
+                total = record['data_wait'] + record['step'] + record['callbacks']
+                record['samples_per_sec'] = samples / total if total > 0 else None
+                metrics.writer.write(record)
+                self.window.append(record)
+                for key in self.totals:
+                    self.totals[key] += record[key]
+                if len(self.window) >= metrics.log_each:
+                    self.report(self.window, 'last %d updates' % len(self.window))
+                    self.window = []
+                    metrics.writer.flush()
+                # The callbacks run after this one count for the next update
+                self.last_end = timer()
+
+            def on_train_end(self, logs=None):
+                if self.window:
+                    self.report(self.window, 'last %d updates' % len(self.window))
+                if self.update > 0:
+                    total = self.totals['data_wait'] + self.totals['step'] + self.totals['callbacks']
+                    logger.info('Training metrics (%d updates): %.1f samples/s, data wait %.1f%%, step %.1f%%, '
+                                'callbacks %.1f%%. Peak memory %.0f MB. Stored in %s' %
+                                (self.update, self.totals['samples'] / max(total, 1e-8),
+                                 100. * self.totals['data_wait'] / max(total, 1e-8),
+                                 100. * self.totals['step'] / max(total, 1e-8),
+                                 100. * self.totals['callbacks'] / max(total, 1e-8), max_rss_mb(), metrics.path))
+                metrics.writer.flush()
+
+            def padding(self, batch, samples):
+                """
+                Fraction of padded caption positions of the batch-th batch of the epoch.
+                """
+                try:
+                    captions = dataset.Y_train[caption_id] if caption_id in dataset.Y_train \
+                        else dataset.X_train[caption_id]
+                    start = batch * params['BATCH_SIZE']
+                    lengths = [len(c.split()) + 1 for c in captions[start:start + samples]]  # +1 for <eos>
+                except Exception:
+                    return None
+                if not lengths:
+                    return None
+                return 1. - float(sum(lengths)) / (max(lengths) * len(lengths))
+
+            def report(self, records, description):
+                total = sum([r['data_wait'] + r['step'] + r['callbacks'] for r in records])
+                paddings = [r['padding'] for r in records if r['padding'] is not None]
+                logger.info('Training metrics (%s, update %d): %.1f samples/s, data wait %.3fs, step %.3fs, '
+                            'callbacks %.3fs per update, padding %s, peak memory %.0f MB' %
+                            (description, self.update, sum([r['samples'] for r in records]) / max(total, 1e-8),
+                             sum([r['data_wait'] for r in records]) / len(records),
+                             sum([r['step'] for r in records]) / len(records),
+                             sum([r['callbacks'] for r in records]) / len(records),
+                             '%.1f%%' % (100. * sum(paddings) / len(paddings)) if paddings else 'n/a',
+                             records[-1]['max_rss_mb']))
+
+        return TrainingMetricsCallback()
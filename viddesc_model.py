@@ -3,12 +3,17 @@ import os
 
 import numpy as np
 
+from data_engine.shared_memory_loader import shared_memory_generators
 from keras import backend as K
 from keras.layers import *
 from keras.models import model_from_json, Model
 from keras.regularizers import l2
 from keras_wrapper.cnn_model import Model_Wrapper
 from keras_wrapper.extra.regularize import Regularize
+from keras_wrapper.utils import checkParameters
+from utils.batched_search import predict_batched_beam_search
+from utils import profiling
+from utils.decode_cache import inputs_hash
 
 
 class VideoDesc_Model(Model_Wrapper):
@@ -82,7 +87,8 @@ class VideoDesc_Model(Model_Wrapper):
             if hasattr(self, type):
                 if self.verbose > 0:
                     logging.info("<<< Building '" + type + "' Video Captioning Model >>>")
-                eval('self.' + type + '(params)')
+                with profiling.scope('build_model'):
+                    eval('self.' + type + '(params)')
             else:
                 raise Exception('Video_Captioning_Model type "' + type + '" is not implemented.')
 
@@ -105,13 +111,135 @@ class VideoDesc_Model(Model_Wrapper):
         Sets a new optimizer for the Translation_Model.
         :param **kwargs:
         """
+        with profiling.scope('setOptimizer'):
+            super(self.__class__, self).setOptimizer(lr=self.params['LR'],
+                                                     clipnorm=self.params['CLIP_C'],
+                                                     loss=self.params['LOSS'],
+                                                     optimizer=self.params['OPTIMIZER'],
+                                                     sample_weight_mode='temporal' if self.params.get('SAMPLE_WEIGHTS',
+                                                                                                      False) else None)
+
+    def setDecodeCache(self, decode_cache):
+        """
+        Sets a DecodeCache (see utils/decode_cache.py) for storing and reusing the beam search results.
+        :param decode_cache: DecodeCache instance or None for disabling it
+        """
+        self.decode_cache = decode_cache
+
+    def setFunctionCache(self, function_cache):
+        """
+        Sets a FunctionCache (see utils/function_cache.py) for storing and reloading the compiled functions of the
+        model, model_init and model_next.
+        :param function_cache: FunctionCache instance or None for disabling it
+        """
+        self.function_cache = function_cache
+        if function_cache is not None:
+            function_cache.install(self)
+        else:
+            from utils.function_cache import wrap_function_builders
+
+            # The compilation is still timed by the profiler
+            wrap_function_builders(self)
+            for model_name in ['model', 'model_init', 'model_next']:
+                if getattr(self, model_name, None) is not None:
+                    getattr(self, model_name)._function_cache = None
+
+    def setShortlist(self, shortlist):
+        """
+        Sets a vocabulary Shortlist (see utils/shortlist.py) for restricting the output layer when decoding.
+        Shortlists are only applied by the batched search.
+        :param shortlist: Shortlist instance or None for disabling it
+        """
+        self.shortlist = shortlist
+
+    def setEnsemble(self, ensemble):
+        """
+        Sets an Ensemble (see utils/ensemble.py) decoded instead of this model by predictBeamSearchNet. Ensembles are
+        only applied by the batched search, and the vocabulary shortlist is not applied with them.
+        :param ensemble: Ensemble instance or None for disabling it
+        """
+        self.ensemble = ensemble
+
+    def trainNet(self, ds, parameters=None, out_name=None):
+        """
+        Trains the network on the given dataset.
+        If 'shared_memory_loader' is enabled (and the batches are not homogeneous), the training batches are loaded
+        by 'n_parallel_loaders' processes through shared memory, with 'loader_prefetch' batches prepared ahead
+        (see data_engine/shared_memory_loader.py).
+        """
+        # The loader options are not training parameters of Model_Wrapper (which rejects unknown ones)
+        parameters = dict(parameters or dict())
+        shared_memory_loader = parameters.pop('shared_memory_loader', False)
+        loader_prefetch = parameters.pop('loader_prefetch', 8)
+        if not shared_memory_loader or parameters.get('homogeneous_batches', False):
+            return super(self.__class__, self).trainNet(ds, parameters, out_name)
+        n_parallel_loaders = parameters.get('n_parallel_loaders', 1)
+        with shared_memory_generators(n_parallel_loaders, loader_prefetch, max_q_size=n_parallel_loaders):
+            return super(self.__class__, self).trainNet(ds, parameters, out_name)
+
+    def predictBeamSearchNet(self, ds, parameters=None):
+        """
+        Approximates by beam search the best predictions of the net on the dataset splits chosen.
+        If a decode cache is set, the results of the samples already decoded with the current weights are reused.
+        If 'batched_search' (or BATCHED_SEARCH) is enabled or a vocabulary shortlist is set, the samples are decoded
+        in batches with early exit (see utils/batched_search.py). Only applicable to optimized search models when
+        predicting on full splits. If an ensemble is set, it is decoded (always with the batched search).
+        """
+        if parameters is None:
+            parameters = dict()
+        ensemble = getattr(self, 'ensemble', None)
+        shortlist = getattr(self, 'shortlist', None) if ensemble is None else None
+        batched_search = (parameters.get('batched_search', self.params.get('BATCHED_SEARCH', False)) or
+                          shortlist is not None or ensemble is not None) and \
+                         parameters.get('optimized_search', True) and parameters.get('n_samples', -1) < 1 and \
+                         not parameters.get('pos_unk', False) and getattr(self, 'model_next', None) is not None
+        decode_cache = getattr(self, 'decode_cache', None)
+        if decode_cache is not None:
+            decode_cache.set_weights(self.model)
+        try:
+            with profiling.scope('predictBeamSearchNet'):
+                if batched_search:
+                    params = checkParameters(parameters, self.default_predict_with_beam_params)
+                    if ds.pad_on_batch[params['dataset_inputs'][params['state_below_index']]]:
+                        return predict_batched_beam_search(self, ds, params, shortlist=shortlist, ensemble=ensemble)
+                if ensemble is not None:
+                    raise Exception('Ensemble decoding requires the optimized search on full splits, without pos_unk '
+                                    'and with pad_on_batch state_below.')
+                return super(self.__class__, self).predictBeamSearchNet(ds, parameters)
+        finally:
+            if decode_cache is not None:
+                decode_cache.flush()
+
+    def beam_search(self, X, params, *args, **kwargs):
+        """
+        Beam search on a single sample. Looks up the decode cache (if set) before applying the search.
+        """
+        decode_cache = getattr(self, 'decode_cache', None)
+        if decode_cache is None:
+            with profiling.scope('beam_search'):
+                return super(self.__class__, self).beam_search(X, params, *args, **kwargs)
+
+        key = inputs_hash(X, params, extra=(args, sorted(kwargs.items())))
+        result = decode_cache.get(key)
+        if result is None:
+            with profiling.scope('beam_search'):
+                result = super(self.__class__, self).beam_search(X, params, *args, **kwargs)
+            decode_cache.put(key, result)
+        return result
+
+    def predict_cond(self, X, states_below, params, ii):
+        """
+        Beam search step (non-optimized search), timed as 'model_next' by the profiler (see utils/profiling.py).
+        """
+        with profiling.scope('model_next'):
+            return super(self.__class__, self).predict_cond(X, states_below, params, ii)
 
-        super(self.__class__, self).setOptimizer(lr=self.params['LR'],
-                                                 clipnorm=self.params['CLIP_C'],
-                                                 loss=self.params['LOSS'],
-                                                 optimizer=self.params['OPTIMIZER'],
-                                                 sample_weight_mode='temporal' if self.params.get('SAMPLE_WEIGHTS',
-                                                                                                  False) else None)
+    def predict_cond_optimized(self, X, states_below, params, ii, prev_out):
+        """
+        Beam search step (optimized search), timed as 'model_init' or 'model_next' by the profiler.
+        """
+        with profiling.scope('model_init' if ii == 0 else 'model_next'):
+            return super(self.__class__, self).predict_cond_optimized(X, states_below, params, ii, prev_out)
 
     def __str__(self):
         """